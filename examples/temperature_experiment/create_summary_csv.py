@@ -39,7 +39,7 @@ for i, val in enumerate(["", "P0.5", "P1.0", "P1.5", "P2.0", "P2.5", "P3.0",
 
     for i, f in enumerate(files):
         ipw = IPW(f)
-        melt_sum_list[i] = ipw.data_frame.melt.sum()
+        melt_sum_list[i] = ipw['melt'].sum()
 
     melt_sums[val] = melt_sum_list
 
@@ -1,40 +1,24 @@
 #!/usr/local/bin/python
 """
-Example of how to modify the observed Kormos data's temperature by a values and
-save the modified results
+Example of how to modify the observed Kormos data's temperature by several
+values and save the modified results.
+
+Usage: ./modify_ipw_temps.py amount [amount ...]
+
+Every input file in data/inputs is read once, and written with its
+temperature increased by each amount to data/inputsP{amount}/.
 """
 
 import sys
-import os
 
 sys.path.append('../../')
 
-from wcwave_adaptors.isnobal import IPW
-
-amount = float(sys.argv[1])
-inputFile = sys.argv[2]
-
-base_dir = os.path.dirname(inputFile).split('/')[0]
-
-# output_dirs = ["data/inputsP" + amount + "/", "data/inputsM" + amount + "/"]
-output_dir = base_dir + "/inputsP" + str(amount) + "/"
-
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-# load file
-ipw = IPW(inputFile)
+from vwpy.ensemble import Perturbation, offset, write_perturbed_inputs
 
-df = ipw.data_frame().copy()
+amounts = [float(amount) for amount in sys.argv[1:]]
 
-# for i, amt in enumerate([float(amount), -float(amount)]):
-# adjust the dataframe's temperature by amt
-ipw._data_frame.T_a = df.T_a + amount
+perturbations = [Perturbation("inputsP" + str(amount),
+                              {'T_a': offset(amount)})
+                 for amount in amounts]
 
-# save file to the appropriate outputdir
-ipw.recalculate_header()
-try:
-    ipw.write(output_dir + os.path.basename(inputFile))
-except Exception as e:
-    print "Error on file " + inputFile
-    print e.message
+write_perturbed_inputs("data/inputs", perturbations, "data")
@@ -186,10 +186,9 @@ fi
 
 printf "\nCreating modified temperature input data\n"
 
-# Increase the temperatures by multiples of .5 degrees
-for mod_val in 0.5 1.0 1.5 2.0 2.5 3.0 3.5 4.0; do
-    parallel python modify_ipw_temps.py $mod_val {} ::: $(find data/inputs -type f)
-done
+# Increase the temperatures by multiples of .5 degrees; each input file is
+# read once and written for every scenario
+python modify_ipw_temps.py 0.5 1.0 1.5 2.0 2.5 3.0 3.5 4.0
 
 
 # Now we're ready to run ISNOBAL on each of our nine input scenarios: observed
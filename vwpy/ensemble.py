@@ -0,0 +1,462 @@
+"""
+Run ensembles of iSNOBAL scenarios on a pool of processes.
+
+An ensemble is a base input NetCDF and a list of Scenarios, each a name and a
+function that perturbs a copy of the base input, e.g. adds 1 dg C to T_a:
+
+>>> def warmer(nc):
+...     nc.variables['T_a'][:] += 1.0
+>>> members = run_ensemble('kormos_inputs.nc',
+...                        [Scenario('observed'), Scenario('P1.0', warmer)],
+...                        'ensemble_outputs')
+>>> members[1].dataset.variables['melt']
+
+Every member runs in a scratch directory of its own. The number of members
+run at once is bounded by the CPUs they use and by the free disk space of
+the scratch directory.
+
+Scenarios of IPW inputs are written by write_perturbed_inputs, which decodes
+every file of a directory once and writes it for each of a list of
+Perturbations, e.g. T_a + 0.5, T_a + 1.0, ... T_a + 4.0:
+
+>>> perturbations = [Perturbation('inputsP%.1f' % (0.5*k),
+...                               {'T_a': offset(0.5*k)})
+...                  for k in range(1, 9)]
+>>> write_perturbed_inputs('data/inputs', perturbations, 'data')
+"""
+import logging
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from netCDF4 import Dataset
+from operator import add, mul
+from os import listdir, makedirs, statvfs
+from os.path import basename, exists, isfile
+from os.path import join as osjoin
+
+from .isnobal import (isnobal, IPW, IPWIndex, _close_datasets,
+                      refresh_precip_tsteps, VARNAME_BY_FILETYPE, NC_NBYTES)
+
+
+#: Free bytes run_ensemble leaves on the scratch directory's file system
+MIN_FREE_DISK = 1024**3
+
+#: Seconds between run_ensemble's checks on its running members
+ENSEMBLE_POLL_SECONDS = 0.2
+
+#: A member of an ensemble: its name, which also names its output NetCDF,
+#: and a function that modifies an open copy of the base input in place, or
+#: None to run the base input as it is. The function must be picklable,
+#: i.e. defined at the top level of a module.
+Scenario = namedtuple('Scenario', ['name', 'perturb'])
+Scenario.__new__.__defaults__ = (None,)
+
+#: A scenario of IPW inputs for write_perturbed_inputs: its name, which
+#: names its output directory, and a dict of variable name to a function of
+#: that band's flat floating point data, see offset and scale
+Perturbation = namedtuple('Perturbation', ['name', 'transforms'])
+
+
+def offset(amount):
+    """Transform adding `amount` to a band, e.g. dg C to T_a"""
+    return partial(add, amount)
+
+
+def scale(factor):
+    """Transform multiplying a band by `factor`, e.g. m_pp by 1.1"""
+    return partial(mul, factor)
+
+
+class EnsembleMember(object):
+    """
+    Result of running one Scenario of an ensemble.
+
+    Attributes:
+        name (str) name of the scenario
+        output_path (str) path of the output NetCDF
+        timing (dict) seconds spent perturbing the input ('perturb'),
+            running isnobal including staging and building the output
+            NetCDF ('isnobal'), and in total ('total')
+        error (Exception) what the run raised, or None if it succeeded
+    """
+    def __init__(self, name, output_path, timing=None, error=None):
+        self.name = name
+        self.output_path = output_path
+        self.timing = timing or {}
+        self.error = error
+        self._dataset = None
+
+    @property
+    def dataset(self):
+        """
+        The output NetCDF, opened read-only on first access
+        """
+        if self.error is not None:
+            raise EnsembleError("member %s failed: %s" %
+                                (self.name, self.error))
+
+        if self._dataset is None:
+            self._dataset = Dataset(self.output_path, 'r')
+
+        return self._dataset
+
+    def close(self):
+        if self._dataset is not None:
+            self._dataset.close()
+            self._dataset = None
+
+
+def run_ensemble(base_nc, scenarios, output_dir, workers=None,
+                 max_cpus=None, scratch_dir=None, min_free_disk=MIN_FREE_DISK,
+                 **kwargs):
+    """
+    Run isnobal for each scenario of an ensemble, each member in a worker
+    process of its own. A member whose process dies, e.g. killed for
+    running out of memory, fails with an EnsembleError like a member whose
+    run raised.
+
+    Arguments:
+        base_nc (str or netCDF4.Dataset) input NetCDF the scenarios perturb.
+            A Dataset must be open read-only; HDF5 locks files open for
+            writing, so members could not open it
+        scenarios (list) Scenarios to run; their names must be unique
+        output_dir (str) directory to write {name}.nc outputs to
+        workers (int) most members to run at once; by default as many as
+            the CPU and disk limits allow
+        max_cpus (int) CPUs the ensemble may use, by default all of them.
+            A member uses as many as the `tiles` or `workers` it is run
+            with, see isnobal
+        scratch_dir (str) directory for the members' scratch directories;
+            defaults to the system's temporary directory
+        min_free_disk (int) bytes to leave free on the file system of
+            `scratch_dir`. No member is started unless its estimated
+            scratch space (see _member_scratch_bytes) fits above that
+        kwargs: passed on to isnobal for every member
+
+    Returns:
+        (list) EnsembleMember of each scenario, in the order of `scenarios`
+    """
+    names = [s.name for s in scenarios]
+    if len(set(names)) != len(names):
+        raise EnsembleError("scenario names are not unique")
+
+    if isinstance(base_nc, Dataset):
+        base_ds, base_path = base_nc, base_nc.filepath()
+    else:
+        base_ds, base_path = None, base_nc
+
+    if scratch_dir is None:
+        scratch_dir = tempfile.gettempdir()
+
+    if not exists(output_dir):
+        makedirs(output_dir)
+
+    if base_ds is None:
+        base = Dataset(base_path, 'r')
+        member_bytes = _member_scratch_bytes(base)
+        base.close()
+    else:
+        member_bytes = _member_scratch_bytes(base_ds)
+
+    n_workers = _pool_size(len(scenarios), workers, max_cpus, scratch_dir,
+                           member_bytes, min_free_disk, **kwargs)
+
+    logging.debug('running %d ensemble members, %d at a time' %
+                  (len(scenarios), n_workers))
+
+    members = {}
+    pending = list(scenarios)
+    running = []
+
+    # members opening the base input must not use this process' handle
+    datasets = [base_ds] if base_ds is not None else []
+    try:
+        while pending or running:
+
+            while pending and len(running) < n_workers and \
+                    _free_disk(scratch_dir) >= member_bytes + min_free_disk:
+
+                scenario = pending.pop(0)
+                output_path = osjoin(output_dir, scenario.name + '.nc')
+                member_dir = tempfile.mkdtemp(prefix='member',
+                                              dir=scratch_dir)
+
+                conn, worker_conn = multiprocessing.Pipe(duplex=False)
+                proc = multiprocessing.Process(
+                    target=_run_member,
+                    args=(worker_conn, datasets, base_path, scenario,
+                          output_path, member_dir, kwargs))
+                proc.start()
+                # so the pipe reads as closed once the worker is gone
+                worker_conn.close()
+
+                running.append((proc, conn, scenario.name, output_path,
+                                member_dir))
+
+            if not running:
+                raise EnsembleError(
+                    "less than %d bytes free in %s for a member" %
+                    (member_bytes + min_free_disk, scratch_dir))
+
+            time.sleep(ENSEMBLE_POLL_SECONDS)
+
+            still_running = []
+            for member in running:
+                proc, conn, name, output_path, member_dir = member
+
+                result = _member_result(proc, conn)
+                if result is None:
+                    still_running.append(member)
+                    continue
+
+                proc.join()
+                conn.close()
+                # left behind by a worker that died
+                shutil.rmtree(member_dir, ignore_errors=True)
+
+                timing, error = result
+                if error is None:
+                    members[name] = EnsembleMember(name, output_path, timing)
+                else:
+                    logging.error('ensemble member %s failed: %s' %
+                                  (name, error))
+                    members[name] = EnsembleMember(
+                        name, output_path, error=EnsembleError(error))
+
+            running = still_running
+
+    finally:
+        for proc, conn, _, _, member_dir in running:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+            conn.close()
+            shutil.rmtree(member_dir, ignore_errors=True)
+
+    return [members[name] for name in names]
+
+
+def _member_result(proc, conn):
+    """
+    Result of the member run by the worker `proc`, which sends it through
+    `conn`: None while it runs, or what _run_member sent. A worker that
+    died before sending one gives an error message with its exit code.
+    """
+    # a worker that sent its result and exited reads as sent, not dead
+    if not conn.poll() and proc.is_alive():
+        return None
+
+    try:
+        return conn.recv()
+    except EOFError:
+        proc.join()
+        return None, "worker process died with exit code %s" % proc.exitcode
+
+
+def _run_member(conn, datasets, base_path, scenario, output_path,
+                member_dir, kwargs):
+    """
+    Run one ensemble member in a worker process of run_ensemble, in the
+    scratch directory `member_dir`, which is removed afterwards. The parent's
+    `datasets` are closed first, see _close_datasets.
+
+    Sends through `conn`:
+        (tuple) timing of the member (see EnsembleMember) and None, or None
+            and the error message if the member failed
+    """
+    _close_datasets(datasets)
+
+    try:
+        result = _timed_member_run(base_path, scenario, output_path,
+                                   member_dir, kwargs), None
+    except Exception as e:
+        # not every exception can be unpickled in the parent, e.g. Python
+        # 2's CalledProcessError
+        message = "%s: %s" % (type(e).__name__, e)
+        if getattr(e, 'output', None):
+            message += "\n" + e.output
+        result = None, message
+
+    conn.send(result)
+    conn.close()
+
+
+def _timed_member_run(base_path, scenario, output_path, member_dir,
+                      kwargs):
+    """
+    Run one ensemble member; see _run_member
+    """
+    start = time.time()
+    try:
+        input_path = base_path
+
+        if scenario.perturb is not None:
+            input_path = osjoin(member_dir, 'input.nc')
+            shutil.copyfile(base_path, input_path)
+
+            nc = Dataset(input_path, 'a')
+            try:
+                scenario.perturb(nc)
+                # the perturbation may have added or removed precipitation
+                refresh_precip_tsteps(nc)
+            finally:
+                nc.close()
+
+        perturbed = time.time()
+
+        nc_in = Dataset(input_path, 'r')
+        try:
+            isnobal(nc_in, output_path, scratch_dir=member_dir,
+                    **kwargs).close()
+        finally:
+            nc_in.close()
+
+        done = time.time()
+
+    finally:
+        shutil.rmtree(member_dir, ignore_errors=True)
+
+    return {'perturb': perturbed - start, 'isnobal': done - perturbed,
+            'total': done - start}
+
+
+def _member_scratch_bytes(nc_in):
+    """
+    Estimate the scratch space of one member run on `nc_in`: its perturbed
+    copy of the input, and the IPW inputs and outputs of every time step,
+    counting precipitation at every step.
+
+    Returns:
+        (int) bytes
+    """
+    npixels = len(nc_in.dimensions['northing']) * \
+        len(nc_in.dimensions['easting'])
+    ntimes = len(nc_in.dimensions['time'])
+
+    nbands_in = len(VARNAME_BY_FILETYPE['in']) + \
+        len(VARNAME_BY_FILETYPE['precip'])
+    nbands_out = len(VARNAME_BY_FILETYPE['em']) + \
+        len(VARNAME_BY_FILETYPE['snow'])
+
+    # the copy is uncompressed 4-byte floats at worst
+    copy_bytes = ntimes*npixels*nbands_in*4
+    ipw_bytes = ntimes*npixels*(nbands_in + nbands_out)*NC_NBYTES
+
+    return copy_bytes + ipw_bytes
+
+
+def _pool_size(n_members, workers, max_cpus, scratch_dir, member_bytes,
+               min_free_disk, **kwargs):
+    """
+    Number of members to run at once, given the CPUs each uses and the
+    space each needs in `scratch_dir`
+
+    Returns:
+        (int) pool size, at least 1
+    """
+    if max_cpus is None:
+        max_cpus = multiprocessing.cpu_count()
+
+    member_cpus = max(kwargs.get('tiles', 1), kwargs.get('workers', 1), 1)
+
+    by_disk = (_free_disk(scratch_dir) - min_free_disk) // member_bytes
+    if by_disk < 1:
+        raise EnsembleError("less than %d bytes free in %s for a member" %
+                            (member_bytes + min_free_disk, scratch_dir))
+
+    n = min(n_members, max(1, max_cpus // member_cpus), by_disk)
+    if workers is not None:
+        n = min(n, workers)
+
+    return max(1, int(n))
+
+
+def _free_disk(path):
+    """Bytes available to unprivileged users on the file system of `path`"""
+    st = statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def write_perturbed_inputs(input_dir, perturbations, output_root,
+                           file_type=None, workers=1):
+    """
+    Write the IPW files of `input_dir` for each of `perturbations`, to a
+    directory named for the perturbation in `output_root`. Every file is
+    read and decoded once; each perturbation's transforms are applied to
+    the bands they name, those bands are requantized, and the file is
+    written for each perturbation in the same pass. Files without a band
+    a perturbation transforms are copied as they are.
+
+    Arguments:
+        input_dir (str) directory of IPW files, e.g. inputs/
+        perturbations (list) Perturbations to write
+        output_root (str) directory to create the output directories in
+        file_type (str) file type of every file in `input_dir`, for files
+            whose names don't tell it, e.g. 'precip' for ppt_images_dist/;
+            by default files are found and typed by IPWIndex
+        workers (int) number of processes writing files; the transforms
+            must then be picklable, like those of offset and scale
+
+    Returns:
+        (list) output directory of each perturbation
+    """
+    names = [p.name for p in perturbations]
+    if len(set(names)) != len(names):
+        raise EnsembleError("perturbation names are not unique")
+
+    output_dirs = [osjoin(output_root, name) for name in names]
+    for output_dir in output_dirs:
+        if not exists(output_dir):
+            makedirs(output_dir)
+
+    if file_type is None:
+        index = IPWIndex(input_dir)
+        jobs = [(f, str(index.entries[basename(f)]['file_type']))
+                for f in index.files()]
+    else:
+        jobs = [(osjoin(input_dir, filename), file_type)
+                for filename in sorted(listdir(input_dir))
+                # hidden files are indexes and IPW.write's temporary files
+                if not filename.startswith('.') and
+                isfile(osjoin(input_dir, filename))]
+
+    if workers <= 1:
+        for path, job_type in jobs:
+            _write_perturbed_ipw(path, job_type, perturbations, output_dirs)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            paths, job_types = zip(*jobs) if jobs else ([], [])
+            list(executor.map(_write_perturbed_ipw, paths, job_types,
+                              [perturbations]*len(jobs),
+                              [output_dirs]*len(jobs)))
+
+    return output_dirs
+
+
+def _write_perturbed_ipw(path, file_type, perturbations, output_dirs):
+    """
+    Write the IPW file at `path` for each of `perturbations` to the
+    corresponding directory of `output_dirs`, decoding it once
+    """
+    ipw = IPW(path, file_type=file_type)
+
+    for perturbation, output_dir in zip(perturbations, output_dirs):
+        output_path = osjoin(output_dir, basename(path))
+
+        transforms = dict((varname, transform) for varname, transform
+                          in perturbation.transforms.iteritems()
+                          if varname in ipw.varnames)
+
+        if transforms:
+            ipw.transformed(transforms).write(output_path)
+        else:
+            shutil.copyfile(path, output_path)
+
+
+class EnsembleError(Exception):
+    pass
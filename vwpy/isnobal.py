@@ -11,32 +11,42 @@ Tools for working with IPW binary data and running the iSNOBAL model.
 # class (see https://github.com/rogerlew/RL_GIS_Sandbox/tree/master/isnobal).
 #
 import datetime
+import hashlib
+import json
 import logging
+import multiprocessing
 import subprocess
 import netCDF4
 import re
+import tempfile
+import threading
+import time
 import warnings
 import xray
 
-from collections import namedtuple, defaultdict
-from copy import deepcopy
+from collections import (namedtuple, defaultdict, deque, OrderedDict,
+                         MutableMapping)
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy, deepcopy
+from itertools import izip
 from netCDF4 import Dataset
-from numpy import (arange, array, zeros, ravel, reshape, fromstring, dtype,
-                   floor, log10)
+from numpy import (arange, array, asarray, empty, ones, zeros, nonzero,
+                   ravel, reshape, frombuffer, dtype, floor, log10, memmap,
+                   nan, nanmin, nanmax, isnan, cumsum, searchsorted)
 from numpy import sum as npsum
 from numpy import round as npround
-from numpy.ma import masked
-from os import mkdir, listdir
-from os.path import exists, dirname, basename
+from numpy.ma import is_masked, getdata, getmaskarray
+from os import mkdir, listdir, remove, rename, stat, chmod, fdopen, umask
+from os.path import abspath, exists, dirname, basename, getsize, isfile
 from os.path import join as osjoin
 from pandas import date_range, DataFrame, Series, Timedelta
 from progressbar import ProgressBar
 from shutil import rmtree
-from struct import pack
 
 from .watershed import make_fgdc_metadata, make_watershed_metadata
 
-from .netcdf import ncgen_from_template, utm2latlon
+from .netcdf import (ncgen_from_template, utm2latlon,
+                     DEFAULT_STORAGE_PROFILE)
 
 
 #: IPW standard. assumed unchanging since they've been the same for 20 years
@@ -48,6 +58,19 @@ NC_NBYTES = 2
 NC_NBITS = 16
 NC_MAXINT = pow(2, NC_NBITS) - 1
 
+#: Default memory, in bytes, for buffering time steps before writing them to
+#: a NetCDF as one hyperslab per variable
+NC_BUFFER_MEMORY = 256*1024**2
+
+#: Seconds between looks at the outputs of a running isnobal process
+OUTPUT_POLL_SECONDS = 0.5
+
+#: Least time, in seconds, between progress events of a running isnobal
+PROGRESS_INTERVAL_SECONDS = 5
+
+#: Lines of the output of an isnobal process kept for error messages
+OUTPUT_LINES_KEPT = 1000
+
 #: Container for ISNOBAL Global Band information
 GlobalBand = namedtuple("GlobalBand", 'byteorder nLines nSamps nBands')
 
@@ -102,16 +125,53 @@ VARNAME_BY_FILETYPE = \
         'em': ['R_n', 'H', 'L_v_E', 'G', 'M', 'delta_Q',
                'E_s', 'melt', 'ro_predict', 'cc_s'],
         'snow': ['z_s', 'rho', 'm_s', 'h2o', 'T_s_0',
-                 'T_s_l', 'T_s', 'z_s_l', 'h2o_sat']
+                 'T_s_l', 'T_s', 'z_s_l', 'h2o_sat'],
+        # two-layer init, with the lower layer temperature, to restart from
+        'restart': ['z', 'z_0', 'z_s', 'rho', 'T_s_0',
+                    'T_s_l', 'T_s', 'h2o_sat']
     }
 
-#: ISNOBAL variable names to be looked up to make dataframes and write metadata
-#: Convert number of bytes to struct package code for unsigned integer type
-PACK_DICT = \
+#: Index variable of input NetCDFs flagging the time steps with precipitation
+PRECIP_TSTEPS_VARNAME = 'precip_tsteps'
+
+#: Suffix of the restart init a segmented run keeps next to its output
+RESTART_INIT_SUFFIX = '.restart_init'
+
+#: Conventional name of an index file IPWIndex keeps in an IPW directory
+IPW_INDEX_FILENAME = '.ipw_index.json'
+
+#: Bumped when the IPWIndex entry format changes; older indexes are rebuilt
+IPW_INDEX_VERSION = 3
+
+#: Seconds within which a file may be rewritten without its mtime changing,
+#: allowing for file systems that keep mtimes in whole or even seconds
+IPW_INDEX_MTIME_TICK = 2.0
+
+# netCDF-C 4.6 on HDF5 1.10 aborts (double free) reading time steps past the
+# end of a chunked variable's written data, where it should return fill
+# values; generate_standard_nc pads the precip variables to the end of time
+# only with these libraries
+_NC_READ_PAST_DATA_CRASHES = \
+    netCDF4.__netcdf4libversion__.startswith('4.6.') and \
+    netCDF4.__hdf5libversion__.startswith('1.10.')
+
+# the process umask, for IPW.write to give the files it writes through
+# mkstemp the mode open() would; it can only be read by setting it
+_UMASK = umask(0)
+umask(_UMASK)
+
+#: Suffix of the journal generate_standard_nc keeps next to a NetCDF it is
+#: building with resume=True
+NC_JOURNAL_SUFFIX = '.journal'
+
+#: Number of IPW files generate_standard_nc inserts between checkpoints
+NC_CHECKPOINT_FILES = 100
+
+#: Convert IPW byteorder header value to numpy byte order character
+BYTEORDER_DICT = \
     {
-        1: 'B',
-        2: 'H',
-        4: 'I'
+        '0123': '<',
+        '3210': '>'
     }
 
 
@@ -120,7 +180,9 @@ def isnobal(nc_in=None, nc_out_fname=None, data_tstep=60, nsteps=8758,
             mask_file="data/tl2p5mask.ipw", input_prefix="data/inputs/in",
             output_frequency=1, em_prefix="data/outputs/em",
             snow_prefix="data/outputs/snow", dt='hours', year=2010,
-            month=10, day='01', event_emitter=None, **kwargs):
+            month=10, day='01', event_emitter=None, tiles=1,
+            segment_steps=None, scratch_dir=None, crop=False,
+            pipeline=False, **kwargs):
     """ Wrapper for running the ISNOBAL
         (http://cgiss.boisestate.edu/~hpm/software/IPW/man1/isnobal.html)
         model.
@@ -129,6 +191,24 @@ def isnobal(nc_in=None, nc_out_fname=None, data_tstep=60, nsteps=8758,
             nc_in (netCDF4.Dataset) Input NetCDF4 dataset. See
                 AssertISNOBALInput for requirements.
             nc_out_fname (str) Name of NetCDF file to write to, if desired
+            tiles (int) With `nc_in`, split the domain into this many strips
+                of lines with about equal numbers of unmasked pixels and run
+                one isnobal process per strip concurrently; the outputs are
+                mosaicked into one NetCDF. iSNOBAL computes each pixel on its
+                own, so the result is that of a single run.
+            segment_steps (int) With `nc_in`, run the model this many time
+                steps at a time, each segment starting from the snow state
+                at the end of the last; see _isnobal_segmented. Requires
+                `nc_out_fname`. A multiple of the output frequency.
+            scratch_dir (str) With `nc_in`, directory to stage the IPW files
+                of the run in, each run in a new temporary directory of its
+                own; defaults to the system's temporary directory
+            crop (bool) With `nc_in`, stage and run only the bounding box
+                of the unmasked pixels, tiled if `tiles` > 1, and pad the
+                outputs back onto the whole grid with zeros
+            pipeline (bool) With `nc_in`, put each output time step into
+                the NetCDF as soon as isnobal has written it, while the
+                model runs; see _isnobal_pipelined
 
             For explanations the rest, see the link above.
 
@@ -140,26 +220,13 @@ def isnobal(nc_in=None, nc_out_fname=None, data_tstep=60, nsteps=8758,
     """
     if not nc_in:
 
-        isnobalcmd = " ".join(["isnobal",
-                               "-t " + str(data_tstep),
-                               "-n " + str(nsteps),
-                               "-I " + init_img,
-                               "-p " + precip_file,
-                               "-m " + mask_file,
-                               "-i " + input_prefix,
-                               "-O " + str(output_frequency),
-                               "-e " + em_prefix,
-                               "-s " + snow_prefix])
-
-        # TODO sanitize this isnobalcmd or better yet, avoid shell=True
+        cmd = _isnobal_command(data_tstep, nsteps, init_img, precip_file,
+                               mask_file, input_prefix, output_frequency,
+                               em_prefix, snow_prefix)
+
         logging.debug('Running isnobal')
-        kwargs['event_name'] = 'running_isonbal'
-        kwargs['event_description'] = 'Running the ISNOBAL model'
-        kwargs['progress_value'] = 50
-        if event_emitter:
-            event_emitter.emit('progress', **kwargs)
-        output = subprocess.check_output(isnobalcmd, shell=True)
-        logging.debug("ISNOBAL process output: " + output)
+        progress = _ProgressReporter(event_emitter, nsteps, **kwargs)
+        _run_isnobal_process(cmd, em_prefix, progress)
         logging.debug('done runinig isnobal')
         kwargs['event_name'] = 'running_isonbal'
         kwargs['event_description'] = 'Done Running model'
@@ -173,7 +240,8 @@ def isnobal(nc_in=None, nc_out_fname=None, data_tstep=60, nsteps=8758,
                                  data_tstep=data_tstep,
                                  output_frequency=output_frequency, dt=dt,
                                  year=year, month=month, day=day,
-                                 event_emitter=event_emitter, **kwargs)
+                                 event_emitter=event_emitter,
+                                 ipw_index=False, **kwargs)
 
         return nc_out
 
@@ -181,14 +249,41 @@ def isnobal(nc_in=None, nc_out_fname=None, data_tstep=60, nsteps=8758,
 
         AssertISNOBALInput(nc_in)
 
+        if segment_steps and (tiles > 1 or crop):
+            raise ISNOBALNetcdfError("segmented runs can not be tiled or "
+                                     "cropped")
+
+        if pipeline and (segment_steps or tiles > 1 or crop):
+            raise ISNOBALNetcdfError("pipelined runs can not be segmented, "
+                                     "tiled or cropped")
+
+        if pipeline:
+            return _isnobal_pipelined(nc_in, nc_out_fname, dt=dt, year=year,
+                                      month=month, day=day,
+                                      event_emitter=event_emitter,
+                                      scratch_dir=scratch_dir, **kwargs)
+
+        if segment_steps:
+            return _isnobal_segmented(nc_in, nc_out_fname, segment_steps,
+                                      dt=dt, year=year, month=month, day=day,
+                                      event_emitter=event_emitter,
+                                      scratch_dir=scratch_dir, **kwargs)
+
+        if tiles > 1 or crop:
+            return _isnobal_tiled(nc_in, nc_out_fname, tiles, dt=dt,
+                                  year=year, month=month, day=day,
+                                  event_emitter=event_emitter,
+                                  scratch_dir=scratch_dir, crop=crop,
+                                  **kwargs)
+
         # these are guaranteed to be present by the above assertion
         data_tstep = nc_in.data_tstep
         nsteps = nc_in.nsteps - 1  # isnobal steps are from one step to another
         output_frequency = nc_in.output_frequency
 
-        # create standard IPW data in tmpdir; creates tmpdir
-        tmpdir = '/tmp/isnobalrun' + \
-            str(datetime.datetime.now()).replace(' ', '')
+        # create standard IPW data in a directory unique to this run, so
+        # concurrent runs can't collide
+        tmpdir = tempfile.mkdtemp(prefix='isnobalrun', dir=scratch_dir)
 
         nc_to_standard_ipw(nc_in, tmpdir,event_emitter=event_emitter,**kwargs)
 
@@ -215,30 +310,776 @@ def isnobal(nc_in=None, nc_out_fname=None, data_tstep=60, nsteps=8758,
         return nc_out
 
 
+def _isnobal_command(data_tstep, nsteps, init_img, precip_file, mask_file,
+                     input_prefix, output_frequency, em_prefix, snow_prefix):
+    """Arguments of the isnobal command line for a standard run
+
+        Returns:
+            (list) the program and its arguments
+    """
+    return ["isnobal",
+            "-t", str(data_tstep),
+            "-n", str(nsteps),
+            "-I", init_img,
+            "-p", precip_file,
+            "-m", mask_file,
+            "-i", input_prefix,
+            "-O", str(output_frequency),
+            "-e", em_prefix,
+            "-s", snow_prefix]
+
+
+def _run_isnobal_process(cmd, em_prefix, progress, offset=0):
+    """Run an isnobal command line without a shell. Its output is read as
+       it is written and logged line by line, and its progress is reported
+       from the em files it writes (see _steps_done).
+
+        Arguments:
+            cmd (list): isnobal command line, from _isnobal_command
+            em_prefix (str): prefix of the em files of the run
+            progress (_ProgressReporter): reporter of the run
+            offset (int): time steps of the run done before this command
+
+        Returns:
+            (str) the output of isnobal
+
+        Raises:
+            subprocess.CalledProcessError if isnobal fails; its output is
+            the last OUTPUT_LINES_KEPT lines
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    try:
+        reader = _OutputReader(proc.stdout)
+        reader.start()
+
+        progress.update(offset, force=True)
+        while proc.poll() is None:
+            time.sleep(OUTPUT_POLL_SECONDS)
+            progress.update(offset + _steps_done(em_prefix))
+
+        reader.join()
+        progress.update(offset + _steps_done(em_prefix), force=True)
+
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, " ".join(cmd),
+                                            reader.output())
+
+    return reader.output()
+
+
+def _steps_done(em_prefix):
+    """Number of time steps an isnobal run has got through, from the last
+       of the em files it has started to write; these are numbered by time
+       step
+
+        Returns:
+            (int)
+    """
+    outputs_dir, name = dirname(em_prefix) or '.', basename(em_prefix)
+
+    tsteps = [int(f[len(name) + 1:]) for f in listdir(outputs_dir)
+              if f.startswith(name + '.') and f[len(name) + 1:].isdigit()]
+
+    return max(tsteps) + 1 if tsteps else 0
+
+
+class _OutputReader(threading.Thread):
+    """Read the output of a process line by line as it is written, logging
+       each line, so a long run neither fills its pipe nor keeps all of its
+       output in memory. The last OUTPUT_LINES_KEPT lines are kept.
+    """
+    def __init__(self, stream):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stream = stream
+        self.lines = deque(maxlen=OUTPUT_LINES_KEPT)
+
+    def run(self):
+        for line in iter(self.stream.readline, ''):
+            logging.debug('isnobal: ' + line.rstrip())
+            self.lines.append(line)
+        self.stream.close()
+
+    def output(self):
+        return ''.join(self.lines)
+
+
+class _ProgressReporter(object):
+    """Emit progress events of an isnobal run with its throughput and
+       estimated time left, at most one every `interval` seconds
+
+       Events are 'running_isonbal' progress events, as before, with more
+       keyword arguments: tsteps_done, tsteps_per_second and eta_seconds
+       (None until there is a throughput).
+    """
+    def __init__(self, event_emitter, nsteps,
+                 interval=PROGRESS_INTERVAL_SECONDS, **kwargs):
+        """
+        Arguments:
+            event_emitter: pyee event emitter, or None to report nothing
+            nsteps (int): number of time steps of the run
+            interval (float): least time between events, in seconds
+            kwargs: passed on with each event
+        """
+        self.event_emitter = event_emitter
+        self.nsteps = nsteps
+        self.interval = interval
+        self.kwargs = kwargs
+
+        self.first = None
+        self.done = None
+        self.emitted_at = None
+
+    def update(self, done, force=False):
+        """Report that `done` time steps of the run are through, if it is
+           news and the interval has passed, or with `force`
+        """
+        now = time.time()
+        if self.first is None:
+            self.first = (now, done)
+
+        if not force and (done == self.done or
+                          (self.emitted_at is not None and
+                           now - self.emitted_at < self.interval)):
+            return
+
+        self.done = done
+        self.emitted_at = now
+
+        if not self.event_emitter:
+            return
+
+        start_time, start_done = self.first
+        elapsed = now - start_time
+        rate = (done - start_done)/elapsed if elapsed > 0 else 0.0
+
+        kwargs = dict(self.kwargs)
+        kwargs['event_name'] = 'running_isonbal'
+        kwargs['event_description'] = \
+            'Running the ISNOBAL model: time step %d of %d' % (done,
+                                                               self.nsteps)
+        kwargs['progress_value'] = \
+            format((float(done)/max(self.nsteps, 1)) * 100, '.2f')
+        kwargs['tsteps_done'] = done
+        kwargs['tsteps_per_second'] = rate
+        kwargs['eta_seconds'] = \
+            (self.nsteps - done)/rate if rate > 0 else None
+
+        self.event_emitter.emit('progress', **kwargs)
+
+
+def _isnobal_tiled(nc_in, nc_out_fname, tiles, dt='hours', year=2010,
+                   month=10, day='01', event_emitter=None, scratch_dir=None,
+                   crop=False, **kwargs):
+    """Run isnobal on the input NetCDF `nc_in` as concurrent processes
+       over strips of its domain (see _tile_windows), each staged into a
+       scratch directory of its own, and mosaic their outputs into one
+       NetCDF. The time steps with precip are found once for all strips,
+       which are staged by up to `workers` processes at once (see
+       _stage_tiles); a strip's process starts as soon as its inputs are
+       staged. With `crop`, the strips split only the bounding box of the
+       unmasked pixels (see _mask_window).
+
+        Returns:
+            (netCDF4.Dataset) NetCDF Dataset object of the outputs
+    """
+    data_tstep = nc_in.data_tstep
+    nsteps = nc_in.nsteps - 1
+    output_frequency = nc_in.output_frequency
+
+    mask = nc_in.variables['mask'][:]
+    nlines, nsamps = mask.shape
+
+    if crop:
+        lines, samps = _mask_window(mask)
+    else:
+        lines, samps = slice(0, nlines), slice(0, nsamps)
+
+    windows = [(slice(lines.start + w.start, lines.start + w.stop), samps)
+               for w, _ in _tile_windows(mask[lines, samps], tiles)]
+
+    precip_tsteps = _read_precip_tsteps(nc_in)
+    if precip_tsteps is None:
+        precip_tsteps = list(_iter_precip_tsteps(nc_in))
+
+    tile_dirs = []
+    procs = []
+    try:
+        for window in windows:
+            tile_dirs.append(tempfile.mkdtemp(prefix='isnobaltile',
+                                              dir=scratch_dir))
+
+        for tile_idx in _stage_tiles(nc_in, tile_dirs, windows,
+                                     precip_tsteps, event_emitter, **kwargs):
+
+            tile_dir, window = tile_dirs[tile_idx], windows[tile_idx]
+            mkdir(osjoin(tile_dir, 'outputs'))
+
+            cmd = _isnobal_command(data_tstep, nsteps,
+                                   osjoin(tile_dir, 'init.ipw'),
+                                   osjoin(tile_dir, 'ppt_desc'),
+                                   osjoin(tile_dir, 'mask.ipw'),
+                                   osjoin(tile_dir, 'inputs/in'),
+                                   output_frequency,
+                                   osjoin(tile_dir, 'outputs/em'),
+                                   osjoin(tile_dir, 'outputs/snow'))
+
+            logging.debug('Running isnobal on lines %d to %d' %
+                          (window[0].start, window[0].stop))
+
+            log_path = osjoin(tile_dir, 'isnobal.log')
+            with open(log_path, 'w') as log:
+                proc = subprocess.Popen(cmd, stdout=log,
+                                        stderr=subprocess.STDOUT)
+            procs.append((proc, cmd, log_path))
+
+        # the slowest strip tells the progress of the run
+        progress = _ProgressReporter(event_emitter, nsteps, **kwargs)
+        progress.update(0, force=True)
+
+        codes = [None]
+        while None in codes and not any(codes):
+            time.sleep(OUTPUT_POLL_SECONDS)
+            codes = [proc.poll() for proc, _, _ in procs]
+            progress.update(min(_steps_done(osjoin(d, 'outputs/em'))
+                                for d in tile_dirs))
+
+        for proc, cmd, log_path in procs:
+            if proc.returncode:
+                with open(log_path, 'r') as log:
+                    raise subprocess.CalledProcessError(
+                        proc.returncode, " ".join(cmd), log.read())
+
+        kwargs['event_name'] = 'running_isonbal'
+        kwargs['event_description'] = 'Done Running model'
+        kwargs['progress_value'] = 100
+        if event_emitter:
+            event_emitter.emit('progress', **kwargs)
+
+        return _generate_mosaic_nc([osjoin(d, 'outputs') for d in tile_dirs],
+                                   nc_out_fname, data_tstep=data_tstep,
+                                   output_frequency=output_frequency, dt=dt,
+                                   year=year, month=month, day=day,
+                                   event_emitter=event_emitter,
+                                   windows=windows, grid_shape=mask.shape,
+                                   **kwargs)
+
+    finally:
+        for proc, _, _ in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+        for tile_dir in tile_dirs:
+            rmtree(tile_dir, ignore_errors=True)
+
+
+def _stage_tiles(nc_in, tile_dirs, windows, precip_tsteps, event_emitter=None,
+                 workers=1, **kwargs):
+    """Stage the strips `windows` of `nc_in` into `tile_dirs` with
+       nc_to_standard_ipw, given its time steps with precip. With more than
+       one of `workers`, the strips are staged at once by as many processes,
+       each writing the files of its strips through its own handle on the
+       file of `nc_in`.
+
+        Yields:
+            (int) index of each strip once it is staged
+    """
+    if workers <= 1:
+        for tile_idx, (tile_dir, window) in enumerate(zip(tile_dirs,
+                                                          windows)):
+            nc_to_standard_ipw(nc_in, tile_dir, window=window,
+                               precip_tsteps=precip_tsteps,
+                               event_emitter=event_emitter, **kwargs)
+            yield tile_idx
+        return
+
+    nc_path = nc_in.filepath()
+
+    # workers closing their copy of nc_in must have nothing left to flush
+    nc_in.sync()
+
+    pool = multiprocessing.Pool(min(workers, len(windows)), _close_datasets,
+                                ([nc_in],))
+    try:
+        n_done = 0
+        for tile_idx in pool.imap_unordered(
+                _stage_tile_in_worker,
+                [(tile_idx, nc_path, tile_dir, window, precip_tsteps)
+                 for tile_idx, (tile_dir, window)
+                 in enumerate(zip(tile_dirs, windows))]):
+
+            n_done += 1
+            kwargs['event_name'] = 'processing_input'
+            kwargs['event_description'] = 'creating input ipw files of ' \
+                'each strip from the input netcdf file'
+            kwargs['progress_value'] = format(
+                (float(n_done)/len(windows)) * 100, '.2f')
+            if event_emitter:
+                event_emitter.emit('progress', **kwargs)
+
+            yield tile_idx
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _stage_tile_in_worker(args):
+    """Stage one strip in a worker process of _stage_tiles
+
+        Args:
+            args (tuple): index of the strip, path of the input NetCDF, and
+                the staging directory, window and precip time steps
+
+        Returns:
+            (int) index of the strip
+    """
+    tile_idx, nc_path, tile_dir, window, precip_tsteps = args
+
+    nc_in = Dataset(nc_path, 'r')
+    try:
+        nc_to_standard_ipw(nc_in, tile_dir, window=window,
+                           precip_tsteps=precip_tsteps)
+    finally:
+        nc_in.close()
+
+    return tile_idx
+
+
+def _isnobal_pipelined(nc_in, nc_out_fname, dt='hours', year=2010,
+                       month=10, day='01', event_emitter=None,
+                       latlon_cache_dir=None, buffer_memory=NC_BUFFER_MEMORY,
+                       storage_profile=DEFAULT_STORAGE_PROFILE,
+                       scratch_dir=None, **kwargs):
+    """Run isnobal on the input NetCDF `nc_in`, putting its outputs into
+       the output NetCDF while it runs. Each em and snow file is decoded
+       and inserted once it is complete (see _completed_outputs) and then
+       removed, so converting the outputs mostly overlaps the model run.
+
+       All inputs are staged before isnobal starts: it fails on the first
+       input it finds missing rather than waiting for it, and what it reads
+       can't be known ahead of its outputs.
+
+        Returns:
+            (netCDF4.Dataset) NetCDF Dataset object of the outputs
+    """
+    data_tstep = nc_in.data_tstep
+    nsteps = nc_in.nsteps - 1
+    output_frequency = nc_in.output_frequency
+
+    run_dir = tempfile.mkdtemp(prefix='isnobalrun', dir=scratch_dir)
+    proc = None
+    try:
+        nc_to_standard_ipw(nc_in, run_dir, event_emitter=event_emitter,
+                           **kwargs)
+
+        outputs_dir = osjoin(run_dir, 'outputs')
+        mkdir(outputs_dir)
+
+        cmd = _isnobal_command(data_tstep, nsteps,
+                               osjoin(run_dir, 'init.ipw'),
+                               osjoin(run_dir, 'ppt_desc'),
+                               osjoin(run_dir, 'mask.ipw'),
+                               osjoin(run_dir, 'inputs/in'),
+                               output_frequency,
+                               osjoin(outputs_dir, 'em'),
+                               osjoin(outputs_dir, 'snow'))
+
+        # geometry as generate_standard_nc gets it from the headers of the
+        # outputs, which isnobal copies from the init image
+        template_args = dict(bline=float(nc_in.bline - nc_in.dline/2.0),
+                             bsamp=float(nc_in.bsamp - nc_in.dsamp/2.0),
+                             dline=float(nc_in.dline),
+                             dsamp=float(nc_in.dsamp),
+                             nsamps=len(nc_in.dimensions['easting']),
+                             nlines=len(nc_in.dimensions['northing']),
+                             data_tstep=data_tstep, nsteps=nsteps,
+                             output_frequency=output_frequency, dt=dt,
+                             year=year, month=month, day=day)
+
+        nc = ncgen_from_template('ipw_out_template.cdl', nc_out_fname,
+                                 clobber=True,
+                                 storage_profile=storage_profile,
+                                 **template_args)
+
+        buf = _TimeStepBuffer(nc, buffer_memory)
+
+        logging.debug('Running isnobal')
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        reader = _OutputReader(proc.stdout)
+        reader.start()
+
+        progress = _ProgressReporter(event_emitter, nsteps, **kwargs)
+        progress.update(0, force=True)
+
+        for path, file_type, tstep in _completed_outputs(outputs_dir, proc):
+
+            ipw = IPW(path, file_type=file_type)
+            _nc_insert_grids(nc, file_type, _ipw_grids(ipw), tstep, buf)
+            remove(path)
+
+            progress.update(tstep + 1)
+
+        reader.join()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(
+                proc.returncode, " ".join(cmd), reader.output())
+
+        kwargs['event_name'] = 'running_isonbal'
+        kwargs['event_description'] = 'Done Running model'
+        kwargs['progress_value'] = 100
+        if event_emitter:
+            event_emitter.emit('progress', **kwargs)
+
+        buf.flush()
+
+        _finish_standard_nc(nc, data_tstep, latlon_cache_dir)
+
+        return nc
+
+    finally:
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+        rmtree(run_dir, ignore_errors=True)
+
+
+def _completed_outputs(outputs_dir, proc, poll_seconds=OUTPUT_POLL_SECONDS):
+    """Watch the outputs directory of a running isnobal process for em and
+       snow files that are complete, as told by their size and header (see
+       _ipw_file_complete), until the process exits. Files are yielded in
+       time step order and must be removed or moved by the consumer before
+       it asks for the next one, or they are yielded again.
+
+        Args:
+            outputs_dir (str): directory isnobal writes em and snow files to
+            proc (subprocess.Popen): the isnobal process
+            poll_seconds (float): time between looks at the directory when
+                no new file is complete
+
+        Yields:
+            (tuple) path, file type and time step of each file
+    """
+    while True:
+        # look after polling, so no file written before the exit is missed
+        running = proc.poll() is None
+
+        complete = []
+        for name in listdir(outputs_dir):
+            file_type, _, tstep = name.partition('.')
+            if file_type not in ('em', 'snow') or not tstep.isdigit():
+                continue
+
+            path = osjoin(outputs_dir, name)
+            if _ipw_file_complete(path, file_type):
+                complete.append((int(tstep), file_type, path))
+
+        for tstep, file_type, path in sorted(complete):
+            yield path, file_type, tstep
+
+        if not running:
+            return
+
+        if not complete:
+            time.sleep(poll_seconds)
+
+
+def _isnobal_segmented(nc_in, nc_out_fname, segment_steps, dt='hours',
+                       year=2010, month=10, day='01', event_emitter=None,
+                       workers=1, latlon_cache_dir=None,
+                       buffer_memory=NC_BUFFER_MEMORY,
+                       storage_profile=DEFAULT_STORAGE_PROFILE,
+                       scratch_dir=None, **kwargs):
+    """Run isnobal on the input NetCDF `nc_in` in consecutive segments of
+       `segment_steps` time steps. Each segment is staged on its own, with
+       files numbered from 0, and runs from an init image whose snow state
+       is the last snow output of the segment before (see
+       _write_restart_init). Its outputs are appended to `nc_out_fname`,
+       which is synced after each segment so finished segments can be
+       post-processed while later ones run.
+
+       Completed segments are kept in a journal next to `nc_out_fname`, as
+       for generate_standard_nc(resume=True); running the same segmented
+       run again, on the same unmodified input file, continues after the
+       last completed segment. Each segment's restart init is kept next to
+       `nc_out_fname` with the suffix RESTART_INIT_SUFFIX and the segment
+       number, and journaled along with the segment.
+
+        Returns:
+            (netCDF4.Dataset) NetCDF Dataset object of the outputs
+    """
+    if nc_out_fname is None:
+        raise ISNOBALNetcdfError("segmented runs require nc_out_fname")
+
+    # plain numbers for the journal, not numpy scalars
+    data_tstep = int(nc_in.data_tstep)
+    nsteps = int(nc_in.nsteps) - 1
+    output_frequency = int(nc_in.output_frequency)
+
+    if segment_steps % output_frequency:
+        raise ISNOBALNetcdfError(
+            "segment_steps must be a multiple of the output frequency %d "
+            "for a snow state to be written at the end of each segment" %
+            output_frequency)
+
+    segments = [(start, min(start + segment_steps, nsteps))
+                for start in range(0, nsteps, segment_steps)]
+
+    # geometry as generate_standard_nc gets it from the headers of the
+    # outputs, which isnobal copies from the init image
+    template_args = dict(bline=float(nc_in.bline - nc_in.dline/2.0),
+                         bsamp=float(nc_in.bsamp - nc_in.dsamp/2.0),
+                         dline=float(nc_in.dline), dsamp=float(nc_in.dsamp),
+                         nsamps=len(nc_in.dimensions['easting']),
+                         nlines=len(nc_in.dimensions['northing']),
+                         data_tstep=data_tstep, nsteps=nsteps,
+                         output_frequency=output_frequency, dt=dt,
+                         year=year, month=month, day=day)
+
+    # a regenerated or modified input must not resume the old one's run
+    in_stat = stat(nc_in.filepath())
+    nc, journal = _open_nc_for_conversion(
+        'ipw_out_template.cdl', nc_out_fname, True, storage_profile,
+        template_args, build=dict(nc_in=nc_in.filepath(),
+                                  nc_in_size=in_stat.st_size,
+                                  nc_in_mtime=in_stat.st_mtime,
+                                  segment_steps=segment_steps))
+
+    buf = _TimeStepBuffer(nc, buffer_memory)
+
+    restart_path = nc_out_fname + RESTART_INIT_SUFFIX + '.%d'
+
+    progress = _ProgressReporter(event_emitter, nsteps, **kwargs)
+
+    for i, (start, stop) in enumerate(segments):
+
+        segment = 'segment.%d' % i
+        if segment in journal:
+            continue
+
+        run_dir = tempfile.mkdtemp(prefix='isnobalsegment', dir=scratch_dir)
+        try:
+            # isnobal steps from one input to the next, so segments share
+            # their boundary inputs
+            nc_to_standard_ipw(nc_in, run_dir, time_range=(start, stop + 1),
+                               event_emitter=event_emitter, workers=workers,
+                               **kwargs)
+
+            init_path = osjoin(run_dir, 'init.ipw')
+            if i > 0:
+                # segments are journaled in order, with their restarts
+                init_path = restart_path % (i - 1)
+                if basename(init_path) not in journal or \
+                        not exists(init_path):
+                    raise ISNOBALNetcdfError(
+                        "restart init %s of segment %d is missing; "
+                        "remove %s to run from the start" %
+                        (init_path, i - 1, journal.path))
+
+            mkdir(osjoin(run_dir, 'outputs'))
+
+            cmd = _isnobal_command(data_tstep, stop - start, init_path,
+                                   osjoin(run_dir, 'ppt_desc'),
+                                   osjoin(run_dir, 'mask.ipw'),
+                                   osjoin(run_dir, 'inputs/in'),
+                                   output_frequency,
+                                   osjoin(run_dir, 'outputs/em'),
+                                   osjoin(run_dir, 'outputs/snow'))
+
+            logging.debug('Running isnobal on time steps %d to %d' %
+                          (start, stop))
+            _run_isnobal_process(cmd, osjoin(run_dir, 'outputs/em'),
+                                 progress, offset=start)
+
+            index = IPWIndex(osjoin(run_dir, 'outputs'))
+            inserted = [segment]
+            last_snow = None
+            for f, file_type, grids in \
+                    _iter_ipw_grids(index, index.files(), workers):
+
+                tstep = start + int(basename(f).split('.')[-1])
+                _nc_insert_grids(nc, file_type, grids, tstep, buf)
+
+                inserted.append('%s.%d' % (file_type, tstep))
+                # files come in time step order
+                if file_type == 'snow':
+                    last_snow = f
+
+            buf.flush()
+            nc.sync()
+
+            # from the snow output as isnobal wrote it, before it is removed
+            if i + 1 < len(segments):
+                if last_snow is None:
+                    raise ISNOBALNetcdfError(
+                        "isnobal wrote no snow output in time steps %d to "
+                        "%d to restart from" % (start, stop))
+
+                _write_restart_init(nc_in, index.open(last_snow),
+                                    restart_path % i)
+                inserted.append(basename(restart_path % i))
+
+            journal.record(inserted)
+
+            if i > 0 and exists(restart_path % (i - 1)):
+                remove(restart_path % (i - 1))
+
+        finally:
+            rmtree(run_dir, ignore_errors=True)
+
+        kwargs['event_name'] = 'running_isnobal_segment'
+        kwargs['event_description'] = \
+            'Done running time steps %d to %d' % (start, stop)
+        kwargs['progress_value'] = \
+            format((float(i + 1)/len(segments)) * 100, '.2f')
+        if event_emitter:
+            event_emitter.emit('progress', **kwargs)
+
+    _finish_standard_nc(nc, data_tstep, latlon_cache_dir)
+
+    journal.remove()
+    for i in range(len(segments)):
+        if exists(restart_path % i):
+            remove(restart_path % i)
+
+    return nc
+
+
+def _write_restart_init(nc_in, snow, path):
+    """Write an init image to restart isnobal from the snow state of the
+       snow output `snow`. It has all eight bands of a two-layer init: the
+       snow bands come from `snow` and the others, elevation and roughness
+       length, from the init of the input NetCDF `nc_in`.
+
+        Args:
+            nc_in (netCDF4.Dataset): input NetCDF of the run
+            snow (IPW): snow output of the time step to restart from
+            path (str): path of the init image to write
+    """
+    init = IPW.from_nc(nc_in, file_type='init')
+
+    restart = copy(init)
+    restart.file_type = 'restart'
+
+    header_dict = OrderedDict()
+    band_data = OrderedDict()
+    for idx, varname in enumerate(VARNAME_BY_FILETYPE['restart']):
+        source = snow if varname in VARNAME_BY_FILETYPE['snow'] else init
+
+        band = copy(source.header_dict[varname])
+        band.band_idx = idx
+        header_dict[varname] = band
+        band_data[varname] = source[varname]
+
+    restart.nonglobal_bands = header_dict.values()
+
+    header_dict['global'] = \
+        init.header_dict['global']._replace(nBands=len(band_data))
+
+    restart.header_dict = header_dict
+    restart.bands = header_dict.values()
+    restart._data_frame = None
+    restart._band_data = band_data
+
+    restart.recalculate_header()
+    restart.write(path)
+
+
+def _mask_window(mask):
+    """Bounding box of the unmasked (nonzero) pixels of `mask`; the whole
+       grid if there are none
+
+        Returns:
+            (tuple) (lines, samps) window slices
+    """
+    unmasked = _fill_masked(mask, 0) != 0
+    lines = nonzero(unmasked.any(axis=1))[0]
+    samps = nonzero(unmasked.any(axis=0))[0]
+
+    if not len(lines):
+        return slice(0, mask.shape[0]), slice(0, mask.shape[1])
+
+    return (slice(lines[0], lines[-1] + 1), slice(samps[0], samps[-1] + 1))
+
+
+def _tile_windows(mask, ntiles):
+    """Split a grid into at most `ntiles` strips of whole lines with about
+       equal numbers of unmasked (nonzero) pixels of `mask`, so concurrent
+       isnobal runs over the strips take about as long. Strips of lines are
+       contiguous in both the NetCDF and IPW files.
+
+        Args:
+            mask (array): (nlines, nsamps) mask of the grid
+            ntiles (int): number of strips wanted
+
+        Returns:
+            (list) (lines, samps) window slices of the strips, in line order
+    """
+    mask = _fill_masked(mask, 0)
+    nlines, nsamps = mask.shape
+    ntiles = max(1, min(ntiles, nlines))
+
+    # every line weighs a little, so lines with no unmasked pixels split
+    # evenly too; integer weights keep the cumulative sums exact
+    weights = (mask != 0).sum(axis=1)*(nlines + 1) + 1
+    cum = cumsum(weights)
+    cuts = searchsorted(cum, cum[-1]*arange(1, ntiles)/float(ntiles)) + 1
+
+    edges = [0]
+    for cut in cuts:
+        # leave at least one line for each of the remaining strips
+        edges.append(min(max(int(cut), edges[-1] + 1),
+                         nlines - (ntiles - len(edges))))
+    edges.append(nlines)
+
+    return [(slice(l0, l1), slice(0, nsamps))
+            for l0, l1 in zip(edges[:-1], edges[1:])]
+
+
 class IPW(object):
     """
-    Represents an IPW file. Provides a data_frame attribute to access the
-    variables and their floating point representation as a dataframe. The
-    dataframe can be modified, the headers recalculated with
-    recalculateHeaders, and then written back to IPW binary with
-    writeBinary.
+    Represents an IPW file. The floating point data of each band is held as a
+    flat numpy array and accessed by variable name, or as an
+    (nlines, nsamps) grid with `grid`. The data can be modified, the headers
+    recalculated with recalculate_header, and then written back to IPW binary
+    with write.
 
     >>> ipw = IPW("in.0000")
-    >>> ipw.data_frame.T_a = ipw.data_frame.T_a + 1.0 # add 1 dg C to each temp
-    >>> ipw.writeBinary("in.plusOne.000")
+    >>> ipw['T_a'] = ipw['T_a'] + 1.0  # add 1 dg C to each temp
+    >>> ipw.recalculate_header()
+    >>> ipw.write("in.plusOne.000")
+
+    A pandas DataFrame with one column per band is built on demand by
+    data_frame. Once built, the DataFrame holds the data for this IPW so that
+    changes made to it are the ones recalculated and written.
 
+    With `header_only=True` only the header is read. The header_dict,
+    geotransform and time information are available, but the band data is
+    not. Use it to catalogue or validate many files quickly:
+
+    >>> ipw = IPW("em.0134", header_only=True)
+    >>> ipw.header_dict['melt'].float_max
     """
     def __init__(self, input_file=None, config_file=None,
-                 water_year=None, dt=None, file_type=None):
+                 water_year=None, dt=None, file_type=None, header_only=False):
 
         assert dt is None or issubclass(type(dt), datetime.timedelta)
 
         if input_file is not None:
 
-            ipw_lines = IPWLines(input_file)
-            input_split = basename(input_file).split('.')
+            ipw_lines = IPWLines(input_file, header_only=header_only)
 
-            file_type = file_type or input_split[0]
+            file_type = file_type or basename(input_file).split('.')[0]
 
             # _make_bands
             try:
@@ -250,91 +1091,223 @@ class IPW(object):
                 raise IPWFileError("Provide explicit file type for file %s" %
                                    input_file)
 
-            # extract just bands from the header dictionary
-            bands = [band for band in header_dict.values()]
+            self._init_from_header(input_file, file_type, header_dict,
+                                   ipw_lines.binary_data,
+                                   ipw_lines.data_offset, config_file,
+                                   water_year, dt)
+
+        else:
+
+            self._band_data = None
+            self._data_frame = None
+            self.input_file = None
+            self.file_type = None
+            self.header_dict = None
+            self.binary_data = None
+            self.data_offset = None
+            self.bands = None
+            self.nonglobal_bands = None
+            self.geotransform = None
+            self.start_datetime = None
+            self.end_datetime = None
+
+        return None
+
+    def _init_from_header(self, input_file, file_type, header_dict,
+                          binary_data, data_offset, config_file, water_year,
+                          dt):
+        """
+        Set the attributes of an IPW read from `input_file` given its parsed
+        header
+        """
+        input_split = basename(input_file).split('.')
 
-            # get the nonglobal_bands in a list, ordered by band index
-            nonglobal_bands =\
-                sorted([band for varname, band in header_dict.iteritems()
-                        if varname != 'global'],
-                       key=lambda b: b.band_idx)
+        # extract just bands from the header dictionary
+        bands = [band for band in header_dict.values()]
 
-            # the default configuration is used if no config file is given
-            if config_file is None:
-                config_file = \
-                    osjoin(dirname(__file__), '../default.conf')
+        # get the nonglobal_bands in a list, ordered by band index
+        nonglobal_bands =\
+            sorted([band for varname, band in header_dict.iteritems()
+                    if varname != 'global'],
+                   key=lambda b: b.band_idx)
 
+        # the default configuration is used if no config file is given
+        if config_file is None:
+            config_file = \
+                osjoin(dirname(__file__), '../default.conf')
 
-            if file_type in ['in', 'em', 'snow']:
+        if file_type in ['in', 'em', 'snow']:
 
-                # set the water year to default if not given
-                if not water_year:
-                    water_year = 2010
+            # set the water year to default if not given
+            if not water_year:
+                water_year = 2010
 
-                # note that we have not generalized for non-hour timestep data
-                if dt is None:
-                    dt = Timedelta('1 hour')
+            # note that we have not generalized for non-hour timestep data
+            if dt is None:
+                dt = Timedelta('1 hour')
 
-                # the iSNOBAL file naming scheme puts the integer time step
-                # after the dot, really as the extension
-                # TODO as Roger pointed out, really this is for
-                # a single point in time, so this timing thing is not right
-                start_dt = dt * int(input_split[-1])
+            # the iSNOBAL file naming scheme puts the integer time step
+            # after the dot, really as the extension
+            # TODO as Roger pointed out, really this is for
+            # a single point in time, so this timing thing is not right
+            start_dt = dt * int(input_split[-1])
 
-                start_datetime = \
-                    datetime.datetime(water_year, 10, 01) + start_dt
+            start_datetime = \
+                datetime.datetime(water_year, 10, 01) + start_dt
 
-                end_datetime = start_datetime + dt
+            end_datetime = start_datetime + dt
 
-            else:
+        else:
 
-                start_datetime = None
-                end_datetime = None
+            start_datetime = None
+            end_datetime = None
 
-            # initialized when called for below
-            self._data_frame = None
+        # initialized when called for below
+        self._band_data = None
+        self._data_frame = None
 
-            self.input_file = input_file
-            self.file_type = file_type
-            self.header_dict = header_dict
-            self.binary_data = ipw_lines.binary_data
-            self.bands = bands
-            self.nonglobal_bands = nonglobal_bands
+        self.input_file = input_file
+        self.file_type = file_type
+        self.header_dict = header_dict
+        self.binary_data = binary_data
+        self.data_offset = data_offset
+        self.bands = bands
+        self.nonglobal_bands = nonglobal_bands
 
-            # use geo information in band0; all bands have equiv geo info
-            band0 = nonglobal_bands[0]
-            self.geotransform = [band0.bsamp - band0.dsamp / 2.0,
-                                 band0.dsamp,
-                                 0.0,
-                                 band0.bline - band0.dline / 2.0,
-                                 0.0,
-                                 band0.dline]
+        # use geo information in band0; all bands have equiv geo info
+        band0 = nonglobal_bands[0]
+        self.geotransform = [band0.bsamp - band0.dsamp / 2.0,
+                             band0.dsamp,
+                             0.0,
+                             band0.bline - band0.dline / 2.0,
+                             0.0,
+                             band0.dline]
 
-            self.config_file = config_file
+        self.config_file = config_file
 
-            self.start_datetime = start_datetime
-            self.end_datetime = end_datetime
+        self.start_datetime = start_datetime
+        self.end_datetime = end_datetime
 
+    @classmethod
+    def from_header(cls, input_file, header_dict, data_offset,
+                    file_type=None, config_file=None, water_year=None,
+                    dt=None, header_only=False):
+        """
+        Open an IPW file whose header has already been parsed, for example
+        by an IPWIndex. The header is not read again; the data is mapped
+        starting at `data_offset`.
+
+        Arguments:
+            input_file (str) path to the IPW file
+            header_dict (dict) header dictionary as made by _make_bands
+            data_offset (int) byte offset of the data in the file
+
+        Returns:
+            (IPW) IPW instance for the file
+        """
+        assert dt is None or issubclass(type(dt), datetime.timedelta)
+
+        file_type = file_type or basename(input_file).split('.')[0]
+
+        if header_only:
+            binary_data = None
         else:
+            binary_data = _map_ipw_data(input_file, data_offset)
 
-            self._data_frame = None
-            self.input_file = None
-            self.file_type = None
-            self.header_dict = None
-            self.binary_data = None
-            self.bands = None
-            self.nonglobal_bands = None
-            self.geotransform = None
-            self.start_datetime = None
-            self.end_datetime = None
+        ipw = cls()
+        ipw._init_from_header(input_file, file_type, header_dict,
+                              binary_data, data_offset, config_file,
+                              water_year, dt)
 
-        return None
+        return ipw
+
+    def __getitem__(self, varname):
+        """
+        Get the floating point data of one band as a flat array
+        """
+        if self._data_frame is not None:
+            return self._data_frame[varname].values
+
+        return self._data()[varname]
+
+    def __setitem__(self, varname, values):
+        """
+        Replace the floating point data of one band
+        """
+        if self._data_frame is not None:
+            self._data_frame[varname] = values
+        else:
+            self._data()[varname] = asarray(values, dtype='float64')
+
+    def __contains__(self, varname):
+        return varname in self._data()
+
+    @property
+    def varnames(self):
+        """
+        Variable names of the bands in band order
+        """
+        return [b.varname for b in
+                sorted(self.nonglobal_bands, key=lambda b: b.band_idx)]
+
+    def grid(self, varname, key=None):
+        """
+        Get the floating point data of one band as an (nlines, nsamps) array.
+        Given `key`, a numpy index into that grid, get just that part of it;
+        if the band hasn't been decoded only that part is dequantized.
+        """
+        global_band = self.header_dict['global']
+        shape = (global_band.nLines, global_band.nSamps)
+
+        if key is None:
+            return reshape(self[varname], shape)
+
+        data = self._data()
+        if isinstance(data, _LazyBands) and not data.is_decoded(varname):
+            return data.window(varname, shape, key)
+
+        return reshape(self[varname], shape)[key]
+
+    def transformed(self, transforms):
+        """
+        Copy of this IPW with `transforms`, a dict of variable name to a
+        function of the band's flat floating point data, applied to those
+        bands and their headers recalculated. The other bands keep their
+        headers and share this IPW's decoded data, so many transformed
+        copies of a file cost one decode.
+
+        >>> warmer = ipw.transformed({'T_a': lambda t: t + 0.5})
+        >>> warmer.write("in.plusHalf.0000")
+        """
+        data = self._data()
+
+        ipw = copy(self)
+        ipw.header_dict = dict((key, copy(band)) for key, band
+                               in self.header_dict.iteritems())
+        ipw.bands = ipw.header_dict.values()
+        ipw.nonglobal_bands = [ipw.header_dict[band.varname]
+                               for band in self.nonglobal_bands]
+
+        ipw._data_frame = None
+        ipw._band_data = OrderedDict(
+            (varname, asarray(transforms[varname](data[varname]),
+                              dtype='float64')
+             if varname in transforms else data[varname])
+            for varname in self.varnames
+        )
+
+        changed = [ipw.header_dict[varname] for varname in transforms]
+        _recalculate_header(changed, dict((band.varname,
+                                           ipw._band_data[band.varname])
+                                          for band in changed))
+
+        return ipw
 
     def recalculate_header(self):
         """
             Recalculate header values
         """
-        _recalculate_header(self.nonglobal_bands, self.data_frame())
+        _recalculate_header(self.nonglobal_bands, self._data())
         for band in self.nonglobal_bands:
             self.header_dict[band.varname] = band
 
@@ -351,7 +1324,7 @@ class IPW(object):
 
     @classmethod
     def from_nc(cls, nc_in, tstep=None, file_type=None, variable=None,
-                distance_units='m', coord_sys_ID='UTM'):
+                distance_units='m', coord_sys_ID='UTM', window=None):
         """
         Generate an IPW object from a NetCDF file.
 
@@ -371,6 +1344,9 @@ class IPW(object):
             distance_units (str) If you use a measure of distance other
                 than meters, put the units here
             coord_sys_ID (str) Coordinate system being used
+            window (tuple) (lines, samps) slices of the grid to convert,
+                e.g. (slice(0, 50), slice(None)) for the first 50 lines;
+                the header's bline and bsamp are those of the window
 
         Returns:
             (IPW) IPW instance built from NetCDF inputs
@@ -401,8 +1377,12 @@ class IPW(object):
         # read header info from nc and generate/assign to new IPW
         # build global dict
         ipw.byteorder = '0123'  # TODO read from file
-        ipw.nlines = len(nc_in.dimensions['northing'])
-        ipw.nsamps = len(nc_in.dimensions['easting'])
+
+        lines, samps = _window_slices(window,
+                                      len(nc_in.dimensions['northing']),
+                                      len(nc_in.dimensions['easting']))
+        ipw.nlines = lines.stop - lines.start
+        ipw.nsamps = samps.stop - samps.start
 
         # if the bands are not part of a group, they are handled individually
         if file_type:
@@ -420,10 +1400,10 @@ class IPW(object):
         bytes_ = NC_NBYTES
         bits_ = NC_NBITS
 
-        bline = nc_in.bline
         dline = nc_in.dline
-        bsamp = nc_in.bsamp
         dsamp = nc_in.dsamp
+        bline = nc_in.bline + lines.start*dline
+        bsamp = nc_in.bsamp + samps.start*dsamp
 
         geo_units = distance_units
         coord_sys_ID = coord_sys_ID
@@ -435,24 +1415,26 @@ class IPW(object):
         header_dict = dict(zip(varnames,
                                [Band() for i in range(len(varnames) + 1)]))
 
-        # create a dataframe with nrows = nlines*nsamps and variable colnames
-        df_shape = (ipw.nlines*ipw.nsamps, len(varnames))
-        df = DataFrame(zeros(df_shape), columns=varnames)
+        # one flat array of nlines*nsamps values per variable
+        band_data = OrderedDict()
         for idx, var in enumerate(varnames):
             header_dict[var] = Band(varname=var, band_idx=idx, nBytes=bytes_,
                 nBits=bits_, int_max=NC_MAXINT, bline=bline, dline=dline,
                 bsamp=bsamp, dsamp=dsamp, units=geo_units,
                 coord_sys_ID=coord_sys_ID)
 
-            # insert data to each df column
             if tstep is not None:
-                data = ravel(nc_vars[var][tstep])
+                data = nc_vars[var][tstep, lines, samps]
             else:
-                data = ravel(nc_vars[var])
+                data = nc_vars[var][lines, samps]
 
-            df[var] = data
+            # masked points are fill values; write them back as such, or
+            # as NaN, which IPW.write stores as the band's minimum
+            band_data[var] = _fill_masked(
+                ravel(data), getattr(nc_vars[var], '_FillValue', nan)
+            )
 
-        ipw._data_frame = df
+        ipw._band_data = band_data
 
         ipw.nonglobal_bands = header_dict.values()
 
@@ -480,26 +1462,67 @@ class IPW(object):
         Get the Pandas DataFrame representation of the IPW file
         """
         if self._data_frame is None:
-            self._data_frame = \
-                _build_ipw_dataframe(self.nonglobal_bands,
-                                     self.binary_data)
+            data = self._data()
+            self._data_frame = DataFrame(
+                OrderedDict((v, data[v]) for v in self.varnames),
+                columns=self.varnames)
+            # the DataFrame now holds the data; don't keep a stale copy
+            self._band_data = None
+
         return self._data_frame
 
+    def _data(self):
+        """
+        Mapping of variable name to flat floating point band data. This is
+        the DataFrame if one has been built, otherwise a mapping that decodes
+        each band from the binary data the first time it is accessed.
+        """
+        if self._data_frame is not None:
+            return self._data_frame
+
+        if self._band_data is None:
+            if self.binary_data is None:
+                raise IPWFileError("No band data: %s was opened header-only"
+                                   % self.input_file)
+
+            self._band_data = \
+                _LazyBands(self.nonglobal_bands, self.binary_data,
+                           self.header_dict['global'].byteorder)
+
+        return self._band_data
+
     def write(self, fileName):
         """
         Write the IPW data to file
         """
         last_line = "!<header> image -1 $Revision: 1.5 $"
 
-        with open(fileName, 'wb') as f:
-            header_lines = _bands_to_header_lines(self.header_dict)
-            for l in header_lines:
-                f.write(l + '\n')
+        data = self._data()
+
+        header_lines = _bands_to_header_lines(self.header_dict)
+        header = "\n".join(header_lines + [last_line]) + "\n"
+
+        # fileName may be the file this IPW's data is mapped from, which
+        # must not be truncated before its bands are decoded: write beside
+        # it and rename over it. The hidden name keeps a file left by a
+        # crash out of the in.*, em.* and snow.* files of a directory
+        fd, tmp_file = tempfile.mkstemp(dir=dirname(fileName) or '.',
+                                        prefix='.' + basename(fileName) + '.')
+        try:
+            with fdopen(fd, 'wb') as f:
+                f.write(header)
 
-            f.write(last_line + '\n')
+                _write_floatdf_binstring_to_file(
+                    self.nonglobal_bands, data, f,
+                    byteorder=self.header_dict['global'].byteorder)
 
-            _write_floatdf_binstring_to_file(
-                self.nonglobal_bands, self._data_frame, f)
+            # mkstemp makes files only their owner can read
+            chmod(tmp_file, 0666 & ~_UMASK)
+            rename(tmp_file, fileName)
+            tmp_file = None
+        finally:
+            if tmp_file is not None:
+                remove(tmp_file)
 
         return None
 
@@ -509,7 +1532,11 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
                          init_file='init.ipw', ppt_desc_path='ppt_desc',
                          data_tstep=60,
                          output_frequency=1, dt='hours', year=2010, month=10,
-                         day='01',hour='',event_emitter=None,**kwargs):
+                         day='01',hour='',event_emitter=None, workers=1,
+                         latlon_cache_dir=None,
+                         buffer_memory=NC_BUFFER_MEMORY,
+                         storage_profile=DEFAULT_STORAGE_PROFILE,
+                         resume=False, ipw_index=True, **kwargs):
     """Use the utilities from netcdf.py to convert standard set of either input
        or output files to a NetCDF4 file. A standard set of files means
 
@@ -527,6 +1554,27 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
         Arguments:
             base_dir (str): base directory of the data
             nc_out (str): path to write data to
+            workers (int): number of processes decoding the time step IPW
+                files; the NetCDF is still written by this process, in time
+                order
+            latlon_cache_dir (str): directory to cache lat/lon grids in, so
+                NetCDFs of the same basin reuse them; see utm2latlon
+            buffer_memory (int): bytes for buffering consecutive time steps
+                to write them as one hyperslab per variable; see
+                _TimeStepBuffer
+            storage_profile (str or dict): chunking and compression of the
+                time-varying variables, one of 'legacy' (the default),
+                'map', 'series' or 'balanced', see netcdf.STORAGE_PROFILES
+            resume (bool): keep a journal of the files whose data is in
+                `nc_out` next to it (NC_JOURNAL_SUFFIX) and, if a journal
+                of an earlier, interrupted conversion of the same files is
+                there, add only the files it lacks to the existing
+                `nc_out`. The journal is removed once the conversion is
+                complete. Requires `nc_out`
+            ipw_index (bool): keep an IPWIndex of the IPW files in the
+                directory converted, as IPW_INDEX_FILENAME there, so later
+                conversions of it only read the headers of files that were
+                added or changed since
 
         Returns:
             (netCDF4.Dataset) Representation of the data
@@ -542,10 +1590,10 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
 
     if ipw_type == 'inputs':
 
-        input_files = [osjoin(base_dir, inputs_dir, el) for el in
-                       listdir(osjoin(base_dir, inputs_dir))]
+        index = _open_ipw_index(osjoin(base_dir, inputs_dir), ipw_index)
+        input_files = index.files('in')
 
-        ipw0 = IPW(input_files[0])
+        ipw0 = index.open(input_files[0], header_only=True)
         gt = ipw0.geotransform
         gb = [x for x in ipw0.bands if type(x) is GlobalBand][0]
 
@@ -559,16 +1607,24 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
                              output_frequency=output_frequency, dt=dt,
                              year=year, month=month, day=day, hour=hour)
 
-        # initialize the nc file
-        nc = ncgen_from_template('ipw_in_template.cdl', nc_out, clobber=True,
-                                 **template_args)
+        # initialize the nc file, or reopen one an earlier run left
+        nc, journal = _open_nc_for_conversion('ipw_in_template.cdl', nc_out,
+                                              resume, storage_profile,
+                                              template_args)
+
+        buf = _TimeStepBuffer(nc, buffer_memory)
 
         # first take care of non-precip files
+        todo = [f for f in input_files
+                if journal is None or basename(f) not in journal]
         with ProgressBar(maxval=len(input_files)) as progress:
-            for i, f in enumerate(input_files):
-                ipw = IPW(f)
-                tstep = int(basename(ipw.input_file).split('.')[-1])
-                _nc_insert_ipw(nc, ipw, tstep, gb.nLines, gb.nSamps)
+            decoded = _checkpointed(_iter_ipw_grids(index, todo, workers),
+                                    lambda d: basename(d[0]),
+                                    nc, buf, journal)
+            n_done = len(input_files) - len(todo)
+            for i, (f, file_type, grids) in enumerate(decoded, n_done):
+                tstep = int(basename(f).split('.')[-1])
+                _nc_insert_grids(nc, file_type, grids, tstep, buf)
 
                 progress.update(i)
 
@@ -609,12 +1665,17 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
                      for ppt_line in
                      open(osjoin(base_dir, ppt_desc_path), 'r').readlines()]
 
+        todo = [p for p in ppt_pairs
+                if journal is None or basename(p[1]) not in journal]
         with ProgressBar(maxval=len(ppt_pairs)) as progress:
-            for i, ppt_pair in enumerate(ppt_pairs):
+            todo_pairs = _checkpointed(todo, lambda p: basename(p[1]),
+                                       nc, buf, journal)
+            n_done = len(ppt_pairs) - len(todo)
+            for i, ppt_pair in enumerate(todo_pairs, n_done):
                 tstep = int(ppt_pair[0])
                 el = IPW(ppt_pair[1], file_type='precip')
 
-                _nc_insert_ipw(nc, el, tstep, gb.nLines, gb.nSamps)
+                _nc_insert_grids(nc, 'precip', _ipw_grids(el), tstep, buf)
 
                 progress.update(i)
                 kwargs['event_name'] = 'input_ipw_to_nc2'
@@ -623,6 +1684,13 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
                 if event_emitter:
                     event_emitter.emit('progress',**kwargs)
 
+            buf.flush()
+
+            precip_tsteps = [int(p[0]) for p in ppt_pairs]
+            _record_precip_tsteps(nc, precip_tsteps)
+            if _NC_READ_PAST_DATA_CRASHES:
+                _pad_precip_variables(nc, precip_tsteps)
+
             kwargs['event_name'] = 'input_ipw_to_nc2'
             kwargs['event_description'] = 'creating nc form iw files 2'
             kwargs['progress_value'] = 100
@@ -630,8 +1698,9 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
                 event_emitter.emit('progress',**kwargs)
     else:
 
-        output_files = [osjoin(base_dir, el) for el in listdir(base_dir)]
-        ipw0 = IPW(output_files[0])
+        index = _open_ipw_index(base_dir, ipw_index)
+        output_files = index.files()
+        ipw0 = index.open(output_files[0], header_only=True)
         gt = ipw0.geotransform
         gb = [x for x in ipw0.bands if type(x) is GlobalBand][0]
 
@@ -643,18 +1712,26 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
                              output_frequency=output_frequency, dt=dt,
                              year=year, month=month, day=day)
 
-        # initialize nc file
-        nc = ncgen_from_template('ipw_out_template.cdl', nc_out, clobber=True,
-                                 **template_args)
+        # initialize nc file, or reopen one an earlier run left
+        nc, journal = _open_nc_for_conversion('ipw_out_template.cdl', nc_out,
+                                              resume, storage_profile,
+                                              template_args)
 
         logging.debug('creating output file')
 
+        buf = _TimeStepBuffer(nc, buffer_memory)
+
+        todo = [f for f in output_files
+                if journal is None or basename(f) not in journal]
         with ProgressBar(maxval=len(output_files)) as progress:
 
-            for i, f in enumerate(output_files):
-                ipw = IPW(f)
-                tstep = int(basename(ipw.input_file).split('.')[-1])
-                _nc_insert_ipw(nc, ipw, tstep, gb.nLines, gb.nSamps)
+            decoded = _checkpointed(_iter_ipw_grids(index, todo, workers),
+                                    lambda d: basename(d[0]),
+                                    nc, buf, journal)
+            n_done = len(output_files) - len(todo)
+            for i, (f, file_type, grids) in enumerate(decoded, n_done):
+                tstep = int(basename(f).split('.')[-1])
+                _nc_insert_grids(nc, file_type, grids, tstep, buf)
 
                 progress.update(i)
 
@@ -663,13 +1740,135 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
                 kwargs['progress_value'] =  format((float(i)/len(output_files)) * 100,'.2f')
                 if event_emitter:
                     event_emitter.emit('progress',**kwargs)
+            buf.flush()
+
             kwargs['event_name'] = 'ouptut_ipw_to_nc'
             kwargs['event_description'] = 'creating output nc file fro moutput ipw'
             kwargs['progress_value'] =  100
             if event_emitter:
                 event_emitter.emit('progress',**kwargs)
     # whether inputs or outputs, we need to include the dimensional values
-    t = nc.variables['time']
+    _finish_standard_nc(nc, data_tstep, latlon_cache_dir)
+
+    if journal is not None:
+        journal.remove()
+
+    return nc
+
+
+def _generate_mosaic_nc(tile_dirs, nc_out=None, data_tstep=60,
+                        output_frequency=1, dt='hours', year=2010, month=10,
+                        day='01', event_emitter=None, workers=1,
+                        latlon_cache_dir=None, buffer_memory=NC_BUFFER_MEMORY,
+                        storage_profile=DEFAULT_STORAGE_PROFILE,
+                        windows=None, grid_shape=None, **kwargs):
+    """Build the output NetCDF of a domain from the outputs/ directories of
+       isnobal runs over parts of it, as generate_standard_nc would from
+       the outputs of one run over the whole domain
+
+        Arguments:
+            tile_dirs (list): output directories of the parts, e.g. from
+                runs staged with the windows of _tile_windows; each has the
+                same em and snow files
+            nc_out (str): path to write data to
+            windows (list): (lines, samps) window of each part in the
+                domain; by default the parts are whole strips in line order
+            grid_shape (tuple): (nlines, nsamps) of the domain, with
+                `windows`. Pixels outside the windows are zero.
+
+        See generate_standard_nc for the other arguments.
+
+        Returns:
+            (netCDF4.Dataset) Representation of the data
+    """
+    indexes = [IPWIndex(d) for d in tile_dirs]
+    tile_files = [index.files() for index in indexes]
+
+    names = [basename(f) for f in tile_files[0]]
+    for tile_dir, files in zip(tile_dirs, tile_files):
+        if [basename(f) for f in files] != names:
+            raise IPWFileError("Outputs in %s do not match those in %s" %
+                               (tile_dir, tile_dirs[0]))
+
+    ipw0 = indexes[0].open(tile_files[0][0], header_only=True)
+    gt = ipw0.geotransform
+
+    if windows is None:
+        nsamps = ipw0.header_dict['global'].nSamps
+        windows = []
+        nlines = 0
+        for index in indexes:
+            tile_nlines = index.entries[names[0]]['global']['nlines']
+            windows.append((slice(nlines, nlines + tile_nlines),
+                            slice(0, nsamps)))
+            nlines += tile_nlines
+    else:
+        nlines, nsamps = grid_shape
+
+    # the domain's origin, from that of the first part
+    bline = gt[3] - windows[0][0].start*gt[5]
+    bsamp = gt[0] - windows[0][1].start*gt[1]
+
+    template_args = dict(bline=bline, bsamp=bsamp, dline=gt[5],
+                         dsamp=gt[1], nsamps=nsamps, nlines=nlines,
+                         data_tstep=data_tstep, nsteps=len(names),
+                         output_frequency=output_frequency, dt=dt,
+                         year=year, month=month, day=day)
+
+    nc = ncgen_from_template('ipw_out_template.cdl', nc_out, clobber=True,
+                             storage_profile=storage_profile,
+                             **template_args)
+
+    buf = _TimeStepBuffer(nc, buffer_memory)
+
+    # the strips' decoding processes share the workers
+    tile_workers = max(1, workers // len(tile_dirs))
+
+    with ProgressBar(maxval=len(names)) as progress:
+
+        decoded = izip(*[_iter_ipw_grids(index, files, tile_workers)
+                         for index, files in zip(indexes, tile_files)])
+
+        for i, tiles in enumerate(decoded):
+            f, file_type, grids = tiles[0]
+            tstep = int(basename(f).split('.')[-1])
+
+            mosaic = OrderedDict()
+            for var in grids:
+                mosaic[var] = zeros((nlines, nsamps))
+                for window, (_, _, tile_grids) in izip(windows, tiles):
+                    mosaic[var][window] = tile_grids[var]
+
+            _nc_insert_grids(nc, file_type, mosaic, tstep, buf)
+
+            progress.update(i)
+
+            kwargs['event_name'] = 'ouptut_ipw_to_nc'
+            kwargs['event_description'] = \
+                'creating output netcdf file from tiled output ipw files'
+            kwargs['progress_value'] = \
+                format((float(i)/len(names)) * 100, '.2f')
+            if event_emitter:
+                event_emitter.emit('progress', **kwargs)
+
+        buf.flush()
+
+    _finish_standard_nc(nc, data_tstep, latlon_cache_dir)
+
+    return nc
+
+
+def _finish_standard_nc(nc, data_tstep, latlon_cache_dir=None):
+    """Write the time, easting, northing, lat and lon values and the
+       time step attributes of a NetCDF built by generate_standard_nc, once
+       all of its time steps are in
+
+        Args:
+            nc (NetCDF4.Dataset): Dataset being built
+            data_tstep (int): data time step attribute
+            latlon_cache_dir (str): see utm2latlon
+    """
+    t = nc.variables['time']
     t[:] = arange(len(t))
 
     e = nc.variables['easting']
@@ -684,7 +1883,8 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
 
     # get a n_points x 2 array of lat/lon pairs at every point on the grid
     latlon_arr = utm2latlon(nc.bsamp, nc.bline, nc.dsamp,
-                            nc.dline, nsamps, nlines)
+                            nc.dline, nsamps, nlines,
+                            cache_dir=latlon_cache_dir)
 
     # break this out into lat and lon separately at each point on the grid
     lat = nc.variables['lat']
@@ -701,8 +1901,6 @@ def generate_standard_nc(base_dir, nc_out=None, inputs_dir='inputs',
 
     nc.sync()
 
-    return nc
-
 
 def _nc_insert_ipw(dataset, ipw, tstep, nlines, nsamps):
     """Put IPW data into dataset based on file naming conventions
@@ -717,60 +1915,340 @@ def _nc_insert_ipw(dataset, ipw, tstep, nlines, nsamps):
         Returns:
             None. `dataset` is populated in-place.
     """
+    _nc_insert_grids(dataset, ipw.file_type, _ipw_grids(ipw), tstep)
+
+
+def _ipw_grids(ipw):
+    """Get the (nlines, nsamps) grids of an IPW to be put in a NetCDF
+
+        Args:
+            ipw (IPW): source data; its file type selects the variables
+
+        Returns:
+            (OrderedDict) grid of each variable of the file type. Input
+            variables absent from `ipw`, like S_n when the sun is down, are
+            zeros.
+    """
     file_type = ipw.file_type
 
-    df = ipw.data_frame()
+    if file_type not in VARNAME_BY_FILETYPE:
+        raise Exception('File type %s not recognized!' % file_type)
+
+    gb = ipw.header_dict['global']
+
+    grids = OrderedDict()
+    for var in VARNAME_BY_FILETYPE[file_type]:
+        # can't just assign b/c if sun is 'down' var is absent from ipw
+        if file_type == 'in' and var not in ipw:
+            grids[var] = zeros((gb.nLines, gb.nSamps))
+        else:
+            grids[var] = ipw.grid(var)
+
+    return grids
 
+
+def _nc_insert_grids(dataset, file_type, grids, tstep, buf=None):
+    """Put the grids of one IPW file into dataset based on its file type
+
+        Args:
+            dataset (NetCDF4.Dataset): Dataset to be populated
+            file_type (str): type of the IPW file the grids came from
+            grids (dict): grid of each variable, as made by _ipw_grids
+            tstep (int): time step of the file; unused for static files
+            buf (_TimeStepBuffer): if given, time step grids go through it
+                and are in `dataset` only once it is flushed
+
+        Returns:
+            None. `dataset` is populated in-place.
+    """
     variables = dataset.variables
 
-    if file_type == 'dem':
-        # dem only has 'alt' information, stored in root group
-        dataset.variables['alt'][:, :] = reshape(df['alt'],
-                                                    (nlines, nsamps))
+    if file_type in ('dem', 'mask', 'init'):
+        # static grids are stored without a time dimension
+        for var, grid in grids.iteritems():
+            variables[var][:, :] = grid
 
-    elif file_type == 'in':
+    elif file_type in ('in', 'precip', 'em', 'snow'):
 
-        for var in VARNAME_BY_FILETYPE['in']:
-            # can't just assign b/c if sun is 'down' var is absent from df
-            if var in df.columns:
-                variables[var][tstep, :, :] = reshape(df[var],
-                                                  (nlines, nsamps))
+        for var, grid in grids.iteritems():
+            if buf is None:
+                variables[var][tstep, :, :] = grid
             else:
-                variables[var][tstep, :, :] = zeros((nlines, nsamps))
+                buf.insert(var, tstep, grid)
 
-    elif file_type == 'precip':
+    else:
+        raise Exception('File type %s not recognized!' % file_type)
 
-        for var in VARNAME_BY_FILETYPE['precip']:
-            variables[var][tstep, :, :] = reshape(df[var], (nlines, nsamps))
 
-    elif file_type == 'mask':
-        # mask is binary and one-banded; store in root group
-        dataset.variables['mask'][:, :] = reshape(df['mask'],
-                                                     (nlines, nsamps))
+class _TimeStepBuffer(object):
+    """Collect consecutive time steps of the (time, northing, easting)
+       variables of a NetCDF and write each run as one hyperslab, instead of
+       one partial chunk write per time step and variable.
 
-    elif file_type == 'init':
+       A variable's run is written when it reaches a multiple of its buffer
+       length, when a non-consecutive time step arrives, or on flush. The
+       buffer length is the most whole time chunks of the variable that fit
+       its share of `memory`, which is shared evenly by all time-varying
+       variables, and at least one: each part of a chunk written on its own
+       would decompress and rewrite the chunk again. Profiles with long
+       time chunks, like 'series', may take more than `memory`.
 
-        for var in VARNAME_BY_FILETYPE['init']:
-            variables[var][:, :] = reshape(df[var], (nlines, nsamps))
+        Args:
+            dataset (NetCDF4.Dataset): Dataset to be populated
+            memory (int): bytes available for buffered grids
+    """
+    def __init__(self, dataset, memory=NC_BUFFER_MEMORY):
+        self.dataset = dataset
+
+        time_vars = [v for v in dataset.variables.values()
+                     if v.dimensions and v.dimensions[0] == 'time' and
+                     v.ndim == 3]
+
+        self.lengths = {}
+        for var in time_vars:
+            var_memory = memory // len(time_vars)
+            grid_bytes = var.shape[1]*var.shape[2]*var.dtype.itemsize
+            n_budget = max(1, var_memory // grid_bytes)
+
+            chunking = var.chunking()
+            if chunking == 'contiguous':
+                self.lengths[var.name] = n_budget
+            else:
+                self.lengths[var.name] = \
+                    chunking[0]*max(1, n_budget // chunking[0])
 
-    elif file_type == 'em':
+        # varname -> [first time step, number buffered, buffer array]
+        self._runs = {}
 
-        for var in VARNAME_BY_FILETYPE['em']:
-            variables[var][tstep, :, :] = reshape(df[var], (nlines, nsamps))
+    def insert(self, varname, tstep, grid):
+        """Buffer `grid` as time step `tstep` of variable `varname`"""
+        run = self._runs.get(varname)
 
-    elif file_type == 'snow':
+        if run is not None and tstep != run[0] + run[1]:
+            self.flush(varname)
+            run = None
 
-        for var in VARNAME_BY_FILETYPE['snow']:
-            variables[var][tstep, :, :] = reshape(df[var], (nlines, nsamps))
+        if run is None:
+            var = self.dataset.variables[varname]
+            length = self.lengths[varname]
+            # end the run at the next multiple of the buffer length
+            n = length - tstep % length
+            run = [tstep, 0, empty((n,) + var.shape[1:], dtype=var.dtype)]
+            self._runs[varname] = run
 
-    # TODO file_type == "em" and "snow" for outputs
+        run[2][run[1]] = grid
+        run[1] += 1
+
+        if run[1] == len(run[2]):
+            self.flush(varname)
+
+    def flush(self, varname=None):
+        """Write the buffered time steps of `varname`, or of all variables"""
+        varnames = self._runs.keys() if varname is None else [varname]
+
+        for name in varnames:
+            t0, n, data = self._runs.pop(name)
+            self.dataset.variables[name][t0:t0 + n, :, :] = data[:n]
+
+
+class _ConversionJournal(object):
+    """Journal of the IPW files whose data generate_standard_nc has durably
+       written to a NetCDF, kept as JSON at `path`, so an interrupted
+       conversion can continue from its last checkpoint.
+
+       `build` describes the NetCDF being built, e.g. its template and
+       template arguments; the journal of a different build is ignored.
+
+        Args:
+            path (str): path of the journal file
+            build (dict): JSON-serializable description of the NetCDF
+    """
+    def __init__(self, path, build):
+        self.path = path
+        # as it will read back from JSON, e.g. with tuples as lists
+        self.build = json.loads(json.dumps(build))
+        self.done = set()
+        self.valid = False
+
+        if exists(path):
+            try:
+                with open(path, 'r') as f:
+                    journal = json.load(f)
+
+                if journal.get('build') == self.build:
+                    self.done = set(journal['done'])
+                    self.valid = True
+
+            except (ValueError, KeyError):
+                logging.debug('Journal %s is corrupt; starting over' % path)
+
+    def __contains__(self, filename):
+        return filename in self.done
+
+    def record(self, filenames):
+        """Add `filenames` to the completed files and write the journal.
+           It is written to a temporary file first and moved into place, so
+           an interruption leaves the old or the new journal."""
+        self.done.update(filenames)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'build': self.build, 'done': sorted(self.done)},
+                      f, separators=(',', ':'))
+
+        rename(tmp_path, self.path)
+        self.valid = True
+
+    def reset(self):
+        """Forget all completed files"""
+        self.done = set()
+        self.record([])
+
+    def remove(self):
+        """Delete the journal file"""
+        if exists(self.path):
+            remove(self.path)
+        self.valid = False
+
+
+def _open_nc_for_conversion(template, nc_out, resume, storage_profile,
+                            template_args, build=None):
+    """Create the NetCDF of generate_standard_nc from `template`, or with
+       `resume` reopen the NetCDF an interrupted conversion left at `nc_out`.
+       `build` adds to what a resumable journal must match, see
+       _ConversionJournal.
+
+        Returns:
+            (tuple) the Dataset and its _ConversionJournal, which is None
+                unless `resume`
+    """
+    if not resume:
+        nc = ncgen_from_template(template, nc_out, clobber=True,
+                                 storage_profile=storage_profile,
+                                 **template_args)
+        return nc, None
+
+    if nc_out is None:
+        raise ISNOBALNetcdfError("resuming a conversion requires nc_out")
+
+    build = dict(build or {}, template=template,
+                 storage_profile=storage_profile, **template_args)
+    journal = _ConversionJournal(nc_out + NC_JOURNAL_SUFFIX, build)
+
+    if journal.valid and exists(nc_out):
+        logging.debug('resuming %s with %d files done' %
+                      (nc_out, len(journal.done)))
+        return Dataset(nc_out, 'a'), journal
+
+    nc = ncgen_from_template(template, nc_out, clobber=True,
+                             storage_profile=storage_profile,
+                             **template_args)
+    journal.reset()
+
+    return nc, journal
+
+
+def _checkpointed(items, key, dataset, buf, journal, every=None):
+    """Yield `items`, and after every `every` of them have been inserted
+       into `dataset` and after the last, flush `buf`, sync `dataset` and
+       record the `key` of the inserted items in `journal`. Without a
+       journal the items are yielded as they are.
+
+        Args:
+            items (iterable): items being inserted, e.g. decoded IPW files
+            key (function): journal entry of an item
+            dataset (NetCDF4.Dataset): Dataset the items are inserted into
+            buf (_TimeStepBuffer): buffer of the inserted time steps
+            journal (_ConversionJournal): journal of the conversion, or None
+            every (int): items per checkpoint, NC_CHECKPOINT_FILES if None
+    """
+    if every is None:
+        every = NC_CHECKPOINT_FILES
+
+    if journal is None:
+        for item in items:
+            yield item
+        return
+
+    pending = []
+    for item in items:
+        yield item
+
+        pending.append(key(item))
+        if len(pending) >= every:
+            buf.flush()
+            dataset.sync()
+            journal.record(pending)
+            pending = []
+
+    buf.flush()
+    dataset.sync()
+    journal.record(pending)
 
-    else:
-        raise Exception('File type %s not recognized!' % file_type)
+
+def _decode_ipw_grids(path, header_dict, data_offset, file_type):
+    """Decode an IPW file in a worker process of _iter_ipw_grids
+
+        Returns:
+            (tuple) path, file type and grids of the file
+    """
+    ipw = IPW.from_header(path, header_dict, data_offset,
+                          file_type=file_type)
+
+    return path, file_type, _ipw_grids(ipw)
+
+
+def _iter_ipw_grids(index, files, workers=1):
+    """Decode indexed IPW files, yielding them in the order of `files`
+
+        With more than one worker the files are decoded in a process pool.
+        At most two files per worker are decoded ahead of the one being
+        consumed, which bounds the memory held by decoded grids.
+
+        Args:
+            index (IPWIndex): index of the directory of `files`
+            files (list): paths of the files to decode
+            workers (int): number of decoding processes
+
+        Yields:
+            (tuple) path, file type and grids (see _ipw_grids) of each file
+    """
+    if workers <= 1:
+        for f in files:
+            ipw = index.open(f)
+            yield f, ipw.file_type, _ipw_grids(ipw)
+        return
+
+    max_in_flight = 2*workers
+    pending = deque()
+    files = iter(files)
+
+    def submit_next(executor):
+        for f in files:
+            entry = index.entries[basename(f)]
+            pending.append(
+                executor.submit(_decode_ipw_grids, f, index.header_dict(f),
+                                entry['data_offset'],
+                                str(entry['file_type']))
+            )
+            return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        for _ in range(max_in_flight):
+            submit_next(executor)
+
+        while pending:
+            path, file_type, grids = pending.popleft().result()
+            submit_next(executor)
+
+            yield path, file_type, grids
 
 
 def nc_to_standard_ipw(nc_in, ipw_base_dir, clobber=True, type_='inputs',
-                       event_emitter=None, **kwargs):
+                       event_emitter=None, workers=1, resume=False,
+                       window=None, time_range=None, precip_tsteps=None,
+                       **kwargs):
     """Convert an iSNOBAL NetCDF file to an iSNOBAL standard directory structure
        in IPW format. This means that for
 
@@ -789,6 +2267,21 @@ def nc_to_standard_ipw(nc_in, ipw_base_dir, clobber=True, type_='inputs',
         Arguments:
             nc_in (str) path to input NetCDF file to break out
             ipw_base_dir (str) location to store
+            workers (int) number of processes writing the time step IPW
+                files; each opens its own read handle on `nc_in`, so it
+                must be a file on disk
+            resume (bool) keep the files an interrupted conversion left in
+                `ipw_base_dir` and write only those that are missing or
+                whose size does not match their header
+            window (tuple) (lines, samps) slices of the grid to write, to
+                run isnobal on part of the domain; see IPW.from_nc
+            time_range (tuple) (start, stop) time indexes to write, to run
+                isnobal on part of the period; the files and ppt_desc are
+                numbered from 0 at `start`
+            precip_tsteps (list) time indexes of `nc_in` with precip, if
+                already known, e.g. to stage several windows of it; by
+                default they are read from the index generate_standard_nc
+                records or searched for
 
         Returns:
             None
@@ -810,56 +2303,40 @@ def nc_to_standard_ipw(nc_in, ipw_base_dir, clobber=True, type_='inputs',
         "%s not a valid input iSNOBAL NetCDF; %s are missing" \
         % (nc_in.filepath(), expected_vars.difference(present_vars))
 
-    if clobber and exists(ipw_base_dir):
+    if resume and exists(ipw_base_dir):
+        logging.debug('resuming conversion into %s' % ipw_base_dir)
+    elif clobber and exists(ipw_base_dir):
         rmtree(ipw_base_dir)
     elif exists(ipw_base_dir):
         raise IPWFileError("clobber=False and %s exists" % ipw_base_dir)
-    mkdir(ipw_base_dir)
 
-    time_index = range(len(nc_in.variables['time']))
+    if not exists(ipw_base_dir):
+        mkdir(ipw_base_dir)
+
+    def pending(jobs):
+        return [j for j in jobs
+                if not (resume and _ipw_file_complete(j[2], j[1]))]
+
+    ntimes = len(nc_in.variables['time'])
+    start, stop = time_range or (0, ntimes)
+    time_index = range(start, min(stop, ntimes))
 
     if type_ == 'inputs':
         # for each time step create an IPW file
         inputs_dir = osjoin(ipw_base_dir, 'inputs')
-        mkdir(inputs_dir)
+        if not exists(inputs_dir):
+            mkdir(inputs_dir)
 
-        tsteps = len(time_index)
+        in_jobs = _input_jobs(inputs_dir, time_index, start)
 
-        zeropad_factor = floor(log10(tsteps))
+        todo = pending(in_jobs)
+        n_skipped = len(in_jobs) - len(todo)
 
-        file_type = 'in'
         logging.debug('creating input ipw files for each timestep from the input netcdf file (stage 1)')
-        with ProgressBar(maxval=time_index[-1]) as progress:
-            if len(time_index) > 1:
-                for i, idx in enumerate(time_index):
-                    if idx < 10:
-                        idxstr = "0"*zeropad_factor + str(idx)
-                    elif idx < 100:
-                        idxstr = "0"*(zeropad_factor - 1) + str(idx)
-                    elif idx < 1000:
-                        idxstr = "0"*(zeropad_factor - 2) + str(idx)
-                    else:
-                        idxstr = str(idx)
-                    IPW.from_nc(nc_in, tstep=idx, file_type=file_type,
-                                ).write(osjoin(inputs_dir, 'in.' + idxstr))
-                    progress.update(i)
-
-                    kwargs['event_name'] = 'processing_input'
-
-                    kwargs['event_description'] = 'creating input ipw files for ' \
-                        'each timestep from the input netcdf file (stage 1)'
-
-                    kwargs['progress_value'] = format(
-                        (float(i)/time_index[-1]) * 100, '.2f')
-
-                    if event_emitter:
-                        event_emitter.emit('progress', **kwargs)
-
-            else:
-                IPW.from_nc(nc_in, tstep=time_index[0], file_type=file_type,
-                            ).write(osjoin(inputs_dir, 'in'))
-
-                progress.update(i)
+        with ProgressBar(maxval=len(in_jobs)) as progress:
+            for n_done in _stage_nc_to_ipw(nc_in, todo, workers, window):
+                n_done += n_skipped
+                progress.update(n_done)
 
                 kwargs['event_name'] = 'processing_input'
 
@@ -867,7 +2344,7 @@ def nc_to_standard_ipw(nc_in, ipw_base_dir, clobber=True, type_='inputs',
                     'each timestep from the input netcdf file (stage 1)'
 
                 kwargs['progress_value'] = format(
-                    (float(i)/time_index[-1]) * 100, '.2f')
+                    (float(n_done)/len(in_jobs)) * 100, '.2f')
 
                 if event_emitter:
                     event_emitter.emit('progress', **kwargs)
@@ -883,77 +2360,329 @@ def nc_to_standard_ipw(nc_in, ipw_base_dir, clobber=True, type_='inputs',
                 event_emitter.emit('progress', **kwargs)
 
         file_type = 'init'
-        IPW.from_nc(nc_in, file_type=file_type
-                    ).write(osjoin(ipw_base_dir, 'init.ipw'))
+        static_files = [('init.ipw', file_type, dict(file_type=file_type)),
+                        ('dem.ipw', 'dem', dict(variable='alt')),
+                        ('mask.ipw', 'mask', dict(variable='mask'))]
 
-        IPW.from_nc(nc_in, variable='alt'
-                    ).write(osjoin(ipw_base_dir, 'dem.ipw'))
-
-        IPW.from_nc(nc_in, variable='mask'
-                    ).write(osjoin(ipw_base_dir, 'mask.ipw'))
+        for filename, static_type, from_nc_kwargs in static_files:
+            path = osjoin(ipw_base_dir, filename)
+            if not (resume and _ipw_file_complete(path, static_type)):
+                IPW.from_nc(nc_in, window=window, **from_nc_kwargs
+                            ).write(path)
 
         # precip is weird. for no precip tsteps, no IPW exists
         # list of tsteps that had precip and associated
         # files stored in ppt_desc
         file_type = 'precip'
         ppt_images_dir = osjoin(ipw_base_dir, 'ppt_images_dist')
-        mkdir(ppt_images_dir)
-
-        # can use just one variable (precip mass) to see which
-        mpp = nc_in.variables['m_pp'][:]
-        pctsnow = nc_in.variables['percent_snow'][:]
-        rhosnow = nc_in.variables['rho_snow'][:]
-        precip_temp = nc_in.variables['T_pp'][:]
-
-        # if no precip at a tstep, variable type is numpy.ma.core.MaskedArray
-        time_indexes = [i for i, el in enumerate(mpp)
-                        if not (
-                            (
-                                (mpp[i].all() is masked) and
-                                (pctsnow[i].all() is masked) and
-                                (rhosnow[i].all() is masked) and
-                                (precip_temp[i].all() is masked)
-                            )
-                            or
-                            (
-                                (mpp[i] > 1e6).all() and
-                                (pctsnow[i] > 1e6).all() and
-                                (rhosnow[i] > 1e6).all() and
-                                (precip_temp[i] > 1e6).all()
-                            )
-                            )
-                        ]
-
-        # this should be mostly right except for ppt_desc and ppt data dir
+        if not exists(ppt_images_dir):
+            mkdir(ppt_images_dir)
+
+        # NetCDFs from generate_standard_nc record their precip time steps
+        time_indexes = precip_tsteps
+        if time_indexes is None:
+            time_indexes = _read_precip_tsteps(nc_in)
+        if time_indexes is None:
+            time_indexes = list(_iter_precip_tsteps(nc_in))
+
+        ppt_jobs = [(idx, file_type,
+                     osjoin(ppt_images_dir,
+                            'ppt_' + str(idx - start) + '.ipw'))
+                    for idx in time_indexes if start <= idx < stop]
+
+        todo = pending(ppt_jobs)
+        n_skipped = len(ppt_jobs) - len(todo)
+
+        logging.debug('creating input ipw files for each timestep from the input netcdf file (stage 2)')
+        with ProgressBar(maxval=len(ppt_jobs)) as progress:
+
+            for n_done in _stage_nc_to_ipw(nc_in, todo, workers, window):
+                n_done += n_skipped
+                progress.update(n_done)
+                kwargs['event_name'] = 'processing_input2'
+                kwargs['event_description'] = 'creating input ipw files for each timestep from the input netcdf file (stage 2)'
+                kwargs['progress_value'] = format((float(n_done)/len(ppt_jobs)) * 100, '.2f')
+                if event_emitter:
+                    event_emitter.emit('progress',**kwargs)
+
+            kwargs['event_name'] = 'processing_input2'
+            kwargs['event_description'] = 'creating input ipw for each timestep form nc 2'
+            kwargs['progress_value'] = 100
+            if event_emitter:
+                event_emitter.emit('progress',**kwargs)
+
+        # written once all precip files exist, in time step order however
+        # the files were staged
         with open(osjoin(ipw_base_dir, 'ppt_desc'), 'w') as ppt_desc:
-            logging.debug('creating input ipw files for each timestep from the input netcdf file (stage 2)')
-            with ProgressBar(maxval=len(time_indexes)) as progress:
+            for idx, _, ppt_path in ppt_jobs:
+                ppt_desc.write("%s\t%s\n" % (idx - start, ppt_path))
+    else:
+        raise Exception("NetCDF to IPW converter not implemented for type %s" %
+                        type_)
 
-                for i, idx in enumerate(time_indexes):
-                    ppt_desc.write("%s\t%s\n" % (idx,
-                                   osjoin(ppt_images_dir,
-                                          'ppt_' + str(idx) + '.ipw')))
 
-                    ipw = IPW.from_nc(nc_in, tstep=idx, file_type=file_type)
+def _input_jobs(inputs_dir, time_index, start=0):
+    """Staging jobs of the in.* files of a run over the time steps
+       `time_index`, numbered from `start`
 
-                    ipw.write(osjoin(ppt_images_dir,
-                                     'ppt_' + str(idx) + '.ipw'))
+        Returns:
+            (list) (tstep, file_type, path) of each file
+    """
+    if len(time_index) == 1:
+        return [(time_index[0], 'in', osjoin(inputs_dir, 'in'))]
 
-                    progress.update(i)
-                    kwargs['event_name'] = 'processing_input2'
-                    kwargs['event_description'] = 'creating input ipw files for each timestep from the input netcdf file (stage 2)'
-                    kwargs['progress_value'] = format((float(i)/len(time_indexes)) * 100, '.2f')
-                    if event_emitter:
-                        event_emitter.emit('progress',**kwargs)
+    # zero-pad to the number of digits of the number of time steps
+    width = int(floor(log10(len(time_index)))) + 1
 
-                kwargs['event_name'] = 'processing_input2'
-                kwargs['event_description'] = 'creating input ipw for each timestep form nc 2'
-                kwargs['progress_value'] = 100
-                if event_emitter:
-                    event_emitter.emit('progress',**kwargs)
+    return [(idx, 'in', osjoin(inputs_dir, 'in.%0*d' % (width, idx - start)))
+            for idx in time_index]
+
+
+def _ipw_file_complete(path, file_type=None):
+    """Whether the IPW file at `path` exists and is as long as its header
+       says, i.e. the header and all lines of pixel data were written.
+       Only the header is read. `file_type` is needed for files whose type
+       can't be told from their name, as for IPW.
+
+        Returns:
+            (bool)
+    """
+    if not isfile(path):
+        return False
+
+    try:
+        ipw = IPW(path, file_type=file_type, header_only=True)
+    except (IPWFileError, IndexError, ValueError):
+        return False
+
+    gb = ipw.header_dict['global']
+    pixel_bytes = sum(b.bytes_ for b in ipw.nonglobal_bands)
+
+    return getsize(path) == \
+        ipw.data_offset + gb.nLines*gb.nSamps*pixel_bytes
+
+
+def _record_precip_tsteps(dataset, tsteps):
+    """Flag the time steps with precipitation of an input NetCDF in an index
+       variable along time, so conversions back to IPW need not search for
+       them. Anything that modifies the precip variables of a dataset with
+       the index must record it again, see refresh_precip_tsteps.
+
+        Args:
+            dataset (NetCDF4.Dataset): input Dataset
+            tsteps (iterable): time steps that have precipitation
+    """
+    flags = zeros(len(dataset.dimensions['time']), dtype='i1')
+    flags[list(tsteps)] = 1
+
+    if PRECIP_TSTEPS_VARNAME in dataset.variables:
+        var = dataset.variables[PRECIP_TSTEPS_VARNAME]
     else:
-        raise Exception("NetCDF to IPW converter not implemented for type %s" %
-                        type_)
+        var = dataset.createVariable(PRECIP_TSTEPS_VARNAME, 'i1', ('time',))
+        var.long_name = "time steps with precipitation"
+        var.description = "1 at the time steps that have precipitation " \
+            "inputs, 0 at all others, where precipitation is unset"
+
+    var[:] = flags
+
+
+def _read_precip_tsteps(dataset):
+    """Time steps with precipitation recorded in an input NetCDF
+
+        Args:
+            dataset (NetCDF4.Dataset): input Dataset
+
+        Returns:
+            (list) flagged time steps in order, or None if the dataset has
+            no index or it does not span the time dimension
+    """
+    if PRECIP_TSTEPS_VARNAME not in dataset.variables:
+        return None
+
+    var = dataset.variables[PRECIP_TSTEPS_VARNAME]
+    if var.dimensions != ('time',):
+        return None
+
+    flags = getdata(var[:])
+    return [int(t) for t in nonzero(flags == 1)[0]]
+
+
+def refresh_precip_tsteps(dataset):
+    """Search an input NetCDF for its time steps with precipitation again and
+       record them, if it has an index of them. Call after modifying its
+       precip variables, e.g. in a Scenario's perturb.
+
+        Args:
+            dataset (NetCDF4.Dataset): input Dataset open for writing
+    """
+    if PRECIP_TSTEPS_VARNAME in dataset.variables:
+        _record_precip_tsteps(dataset, _iter_precip_tsteps(dataset))
+
+
+def _pad_precip_variables(dataset, tsteps):
+    """Write fill values at the last time step of the precip variables if it
+       has no precipitation, so their data spans the whole time dimension.
+       Only needed where _NC_READ_PAST_DATA_CRASHES.
+
+        Args:
+            dataset (NetCDF4.Dataset): input Dataset being built
+            tsteps (list): time steps that have precipitation files
+    """
+    last = len(dataset.dimensions['time']) - 1
+
+    if last < 0 or last in tsteps:
+        return
+
+    for varname in VARNAME_BY_FILETYPE['precip']:
+        var = dataset.variables[varname]
+        fill_value = getattr(var, '_FillValue',
+                             netCDF4.default_fillvals[var.dtype.str[1:]])
+        var[last, :, :] = fill_value
+
+
+def _iter_precip_tsteps(nc_in, memory=NC_BUFFER_MEMORY):
+    """Find the time steps with precipitation in an input NetCDF
+
+        A time step has no precipitation if every point of every precip
+        variable is masked, or all unmasked points are over 1e6, i.e.
+        unset fill values. The variables are read a block of time steps at
+        a time, aligned to their chunks where `memory` allows, and each
+        block is tested at once.
+
+        Args:
+            nc_in (NetCDF4.Dataset): input Dataset
+            memory (int): bytes of precip data to read at once
+
+        Yields:
+            (int) each time step with precipitation, in order
+    """
+    variables = [nc_in.variables[var]
+                 for var in VARNAME_BY_FILETYPE['precip']]
+
+    ntsteps = variables[0].shape[0]
+    step_bytes = sum(v.shape[1]*v.shape[2]*v.dtype.itemsize
+                     for v in variables)
+
+    block = max(1, memory // step_bytes)
+    chunking = variables[0].chunking()
+    if chunking != 'contiguous' and block >= chunking[0]:
+        block -= block % chunking[0]
+
+    for t0 in range(0, ntsteps, block):
+        t1 = min(t0 + block, ntsteps)
+
+        all_masked = ones(t1 - t0, dtype=bool)
+        all_unset = ones(t1 - t0, dtype=bool)
+
+        for var in variables:
+            data = var[t0:t1]
+            data = data.reshape((t1 - t0, -1))
+
+            mask = getmaskarray(data)
+            var_masked = mask.all(axis=1)
+
+            all_masked &= var_masked
+            all_unset &= ((getdata(data) > 1e6) | mask).all(axis=1) & \
+                ~var_masked
+
+        for i in nonzero(~(all_masked | all_unset))[0]:
+            yield t0 + int(i)
+
+
+def _write_ipws_from_nc(nc_in, jobs, window=None):
+    """Write one IPW file per job from a NetCDF
+
+        Args:
+            nc_in (str or netCDF4.Dataset): NetCDF to read; a path is opened
+                and closed here, which lets worker processes use their own
+                read handle
+            jobs (list): (tstep, file_type, path) of each IPW file to write
+            window (tuple): part of the grid to write, see IPW.from_nc
+
+        Returns:
+            (int) number of files written
+    """
+    close = isinstance(nc_in, basestring)
+    if close:
+        nc_in = Dataset(nc_in, 'r')
+
+    try:
+        for tstep, file_type, path in jobs:
+            IPW.from_nc(nc_in, tstep=tstep, file_type=file_type,
+                        window=window).write(path)
+    finally:
+        if close:
+            nc_in.close()
+
+    return len(jobs)
+
+
+def _close_datasets(datasets):
+    """Close a forked worker's copies of `datasets`, which its parent has
+       open. Otherwise HDF5 would hand the worker the inherited handle when
+       it opens the same file, with a file offset shared with the parent
+       and the other workers, and reads would come back wrong.
+
+       Meant as the initializer of a multiprocessing.Pool, or the start of
+       a multiprocessing.Process, whose arguments are inherited by the fork
+       rather than pickled.
+    """
+    for nc in datasets:
+        if nc.isopen():
+            nc.close()
+
+
+def _write_ipws_in_worker(args):
+    """Write IPW files in a worker process of _stage_nc_to_ipw
+
+        Args:
+            args (tuple): arguments of _write_ipws_from_nc
+    """
+    return _write_ipws_from_nc(*args)
+
+
+def _stage_nc_to_ipw(nc_in, jobs, workers=1, window=None):
+    """Write the IPW files of `jobs` from `nc_in`, in a process pool if
+       `workers` is more than one
+
+        Each worker gets contiguous runs of time steps, several per worker
+        to balance the load, and reads them through its own handle on the
+        file of `nc_in`.
+
+        Args:
+            nc_in (netCDF4.Dataset): NetCDF to read
+            jobs (list): (tstep, file_type, path) of each IPW file to write
+            workers (int): number of writing processes
+            window (tuple): part of the grid to write, see IPW.from_nc
+
+        Yields:
+            (int) number of files written so far, each time it grows
+    """
+    if workers <= 1:
+        for n_done in range(1, len(jobs) + 1):
+            _write_ipws_from_nc(nc_in, jobs[n_done - 1:n_done], window)
+            yield n_done
+        return
+
+    nc_path = nc_in.filepath()
+    run_len = max(1, -(-len(jobs) // (4*workers)))
+    runs = [jobs[i:i + run_len] for i in range(0, len(jobs), run_len)]
+
+    # workers closing their copy of nc_in must have nothing left to flush
+    nc_in.sync()
+
+    pool = multiprocessing.Pool(workers, _close_datasets, ([nc_in],))
+    try:
+        n_done = 0
+        for n in pool.imap_unordered(_write_ipws_in_worker,
+                                     [(nc_path, run, window) for run in runs]):
+            n_done += n
+            yield n_done
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def metadata_from_ipw(ipw, output_file, parent_model_run_uuid, model_run_uuid,
@@ -1051,74 +2780,78 @@ def _is_consecutive(ipws):
     return ret
 
 
-def _build_ipw_dataframe(nonglobal_bands, binary_data):
+def _build_ipw_dataframe(nonglobal_bands, binary_data, byteorder='0123'):
     """
     Build a pandas DataFrame using header info to assign column names
     """
     colnames = [b.varname for b in nonglobal_bands]
 
-    dtype = _bands_to_dtype(nonglobal_bands)
+    band_data = _LazyBands(nonglobal_bands, binary_data, byteorder)
 
-    intData = fromstring(binary_data, dtype=dtype)
+    return DataFrame(OrderedDict((c, band_data[c]) for c in colnames),
+                     columns=colnames)
 
-    df = DataFrame(intData, columns=colnames)
 
-    for b in nonglobal_bands:
-        df[b.varname] = _calc_float_value(b, df[b.varname])
+def _fill_masked(data, fill_value=nan):
+    """
+    Replace masked values of NetCDF data with `fill_value`, by default NaN
+    as a pandas column assignment would. Integer data with masked values is
+    upcast to float.
+    """
+    if not is_masked(data):
+        return getdata(data)
 
-    return df
+    if data.dtype.kind != 'f':
+        data = data.astype('float64')
 
+    return data.filled(fill_value)
 
-def _make_bands(header_lines, varnames):
-    """
-    Make a header dictionary that points to Band objects for each variable
-    name.
 
-    Returns: dict
+def _window_slices(window, nlines, nsamps):
+    """
+    Normalize a (lines, samps) window of an nlines x nsamps grid to slices
+    with explicit, in-bounds starts and stops; None is the whole grid.
     """
-    globalEndIdx = 0
-    # parse global information from global header
-    for i, l in enumerate(header_lines[1:-1]):
-        if IsHeaderStart(l):
-            globalEndIdx = i
-            break
+    if window is None:
+        window = (slice(None), slice(None))
 
-    global_header_lines = header_lines[1:globalEndIdx+1]
+    lines, samps = window
+    line0, line1, line_step = lines.indices(nlines)
+    samp0, samp1, samp_step = samps.indices(nsamps)
 
-    # tried a prettier dictionary comprehension, but wouldn't fly
-    global_band_dict = defaultdict(int)
-    for l in global_header_lines:
-        if l:
-            spl = l.strip().split()
-            if spl[0] == 'byteorder':
-                global_band_dict[spl[0]] = spl[2]
-            else:
-                global_band_dict[spl[0]] = int(spl[2])
+    if line_step != 1 or samp_step != 1 or line1 <= line0 or samp1 <= samp0:
+        raise IPWFileError("Window %s is not a contiguous part of the grid"
+                           % (window,))
 
-    # these are the standard names in an ISNOBAL header file
-    byteorder = global_band_dict['byteorder']
-    nLines = global_band_dict['nlines']
-    nSamps = global_band_dict['nsamps']
-    nBands = global_band_dict['nbands']
+    return slice(line0, line1), slice(samp0, samp1)
 
-    # this will be put into the return dictionary at the return statement
-    globalBand = GlobalBand(byteorder, nLines, nSamps, nBands)
 
-    # initialize a list of bands to put parsed information into
-    bands = [Band() for i in range(nBands)]
+def _make_bands(header_lines, varnames):
+    """
+    Make a header dictionary that points to Band objects for each variable
+    name.
 
-    for i, b in enumerate(bands):
-        b.varname = varnames[i]
-        b.band_idx = i
+    The header is parsed in one pass over its lines. IPW repeats the geo
+    information for every band; it is read from the first geo header and
+    copied to all bands once the pass is done.
+
+    Returns: dict
+    """
+    global_band_dict = defaultdict(int)
+    bands = None
 
     band_type = None
     band_idx = None
-    geo_parsed = False
-    ref_band = Band()
+    lq_counter = 0
     geo_count = 0
-    for line in header_lines[globalEndIdx:]:
+    ref_band = Band()
+
+    for line in header_lines:
 
         spl = line.strip().split()
+        if not spl:
+            continue
+
         attr = spl[0]
 
         if IsHeaderStart(line):
@@ -1126,12 +2859,22 @@ def _make_bands(header_lines, varnames):
             band_type = spl[BAND_TYPE_LOC]
             band_idx = int(spl[BAND_INDEX_LOC])
 
-            lqCounter = 0
+            lq_counter = 0
 
             if band_type == 'geo':
                 geo_count += 1
-                if geo_count == 2:
-                    geo_parsed = True
+
+            # the global header comes first; make bands once it's done
+            if bands is None and band_type != 'basic_image_i':
+                bands = [Band(varname=varnames[i], band_idx=i)
+                         for i in range(global_band_dict['nbands'])]
+
+        elif band_type == 'basic_image_i':
+            # these are the standard names in an ISNOBAL header file
+            if attr == 'byteorder':
+                global_band_dict[attr] = spl[2]
+            else:
+                global_band_dict[attr] = int(spl[2])
 
         elif band_type == 'basic_image':
             # assign byte and bits info that's stored here
@@ -1142,52 +2885,50 @@ def _make_bands(header_lines, varnames):
             # assign integer and float min and max. ignore non-"map" fields
             if attr == "map":
                 # minimum values are listed first by IPW
-                if lqCounter == 0:
+                if lq_counter == 0:
                     bands[band_idx].int_min = float(spl[2])
                     bands[band_idx].float_min = float(spl[3])
-                    lqCounter += 1
+                    lq_counter += 1
 
-                elif lqCounter == 1:
+                elif lq_counter == 1:
                     bands[band_idx].int_max = float(spl[2])
                     bands[band_idx].float_max = float(spl[3])
 
         elif band_type == 'geo':
             # Not all bands have geo information. The ones that do are
-            # expected to be redundant. Check that all available are equal
-            # and for any that don't have geo information, set them to the
-            # geo information
-            if not geo_parsed:
-
-                if attr in ["bline", "bsamp", "dline", "dsamp"]:
-                    setattr(ref_band, attr, float(spl[2]))
-                    # setattr(bands[band_idx], attr, float(spl[2]))
-
-                elif attr in ["units", "coord_sys_ID"]:
-                    if attr == "units":
-                        attr = "geo_units"
-                    setattr(ref_band, attr, spl[2])
-                    # setattr(bands[band_idx], attr, spl[2])
-                else:
-                    raise Exception(
-                        "'geo' attribute %s from IPW file not recognized!" %
-                        attr)
+            # expected to be redundant, so only the first is read
+            if attr in ["bline", "bsamp", "dline", "dsamp"]:
+                value = float(spl[2])
 
-            else:
+            elif attr in ["units", "coord_sys_ID"]:
                 if attr == "units":
                     attr = "geo_units"
+                value = spl[2]
 
-                assert\
-                    getattr(ref_band, attr) == getattr(bands[band_idx], attr)
+            else:
+                raise Exception(
+                    "'geo' attribute %s from IPW file not recognized!" %
+                    attr)
 
-        # now set all bands to the reference band
-        for band in bands:
+            if geo_count == 1:
+                setattr(ref_band, attr, value)
 
-            band.bline = ref_band.bline
-            band.bsamp = ref_band.bsamp
-            band.dline = ref_band.dline
-            band.dsamp = ref_band.dsamp
-            band.geo_units = ref_band.geo_units
-            band.coord_sys_ID = ref_band.coord_sys_ID
+    globalBand = GlobalBand(global_band_dict['byteorder'],
+                            global_band_dict['nlines'],
+                            global_band_dict['nsamps'],
+                            global_band_dict['nbands'])
+
+    # now set all bands to the reference band
+    for band in bands:
+
+        band.bline = ref_band.bline
+        band.bsamp = ref_band.bsamp
+        band.dline = ref_band.dline
+        band.dsamp = ref_band.dsamp
+        band.geo_units = ref_band.geo_units
+        band.coord_sys_ID = ref_band.coord_sys_ID
+
+    nBands = globalBand.nBands
 
     return dict(zip(['global']+varnames[:nBands], [globalBand]+bands))
 
@@ -1204,12 +2945,14 @@ def _calc_float_value(band, integerValue):
     return integerValue * (floatRange / band.int_max) + band.float_min
 
 
-def _bands_to_dtype(bands):
+def _bands_to_dtype(bands, byteorder='0123'):
     """
     Given a list of Bands, convert them to a numpy.dtype for use in creating
-    the IPW dataframe.
+    the IPW dataframe. `byteorder` is the IPW byteorder header value.
     """
-    return dtype([(b.varname, 'uint' + str(b.bytes_ * 8)) for b in bands])
+    order = BYTEORDER_DICT[byteorder]
+
+    return dtype([(b.varname, order + 'u' + str(b.bytes_)) for b in bands])
 
 
 def _bands_to_header_lines(bands_dict):
@@ -1274,64 +3017,80 @@ def _bands_to_header_lines(bands_dict):
     return firstLines + other_lines
 
 
-def _write_floatdf_binstring_to_file(bands, df, write_file):
+def _write_floatdf_binstring_to_file(bands, df, write_file, byteorder='0123'):
     """
     Convert the dataframe floating point data to a binary string.
 
+    Each band is quantized with numpy into its own unsigned integer field of
+    a structured array, so the bands are interleaved pixel by pixel as IPW
+    expects, and the whole array goes to the file in a single write.
+
+    IPW has no missing value, so NaNs, e.g. the masked points IPW.from_nc
+    reads from a variable without a _FillValue, are written as the band's
+    float_min.
+
     Arguments:
         bands: list of Band objects
         df: dataframe to be written
         write_file: File object ready for writing to
+        byteorder: IPW byteorder header value of the file being written
     """
-    # first convert df to an integer dataframe
-    int_df = DataFrame(dtype='uint64')
+    bands = sorted(bands, key=lambda b: b.band_idx)
 
-    for b in sorted(bands, key=lambda b: b.band_idx):
-        # check that bands are appropriately made, that b.Max/Min really are
-        assert df[b.varname].le(b.float_max).all(), \
-            "Bad band: max not really max.\nb.float_max = %2.10f\n \
-            df[b.varname].max()  = %s" % (b.float_max, df[b.varname].max())
+    float_cols = [asarray(df[b.varname], dtype='float64') for b in bands]
 
-        assert df[b.varname].ge(b.float_min).all(), \
-            "Bad band: min not really min.\nb.float_min = %s\n \
-            df[b.varname].min()  = %2.10f" % (b.float_min, df[b.varname].min())
+    int_dtype = _bands_to_dtype(bands, byteorder)
+    int_arr = empty(len(float_cols[0]), dtype=int_dtype)
 
-        def _map_fn(x):
-            if b.float_max - b.float_min == 0.0:
-                return 0.0
-            else:
-                return floor(npround(
-                    ((x - b.float_min) * b.int_max)/(b.float_max - b.float_min)
-                    ))
-
-        int_df[b.varname] = _map_fn(df[b.varname])
+    for b, float_col in zip(bands, float_cols):
+        nans = isnan(float_col)
+        if nans.any():
+            float_col = float_col.copy()
+            float_col[nans] = b.float_min
 
-    # use the struct package to pack ints to bytes; use '=' to prevent padding
-    # that causes problems with the IPW scheme
-    # pack_str = "=" + "".join([PACK_DICT[b.bytes_] for b in bands])
+        # check that bands are appropriately made, that b.Max/Min really are
+        assert (float_col <= b.float_max).all(), \
+            "Bad band: max not really max.\nb.float_max = %2.10f\n \
+            df[b.varname].max()  = %s" % (b.float_max, float_col.max())
 
-    int_mat = int_df.as_matrix()
+        assert (float_col >= b.float_min).all(), \
+            "Bad band: min not really min.\nb.float_min = %s\n \
+            df[b.varname].min()  = %2.10f" % (b.float_min, float_col.min())
 
-    pack_str = "=" + "".join([PACK_DICT[b.bytes_] for b in bands])*len(int_mat)
+        float_range = b.float_max - b.float_min
+        if float_range == 0.0:
+            int_arr[b.varname] = 0
+        else:
+            # same arithmetic as the scalar mapping, done in place; rounded
+            # values are already integral so the cast into the field is exact
+            scaled = float_col - b.float_min
+            scaled *= b.int_max
+            scaled /= float_range
+            int_arr[b.varname] = npround(scaled, out=scaled)
 
-    # for row_idx in range(len(int_mat)):
-    flat_mat = int_mat.flatten()
-    write_file.write(pack(pack_str, *flat_mat))
+    write_file.write(int_arr.tobytes())
 
 
-def _recalculate_header(bands, dataframe):
+def _recalculate_header(bands, data):
     """
-    Recalculate the minimum and maximum of each band in bands given a dataframe
-    that contains data for each band.
+    Recalculate the minimum and maximum of each band in bands given a
+    DataFrame or dict of arrays that contains data for each band. NaNs are
+    skipped, as they are written as the minimum; a band of only NaNs gets
+    the range [0, 1].
 
     Returns: None
     """
-    assert set(list(dataframe.columns)) == set([b.varname for b in bands]), \
-        "DataFrame column names do not match bands' variable names!"
+    assert set(data.keys()) == set([b.varname for b in bands]), \
+        "Data variable names do not match bands' variable names!"
 
     for band in bands:
-        band.float_min = dataframe[band.varname].min()
-        band.float_max = dataframe[band.varname].max()
+        values = asarray(data[band.varname], dtype='float64')
+        if isnan(values).all():
+            band.float_min, band.float_max = 0.0, 1.0
+            continue
+
+        band.float_min = float(nanmin(values))
+        band.float_max = float(nanmax(values))
 
         if band.float_min == band.float_max:
             band.float_max = band.float_min + 1.0
@@ -1380,25 +3139,481 @@ class Band(object):
                      self.__dict__.iteritems()])
 
 
+class _LazyBands(MutableMapping):
+    """
+    Mapping of variable name to the floating point data of each band of an
+    IPW file. A band is dequantized the first time it is accessed, from a
+    strided view of its field in the interleaved integer data, and cached, so
+    bands that are never touched are never decoded.
+
+    The lq mapping of each band is copied when the mapping is made, so later
+    changes to the Bands' headers don't change how data is decoded.
+    """
+    def __init__(self, nonglobal_bands, binary_data, byteorder='0123'):
+
+        self._bands = OrderedDict((b.varname, deepcopy(b))
+                                  for b in nonglobal_bands)
+
+        self._int_data = frombuffer(
+            binary_data, dtype=_bands_to_dtype(nonglobal_bands, byteorder))
+
+        self._decoded = {}
+
+    def __getitem__(self, varname):
+        if varname not in self._decoded:
+            self._decoded[varname] = \
+                _calc_float_value(self._bands[varname],
+                                  self._int_data[varname])
+
+        return self._decoded[varname]
+
+    def is_decoded(self, varname):
+        return varname in self._decoded
+
+    def window(self, varname, shape, key):
+        """
+        Dequantize only the part `key` of band `varname` viewed as a grid of
+        `shape`, without caching it
+        """
+        int_grid = reshape(self._int_data[varname], shape)
+
+        return _calc_float_value(self._bands[varname], int_grid[key])
+
+    def __setitem__(self, varname, values):
+        self._decoded[varname] = values
+
+    def __delitem__(self, varname):
+        if varname not in self:
+            raise KeyError(varname)
+
+        self._decoded.pop(varname, None)
+        self._bands.pop(varname, None)
+
+    def __contains__(self, varname):
+        return varname in self._bands or varname in self._decoded
+
+    def __iter__(self):
+        for varname in self._bands:
+            yield varname
+
+        for varname in self._decoded:
+            if varname not in self._bands:
+                yield varname
+
+    def __len__(self):
+        return len(set(self._bands) | set(self._decoded))
+
+
 class IPWLines(object):
     """
     Data structure to wrap header and binary parts of an IPW file.
 
+    The header is read line by line up to the image header, which IPW ends
+    with a form feed. The pixel data after it is not read; `binary_data` is a
+    read-only uint8 view over a memory map of the file that starts at byte
+    `data_offset`, so pages are only loaded once the data is decoded.
+
     Arguments: ipwFile -- file name pointing to an IPW file
+               header_only -- if True, don't map the data; binary_data is None
     """
-    def __init__(self, ipw_file):
+    def __init__(self, ipw_file, header_only=False):
 
+        header_lines = []
         with open(ipw_file, 'rb') as f:
-            lines = f.readlines()
+            for line in iter(f.readline, ''):
+                header_lines.append(line)
+                if "\f" in line:
+                    break
+            else:
+                raise IPWFileError("No image header found in %s" % ipw_file)
+
+            data_offset = f.tell()
+
+        self.header_lines = header_lines
+
+        self.data_offset = data_offset
+
+        if header_only:
+            self.binary_data = None
+        else:
+            self.binary_data = _map_ipw_data(ipw_file, data_offset)
+
+
+def _map_ipw_data(ipw_file, data_offset):
+    """
+    Memory-map the data of an IPW file that starts at byte `data_offset`.
+
+    Returns: read-only uint8 array
+    """
+    # mmap can not map zero bytes, e.g. a file that is only a header
+    if getsize(ipw_file) > data_offset:
+        return memmap(ipw_file, dtype='uint8', mode='r', offset=data_offset)
+    else:
+        return array([], dtype='uint8')
+
+
+class IPWIndex(object):
+    """
+    Index of the IPW files in one directory of a standard iSNOBAL directory
+    structure, e.g. an inputs/ or outputs/ directory.
+
+    For every file the index records its file type, time step, header
+    (global band, per-band bytes/bits and lq min/max, geo information), the
+    byte offset of its data, its size and mtime and a hash of its header
+    bytes. Given an `index_file`, the index is kept there, e.g. as
+    IPW_INDEX_FILENAME in the directory or in a cache directory. When it is
+    loaded again only files that were added or whose size or mtime changed
+    are parsed again, and entries for removed files are dropped.
+
+    >>> index = IPWIndex('isnobal_run/outputs',
+    ...                  index_file='isnobal_run/outputs/.ipw_index.json')
+    >>> em_files = index.files('em', start=100, stop=200)
+    >>> ipw = index.open(em_files[0])
+
+    Files that are not IPW files, whose type can't be told from their name
+    or that are hidden, are not indexed.
 
-        last_header_idx = \
-            [(i, l) for i, l in enumerate(lines) if "" in l][0][0]
+    Arguments:
+        directory (str) directory of IPW files to index
+        index_file (str) where to keep the index; by default it is only
+            kept in memory
+    """
+    def __init__(self, directory, index_file=None):
+
+        self.directory = directory
+        self.index_file = index_file
+
+        self.entries = {}
+
+        if index_file is not None and exists(index_file):
+            try:
+                with open(index_file, 'r') as f:
+                    index = json.load(f)
+
+                if index.get('version') == IPW_INDEX_VERSION:
+                    self.entries = index['entries']
+
+            except ValueError:
+                logging.debug('IPW index %s is corrupt; rebuilding' %
+                              index_file)
+
+        self.update()
+
+    def update(self):
+        """
+        Bring the index up to date with the directory, parsing the headers
+        of new and changed files only, and save it if it has an index file.
+
+        Files of one grid all have the same size, and a file rewritten
+        within IPW_INDEX_MTIME_TICK of when it was last checked may keep its
+        mtime. An entry whose size and mtime are unchanged is kept without
+        reading the file unless its mtime is that recent, in which case it
+        is kept only if the header bytes of the file are unchanged too.
+
+        Returns:
+            (bool) whether any entry changed
+        """
+        changed = False
+        entries = {}
+
+        # taken before any stat, so no file is thought older than it is
+        checked = time.time()
+
+        # the index file and its temporary file, if kept in the directory
+        skipped = ()
+        if self.index_file is not None:
+            index_path = abspath(self.index_file)
+            skipped = (index_path, index_path + '.tmp')
+
+        for filename in listdir(self.directory):
+
+            path = osjoin(self.directory, filename)
+
+            # hidden files include the temporary files of IPW.write
+            if filename.startswith('.') or not isfile(path) or \
+                    abspath(path) in skipped:
+                continue
+
+            st = stat(path)
+
+            entry = self.entries.get(filename)
+            if entry is not None and entry['size'] == st.st_size and \
+                    entry['mtime'] == st.st_mtime:
+
+                if st.st_mtime < entry['checked'] - IPW_INDEX_MTIME_TICK:
+                    entries[filename] = entry
+                    continue
+
+                if entry['header_sha1'] == \
+                        _header_sha1(path, entry['data_offset']):
+
+                    entries[filename] = dict(entry, checked=checked)
+                    # worth saving if it spares the next update the hash
+                    changed |= st.st_mtime < checked - IPW_INDEX_MTIME_TICK
+                    continue
+
+            try:
+                entries[filename] = _ipw_index_entry(path, st, checked)
+            except (IPWFileError, IndexError, ValueError):
+                logging.debug('%s is not an indexable IPW file' % path)
+                continue
+
+            changed = True
+
+        changed |= set(entries) != set(self.entries)
+
+        self.entries = entries
+
+        if changed and self.index_file is not None:
+            self.save()
+
+        return changed
+
+    def save(self):
+        """
+        Write the index file. The index is written to a temporary file
+        first and moved into place so readers never see a partial index.
+        """
+        tmp_file = self.index_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'version': IPW_INDEX_VERSION,
+                           'entries': self.entries},
+                          f, separators=(',', ':'))
+
+            rename(tmp_file, self.index_file)
+
+        except (IOError, OSError) as e:
+            # an unwritable data directory should not stop a conversion
+            logging.debug('Could not save IPW index %s: %s' %
+                          (self.index_file, e))
+
+    def files(self, file_type=None, start=None, stop=None):
+        """
+        Paths of indexed files, optionally only those of one file type and
+        with time steps in [start, stop). Files with time steps come first,
+        sorted by time step and then by name.
+        """
+        selected = []
+        for filename, entry in self.entries.iteritems():
+
+            if file_type is not None and entry['file_type'] != file_type:
+                continue
+
+            tstep = entry['tstep']
+            if start is not None and (tstep is None or tstep < start):
+                continue
+            if stop is not None and (tstep is None or tstep >= stop):
+                continue
+
+            selected.append(((tstep is None, tstep, filename), filename))
+
+        return [osjoin(self.directory, filename)
+                for _, filename in sorted(selected)]
+
+    def time_steps(self, file_type):
+        """
+        Sorted time steps of the indexed files of type `file_type`
+        """
+        return sorted(entry['tstep'] for entry in self.entries.values()
+                      if entry['file_type'] == file_type and
+                      entry['tstep'] is not None)
+
+    def header_dict(self, path):
+        """
+        Rebuild the header dictionary of an indexed file without reading it
+        """
+        entry = self.entries[basename(path)]
+
+        gb = entry['global']
+        header_dict = {'global': GlobalBand(str(gb['byteorder']),
+                                            gb['nlines'], gb['nsamps'],
+                                            gb['nbands'])}
+
+        geo = entry['geo']
+        for band_idx, b in enumerate(entry['bands']):
+            varname = str(b['varname'])
+            header_dict[varname] = Band(
+                varname, band_idx, b['bytes'], b['bits'], b['int_min'],
+                b['int_max'], b['float_min'], b['float_max'],
+                geo['bline'], geo['bsamp'], geo['dline'], geo['dsamp'],
+                str(geo['units']), str(geo['coord_sys_ID']))
+
+        return header_dict
 
-        split_idx = last_header_idx + 1
+    def open(self, path, header_only=False, **kwargs):
+        """
+        Open an indexed file as an IPW using the indexed header. Keyword
+        arguments are passed to IPW.from_header.
+        """
+        entry = self.entries[basename(path)]
+
+        return IPW.from_header(osjoin(self.directory, basename(path)),
+                               self.header_dict(path), entry['data_offset'],
+                               file_type=str(entry['file_type']),
+                               header_only=header_only, **kwargs)
+
+
+class IPWStack(object):
+    """
+    Lazy view of the IPW files of one type in a directory, e.g. in.0000 to
+    in.8758 or em.*, as one (time, line, samp) array per variable. Time is
+    the position of a file among the indexed files of that type, in time
+    step order; `time_steps` holds their actual time steps.
+
+    Nothing is read until a variable is sliced, and then only the files in
+    the slice and, in them, only the band and lines asked for.
+
+    >>> stack = IPWStack('isnobal_run/outputs', 'em')
+    >>> stack['melt'].shape
+    (8760, 148, 170)
+    >>> melt = stack['melt'][100:200, 10:20, :]
+
+    Bands missing from a file, like S_n in nighttime input files, read as
+    zeros.
+
+    Arguments:
+        directory (str) directory of IPW files
+        file_type (str) type of the files to stack, e.g. 'in', 'em', 'snow'
+        index (IPWIndex) index of `directory`, if one is already open
+    """
+    def __init__(self, directory, file_type, index=None):
+
+        if index is None:
+            index = IPWIndex(directory)
+
+        self.index = index
+        self.file_type = file_type
+
+        self.files = index.files(file_type, start=0)
+        if not self.files:
+            raise IPWFileError("No %s files with time steps in %s" %
+                               (file_type, directory))
+
+        self.time_steps = index.time_steps(file_type)
+
+        gb = index.header_dict(self.files[0])['global']
+        self.shape = (len(self.files), gb.nLines, gb.nSamps)
+
+        self.varnames = VARNAME_BY_FILETYPE[file_type]
+
+    def __getitem__(self, varname):
+        if varname not in self.varnames:
+            raise KeyError(varname)
+
+        return IPWStackVariable(self, varname)
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class IPWStackVariable(object):
+    """
+    One variable of an IPWStack. Slice it like a (time, line, samp) numpy
+    array to read the data.
+    """
+    def __init__(self, stack, varname):
+        self.stack = stack
+        self.varname = varname
+        self.shape = stack.shape
+        self.ndim = 3
+        self.dtype = dtype('float64')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) > 3:
+            raise IndexError("too many indices for a (time, line, samp) "
+                             "stack")
+
+        time_key = key[0]
+        grid_key = tuple(key[1:]) + (slice(None),) * (3 - len(key))
+
+        time_idx = range(self.shape[0])[time_key]
+
+        if isinstance(time_idx, int):
+            return self._read(time_idx, grid_key)
+
+        window_shape = empty(self.shape[1:], dtype='bool')[grid_key].shape
+        out = empty((len(time_idx),) + window_shape, dtype=self.dtype)
+
+        for i, t in enumerate(time_idx):
+            out[i] = self._read(t, grid_key)
+
+        return out
+
+    def _read(self, time_idx, grid_key):
+        """
+        Read the window `grid_key` of this variable from one file
+        """
+        ipw = self.stack.index.open(self.stack.files[time_idx])
+
+        if self.varname in ipw.varnames:
+            return ipw.grid(self.varname, grid_key)
+
+        return zeros(self.shape[1:])[grid_key]
+
+
+def _open_ipw_index(directory, keep):
+    """
+    Index the IPW files in `directory`, keeping the index there as
+    IPW_INDEX_FILENAME if `keep`, or only in memory.
+    """
+    if keep:
+        return IPWIndex(directory,
+                        index_file=osjoin(directory, IPW_INDEX_FILENAME))
+
+    return IPWIndex(directory)
+
+
+def _ipw_index_entry(path, st, checked):
+    """
+    Read the header of the IPW file at `path` and summarize it for IPWIndex.
+    `st` is the result of stat-ing the file, no earlier than `checked`.
+
+    Returns: dict
+    """
+    ipw = IPW(path, header_only=True)
+
+    try:
+        tstep = int(basename(path).split('.')[-1])
+    except ValueError:
+        tstep = None
+
+    gb = ipw.header_dict['global']
+    band0 = ipw.nonglobal_bands[0]
+
+    return {
+        'file_type': ipw.file_type,
+        'tstep': tstep,
+        'global': {'byteorder': gb.byteorder, 'nlines': gb.nLines,
+                   'nsamps': gb.nSamps, 'nbands': gb.nBands},
+        'geo': {'bline': band0.bline, 'bsamp': band0.bsamp,
+                'dline': band0.dline, 'dsamp': band0.dsamp,
+                'units': band0.geo_units,
+                'coord_sys_ID': band0.coord_sys_ID},
+        'bands': [{'varname': b.varname, 'bytes': b.bytes_,
+                   'bits': b.bits_, 'int_min': b.int_min,
+                   'int_max': b.int_max, 'float_min': b.float_min,
+                   'float_max': b.float_max}
+                  for b in ipw.nonglobal_bands],
+        'data_offset': ipw.data_offset,
+        'header_sha1': _header_sha1(path, ipw.data_offset),
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'checked': checked
+    }
 
-        self.header_lines = lines[:split_idx]
 
-        self.binary_data = "".join(lines[split_idx:])
+def _header_sha1(path, data_offset):
+    "Hexadecimal SHA-1 digest of the header bytes of the IPW file at `path`"
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(data_offset)).hexdigest()
 
 
 class IPWFileError(Exception):
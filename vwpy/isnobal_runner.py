@@ -1,9 +1,274 @@
-from isnobal import isnobal
+from isnobal import isnobal, IPW_INDEX_MTIME_TICK
+import errno
+import hashlib
+import json
+import logging
 import netCDF4
+import os
+import shutil
+import time
+import uuid
 
+from distutils.spawn import find_executable
+from numpy import asarray, ascontiguousarray
+
+from netcdf import STORAGE_PROFILES, DEFAULT_STORAGE_PROFILE
+
+#: Default bound, in bytes, on the size of a run_isnobal result cache
+ISNOBAL_CACHE_SIZE = 10*1024**3
+
+#: Bytes of variable data to read at a time when hashing an input dataset
+HASH_BLOCK_BYTES = 64*1024**2
+
+#: Most input dataset digests _dataset_digest keeps
+DIGEST_CACHE_SIZE = 64
+
+# (path, size, mtime) of hashed input NetCDFs to their digests
+_dataset_digests = {}
+
+
+def run_isnobal(input_path=None, output_path=None, event_emitter=None,
+                cache_dir=None, cache_size=ISNOBAL_CACHE_SIZE,
+                model_version=None, **kwargs):
+    """Run isnobal on the input NetCDF at `input_path`, writing its outputs
+       to the NetCDF `output_path`.
+
+       Given `cache_dir`, outputs are cached there by run_cache_key. A run
+       whose key is cached is not run again; its stored output is copied to
+       `output_path`. The least recently used outputs are evicted to keep
+       the cache within `cache_size` bytes. `model_version` defaults to a
+       hash of the isnobal executable on the PATH; without one, the cache
+       is not used.
+    """
+    if cache_dir is not None and model_version is None:
+        model_version = _isnobal_version()
+        if model_version is None:
+            logging.warning('No isnobal on the PATH to key cached runs by; '
+                            'not using the cache')
+            cache_dir = None
 
-def run_isnobal(input_path=None, output_path=None, event_emitter=None, **kwargs):
     input_nc = netCDF4.Dataset(input_path)
-    nc_out = isnobal(input_nc, output_path,
-                     event_emitter=event_emitter, **kwargs)
-    nc_out.close()
+
+    try:
+        if cache_dir is None:
+            nc_out = isnobal(input_nc, output_path,
+                             event_emitter=event_emitter, **kwargs)
+            nc_out.close()
+            return
+
+        key = run_cache_key(input_nc, model_version, **kwargs)
+        cache_path = os.path.join(cache_dir, key + '.nc')
+
+        if _copy_cached(cache_path, output_path):
+            if event_emitter:
+                kwargs['event_name'] = 'running_isonbal'
+                kwargs['event_description'] = 'Found cached model outputs'
+                kwargs['progress_value'] = 100
+                event_emitter.emit('progress', **kwargs)
+            return
+
+        nc_out = isnobal(input_nc, output_path,
+                         event_emitter=event_emitter, **kwargs)
+        nc_out.close()
+
+    finally:
+        input_nc.close()
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # copy then rename so readers never see a partial file
+    tmp_path = cache_path + '.' + str(uuid.uuid4()) + '.tmp'
+    shutil.copyfile(output_path, tmp_path)
+    os.rename(tmp_path, cache_path)
+
+    _evict_cache(cache_dir, cache_size)
+
+
+def _copy_cached(cache_path, output_path):
+    """Copy the cached outputs at `cache_path` to `output_path`, if there
+       are any. The entry is opened before anything else is done with it,
+       so one evicted meanwhile is either copied whole or a miss.
+
+        Returns:
+            (bool) whether the outputs were cached
+    """
+    try:
+        cached = open(cache_path, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+
+    with cached:
+        try:
+            # mark as recently used
+            os.utime(cache_path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        with open(output_path, 'wb') as f:
+            shutil.copyfileobj(cached, f)
+
+    return True
+
+
+def run_cache_key(nc_in, model_version=None, dt='hours', year=2010, month=10,
+                  day='01', crop=False, segment_steps=None,
+                  storage_profile=DEFAULT_STORAGE_PROFILE, **kwargs):
+    """Key of an isnobal run in a run_isnobal cache: a hash of the input
+       dataset's dimensions, variables and attributes, the run parameters
+       and the model version. The run parameters of an input NetCDF are its
+       data_tstep, nsteps and output_frequency attributes, and the keyword
+       arguments of isnobal that change its outputs: the date arguments set
+       the time axis of the outputs, `crop` zero-fills the unmasked pixels,
+       segmented runs restart from quantized snow states and
+       `storage_profile` sets how the outputs are stored. Any other
+       keyword arguments, e.g. tiles, workers or the event_name,
+       progress_value and job ids of progress events, are not part of the
+       key; tiled runs give the outputs of a single run.
+
+        Returns:
+            (str) hexadecimal SHA-1 digest
+
+        Raises:
+            ValueError: if `model_version` is None and there is no isnobal
+                on the PATH
+    """
+    if model_version is None:
+        model_version = _isnobal_version()
+        if model_version is None:
+            raise ValueError("No isnobal on the PATH to key the run by")
+
+    if isinstance(storage_profile, basestring):
+        storage_profile = STORAGE_PROFILES.get(storage_profile,
+                                               storage_profile)
+
+    digest = hashlib.sha1()
+
+    # isnobal takes these from the input, whatever the keyword arguments
+    params = [('data_tstep', int(nc_in.data_tstep)),
+              ('nsteps', int(nc_in.nsteps)),
+              ('output_frequency', int(nc_in.output_frequency)), ('dt', dt),
+              ('year', int(year)), ('month', int(month)), ('day', int(day)),
+              ('crop', bool(crop)),
+              ('segment_steps', int(segment_steps or 0)),
+              ('storage_profile', storage_profile),
+              ('model_version', model_version)]
+
+    # JSON with sorted keys, so equal dicts and tuples equal to lists hash
+    # alike
+    digest.update(json.dumps(params, sort_keys=True, default=repr))
+
+    digest.update(_dataset_digest(nc_in))
+
+    return digest.hexdigest()
+
+
+def _dataset_digest(nc):
+    """Hexadecimal SHA-1 digest of the dimensions, attributes and variable
+       data of `nc`. Digests of files unchanged for IPW_INDEX_MTIME_TICK
+       are kept by path, size and mtime, so keying runs of the same input
+       again does not read all of its data again.
+    """
+    try:
+        path = os.path.abspath(nc.filepath())
+        st = os.stat(path)
+    except (ValueError, OSError):
+        # e.g. an in-memory dataset
+        path = None
+
+    if path is not None:
+        file_key = (path, st.st_size, st.st_mtime)
+        if file_key in _dataset_digests:
+            return _dataset_digests[file_key]
+
+    digest = hashlib.sha1()
+    _update_digest(digest, nc)
+    hexdigest = digest.hexdigest()
+
+    # a file written within a tick of hashing may change keeping its mtime
+    if path is not None and \
+            st.st_mtime < time.time() - IPW_INDEX_MTIME_TICK:
+        if len(_dataset_digests) >= DIGEST_CACHE_SIZE:
+            _dataset_digests.clear()
+        _dataset_digests[file_key] = hexdigest
+
+    return hexdigest
+
+
+def _update_digest(digest, nc):
+    "Hash the dimensions, attributes and variable data of `nc` into `digest`"
+    digest.update(repr(sorted((name, len(dim))
+                              for name, dim in nc.dimensions.iteritems())))
+    digest.update(repr(_attributes(nc)))
+
+    for name in sorted(nc.variables):
+        var = nc.variables[name]
+        digest.update(repr((name, var.dtype.str, var.dimensions,
+                            _attributes(var))))
+
+        if not var.shape:
+            digest.update(asarray(var.getValue()).tobytes())
+            continue
+
+        # hash stored values, not the masked arrays read by default
+        var.set_auto_maskandscale(False)
+        try:
+            row_bytes = var.dtype.itemsize*var.size/max(var.shape[0], 1)
+            block = max(HASH_BLOCK_BYTES/max(row_bytes, 1), 1)
+            for start in xrange(0, var.shape[0], block):
+                digest.update(ascontiguousarray(
+                    var[start:start + block]).tobytes())
+        finally:
+            var.set_auto_maskandscale(True)
+
+
+def _attributes(nc_obj):
+    "Sorted (name, value) pairs of the attributes of a Dataset or Variable"
+    return [(name, asarray(nc_obj.getncattr(name)).tolist())
+            for name in sorted(nc_obj.ncattrs())]
+
+
+def _isnobal_version():
+    """Version of the isnobal executable on the PATH, as a hash of its
+       contents; iSNOBAL does not report one of its own.
+
+        Returns:
+            (str) hexadecimal SHA-1 digest, or None if there is no isnobal
+    """
+    path = find_executable('isnobal')
+    if path is None:
+        return None
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024**2), ''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _evict_cache(cache_dir, cache_size):
+    "Remove least recently used outputs until the cache fits `cache_size`"
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.nc'):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            # evicted by a concurrent run
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= cache_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
@@ -7,22 +7,51 @@ Author: Matthew Turner <maturner@uidaho.edu>
 Date: April 21, 2015
 """
 import datetime
+import hashlib
 import numpy as np
 import netCDF4
 import os
+import re
 import uuid
 import utm
 
+from collections import OrderedDict
 from jinja2 import Environment, FileSystemLoader
 from subprocess import Popen
+from utm.conversion import (K0, E, E_P2, _E, R, M1, P2, P3, P4, P5,
+                            zone_number_to_central_longitude)
+from utm.error import OutOfRangeError
+
+#: Storage profiles for the (time, northing, easting) variables of the
+#: iSNOBAL templates: chunk shape, zlib deflate level (0 for none) and byte
+#: shuffling. A chunk length of None spans the whole northing or easting
+#: dimension; time is unlimited, so a time chunk length of None means 1.
+#: 'map' suits reading whole grids at one time, 'series' reading the history
+#: of a few pixels, and 'balanced' a mix of both. 'legacy', the default, is
+#: the storage the templates always had: the netCDF library's default
+#: chunks, deflate level 1 and no shuffling.
+STORAGE_PROFILES = {
+    'legacy': dict(chunks=None, deflate_level=1, shuffle=False),
+    'map': dict(chunks=(1, None, None), deflate_level=1, shuffle=True),
+    'balanced': dict(chunks=(24, 64, 64), deflate_level=4, shuffle=True),
+    'series': dict(chunks=(720, 16, 16), deflate_level=4, shuffle=True)
+}
+
+DEFAULT_STORAGE_PROFILE = 'legacy'
+
+#: Number of lat/lon grids utm2latlon keeps in memory
+LATLON_CACHE_SIZE = 8
+
+_LATLON_CACHE = OrderedDict()
 
 
 def ncgen_from_template(template_filename, ncout_filename=None,
-                        cdl_output_filename=None, clobber=False, **kwargs):
-    """Generate a NetCDF file from a template. If no cdl output filename is
-        given, a temporary file in /tmp will be used. This is slightly
-        dangerous, but the resulting template files are not too large, and we
-        do try to clean up afterwards.
+                        cdl_output_filename=None, clobber=False,
+                        storage_profile=DEFAULT_STORAGE_PROFILE, **kwargs):
+    """Generate a NetCDF file from a template. The template is rendered to
+        CDL and the NetCDF built from it in-process with build_nc, without
+        the `ncgen` binary. The CDL is only written to disk if a cdl output
+        filename is given.
 
         Arguments:
             template_filename (str) path to template file used to build CDL
@@ -30,8 +59,11 @@ def ncgen_from_template(template_filename, ncout_filename=None,
             cdl_output_filename (str or None) if the user wants to save the
                 CDL file generated in the process of creating the .nc, provide
                 it here
-            clobber (bool) Whether or not to overwrite file `ncout_filename`
-                if it exists
+            clobber (bool) Whether or not to overwrite file
+                `cdl_output_filename` if it exists
+            storage_profile (str or dict) name of one of STORAGE_PROFILES,
+                or a dict like its values, setting chunking and compression
+                of the time-varying variables
             **kwargs arguments to be passed to build the template; requires
                 knowledge of the arguments of the template
 
@@ -39,25 +71,59 @@ def ncgen_from_template(template_filename, ncout_filename=None,
             (netCDF4.Dataset) NetCDF4 initialized with structure defined in
                 the CDL template when the template variables are filled in
     """
-    # assign a random temp file name for
-    if not cdl_output_filename:
-        cdl_output_filename = '/tmp/' + str(uuid.uuid4()) + '.cdl'
-
-    if os.path.isfile(cdl_output_filename) and not clobber:
+    if cdl_output_filename and os.path.isfile(cdl_output_filename) \
+            and not clobber:
         raise NCOError("CDL file %s already exists and clobber is false" %
                        cdl_output_filename)
 
-    _build_cdl(template_filename, cdl_output_filename, **kwargs)
+    kwargs.update(storage_template_args(storage_profile,
+                                        kwargs.get('nlines'),
+                                        kwargs.get('nsamps')))
+
+    cdl = _build_cdl(template_filename, cdl_output_filename, **kwargs)
 
     if ncout_filename is None:
         ncout_filename = os.path.join('/tmp', str(uuid.uuid4()))
-    print cdl_output_filename
-    nc = ncgen(cdl_output_filename, ncout_filename)
 
-    if not cdl_output_filename:
-        os.remove(cdl_output_filename)
+    return build_nc(parse_cdl(cdl), ncout_filename)
 
-    return nc
+
+def storage_template_args(storage_profile, nlines=None, nsamps=None):
+    """Template arguments setting the storage of time-varying variables
+
+        Arguments:
+            storage_profile (str or dict) name of one of STORAGE_PROFILES, or
+                a dict like its values
+            nlines (int) number of northings of the grid; needed to chunk
+            nsamps (int) number of eastings of the grid; needed to chunk
+
+        Returns:
+            (dict) chunksizes, deflate_level and shuffle template arguments;
+                chunksizes is None for the library's default chunks
+    """
+    if isinstance(storage_profile, basestring):
+        if storage_profile not in STORAGE_PROFILES:
+            raise NCOError("Unknown storage profile %s; choose one of %s" %
+                           (storage_profile, sorted(STORAGE_PROFILES)))
+        storage_profile = STORAGE_PROFILES[storage_profile]
+
+    chunksizes = None
+    if storage_profile['chunks'] is not None:
+        if nlines is None or nsamps is None:
+            raise NCOError("Chunking requires the nlines and nsamps of "
+                           "the grid")
+
+        chunk_time, chunk_lines, chunk_samps = storage_profile['chunks']
+
+        chunk_lines = min(chunk_lines or nlines, nlines)
+        chunk_samps = min(chunk_samps or nsamps, nsamps)
+
+        chunksizes = '%d, %d, %d' % (chunk_time or 1, chunk_lines,
+                                     chunk_samps)
+
+    return dict(chunksizes=chunksizes,
+                deflate_level=storage_profile['deflate_level'],
+                shuffle=('false', 'true')[bool(storage_profile['shuffle'])])
 
 
 CDL_TEMPLATE_ENV = Environment(loader=FileSystemLoader(
@@ -103,25 +169,357 @@ def ncgen(cdl_path, output_path, return_nc=True):
         return netCDF4.Dataset(output_path, 'a')
 
 
+#: numpy types of the CDL types used in our templates
+CDL_TYPES = {'byte': 'i1', 'char': 'S1', 'short': 'i2', 'int': 'i4',
+             'float': 'f4', 'real': 'f4', 'double': 'f8'}
+
+_CDL_TOKEN = re.compile(r"""
+    (?P<comment>//[^\n]*)
+    | (?P<string>"(?:\\.|[^"\\])*")
+    | (?P<end>;)
+    | (?P<text>[^;"/]+|/)
+""", re.VERBOSE)
+
+_CDL_NUMBER = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+
+_CDL_DECLARATION = re.compile(r'^(\w+)\s+(\w+)\s*\(([\w\s,]*)\)$')
+
+
+def parse_cdl(cdl):
+    """Parse the CDL subset used by our templates into a schema for
+        build_nc: global and variable attributes, dimensions and variable
+        declarations. Data sections are not supported.
+
+        Arguments:
+            cdl (str) CDL text, e.g. a rendered template
+
+        Returns:
+            (dict) with OrderedDicts 'attributes' (global attributes),
+                'dimensions' (name to length, None if unlimited) and
+                'variables' (name to a dict of 'type', 'dimensions' and
+                'attributes')
+    """
+    schema = dict(attributes=OrderedDict(), dimensions=OrderedDict(),
+                  variables=OrderedDict())
+
+    # drop the "netcdf name {" header and closing brace
+    cdl = cdl[cdl.index('{') + 1:cdl.rindex('}')]
+
+    section = None
+    statement = []
+    for match in _CDL_TOKEN.finditer(cdl):
+        kind = match.lastgroup
+
+        if kind == 'comment':
+            continue
+
+        elif kind == 'string':
+            statement.append(
+                ('string', match.group().decode('string_escape')[1:-1])
+            )
+
+        elif kind == 'text':
+            text = match.group()
+            # comments split text; join it back up
+            if statement and statement[-1][0] == 'text':
+                text = statement.pop()[1] + text
+
+            keyword = re.match(r'\s*(dimensions|variables|data)\s*:(?!\w)',
+                               text)
+            if keyword and not statement:
+                section = keyword.group(1)
+                text = text[keyword.end():]
+                if section == 'data':
+                    raise NCOError("CDL data sections are not supported")
+            statement.append(('text', text))
+
+        else:
+            _parse_cdl_statement(schema, section, statement)
+            statement = []
+
+    if ''.join(v for _, v in statement).strip():
+        raise NCOError("CDL statement not terminated by ';'")
+
+    return schema
+
+
+def _parse_cdl_statement(schema, section, statement):
+    """Add one ';'-terminated CDL statement to `schema`"""
+    head = statement[0][1] if statement and statement[0][0] == 'text' else ''
+
+    if '=' in head:
+        name, value = head.split('=', 1)
+        name = name.strip()
+        values = [('text', value)] + statement[1:]
+
+        if ':' in name:
+            varname, attname = name.split(':', 1)
+            if varname:
+                attributes = schema['variables'][varname]['attributes']
+            else:
+                attributes = schema['attributes']
+
+            attributes[str(attname)] = _parse_cdl_values(values)
+
+        elif section == 'dimensions':
+            size = value.strip()
+            schema['dimensions'][str(name)] = \
+                None if size == 'UNLIMITED' else int(size)
+
+        else:
+            raise NCOError("Unexpected CDL assignment: %s" % head.strip())
+
+    elif section == 'variables' and len(statement) == 1:
+        declaration = _CDL_DECLARATION.match(head.strip())
+        if declaration is None:
+            raise NCOError("Bad CDL variable declaration: %s" % head.strip())
+
+        type_, varname, dims = declaration.groups()
+        if type_ not in CDL_TYPES:
+            raise NCOError("Unsupported CDL type %s" % type_)
+
+        schema['variables'][str(varname)] = dict(
+            type=CDL_TYPES[type_],
+            dimensions=tuple(str(d.strip()) for d in dims.split(',')
+                             if d.strip()),
+            attributes=OrderedDict()
+        )
+
+    elif head.strip() or len(statement) > 1:
+        raise NCOError("Unexpected CDL statement: %s" % head.strip())
+
+
+def _parse_cdl_values(values):
+    """Value of a CDL attribute: a string, or ints or doubles like ncgen
+        types number literals"""
+    strings = [v for kind, v in values if kind == 'string']
+    if strings:
+        return str(''.join(strings))
+
+    literals = [lit.strip() for _, v in values for lit in v.split(',')
+                if lit.strip()]
+
+    for lit in literals:
+        if not _CDL_NUMBER.match(lit):
+            raise NCOError("Bad CDL attribute value: %s" % lit)
+
+    if any(set('.eE') & set(lit) for lit in literals):
+        numbers = np.array(literals, dtype='f8')
+    else:
+        numbers = np.array(literals, dtype='i4')
+
+    return numbers[0] if len(numbers) == 1 else numbers
+
+
+def build_nc(schema, output_path):
+    """Create a NetCDF4 file with the dimensions, variables and attributes of
+        `schema`, as made by parse_cdl, without the `ncgen` binary. The
+        special attributes _ChunkSizes, _DeflateLevel, _Shuffle, _Storage,
+        _Fletcher32 and _FillValue set the corresponding options of
+        netCDF4.Dataset.createVariable; other special attributes raise an
+        NCOError.
+
+        Arguments:
+            schema (dict) description of the file; see parse_cdl
+            output_path (str) path of the file to create, overwritten if it
+                exists
+
+        Returns:
+            (netCDF4.Dataset) the new dataset, open for writing
+    """
+    nc = netCDF4.Dataset(output_path, 'w', format='NETCDF4')
+
+    try:
+        for name, value in schema['attributes'].iteritems():
+            nc.setncattr(name, value)
+
+        for name, size in schema['dimensions'].iteritems():
+            nc.createDimension(name, size)
+
+        for varname, var in schema['variables'].iteritems():
+            attributes = OrderedDict(var['attributes'])
+
+            options = {}
+            if '_FillValue' in attributes:
+                options['fill_value'] = \
+                    np.array(attributes.pop('_FillValue'), dtype=var['type'])
+            if '_ChunkSizes' in attributes:
+                options['chunksizes'] = \
+                    [int(c) for c in np.atleast_1d(
+                        attributes.pop('_ChunkSizes'))]
+            if '_DeflateLevel' in attributes:
+                level = int(attributes.pop('_DeflateLevel'))
+                options['zlib'] = level > 0
+                options['complevel'] = level
+            if '_Shuffle' in attributes:
+                options['shuffle'] = \
+                    attributes.pop('_Shuffle').lower() == 'true'
+            if '_Fletcher32' in attributes:
+                options['fletcher32'] = \
+                    attributes.pop('_Fletcher32').lower() == 'true'
+            if '_Storage' in attributes:
+                options['contiguous'] = \
+                    attributes.pop('_Storage').lower() == 'contiguous'
+
+            special = [a for a in attributes if a.startswith('_')]
+            if special:
+                raise NCOError("Unsupported special attributes %s of %s" %
+                               (special, varname))
+
+            # ncgen only shuffles along with deflation
+            options.setdefault('shuffle', False)
+
+            v = nc.createVariable(varname, var['type'], var['dimensions'],
+                                  **options)
+
+            for name, value in attributes.iteritems():
+                v.setncattr(name, value)
+
+    except:
+        nc.close()
+        raise
+
+    return nc
+
+
 class NCOError(Exception):
     pass
 
 
 def utm2latlon(bsamp=None, bline=None, dsamp=None, dline=None,
-               nsamp=None, nline=None, utm_zone=11, utm_letter='T'):
+               nsamp=None, nline=None, utm_zone=11, utm_letter='T',
+               cache_dir=None):
     """Create latitude and longitude variables based on the bline and bsamp
        variables given. Default UTM zone is 11T, where Dry Crrek and Reynold's
        Creek are. Included here because we will follow Climate and Forecasting
        (CF) standards for our NetCDF files, which demands lat/lon be present
        in addition to whatever grid variables used by a model.
 
+       Grids are cached by their geometry, in memory for the last
+       LATLON_CACHE_SIZE grids and, given `cache_dir`, as .npy files there.
+
        Returns:
-           2 x (nline * nsamp) array of lat/lon coordinates
+           (nline * nsamp) x 2 array of lat/lon coordinates, samps varying
+           slowest
     """
-    lines = [bline + dline*i for i in range(nline)]
-    samps = [bsamp + dsamp*i for i in range(nsamp)]
+    key = (bsamp, bline, dsamp, dline, nsamp, nline, utm_zone, utm_letter)
+
+    if key in _LATLON_CACHE:
+        _LATLON_CACHE[key] = _LATLON_CACHE.pop(key)
+        return _LATLON_CACHE[key].copy()
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir, 'latlon_%s.npy' % hashlib.sha1(repr(key)).hexdigest()
+        )
+
+    if cache_path is not None and os.path.isfile(cache_path):
+        latlon_arr = np.load(cache_path)
+
+    else:
+        lines = bline + dline*np.arange(nline)
+        samps = bsamp + dsamp*np.arange(nsamp)
+
+        lat, lon = utm_to_latlon(np.repeat(samps, nline),
+                                 np.tile(lines, nsamp),
+                                 utm_zone, utm_letter)
+
+        latlon_arr = np.column_stack((lat, lon))
+
+        if cache_path is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # write then rename so readers never see a partial file
+            tmp_path = cache_path + '.' + str(uuid.uuid4()) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, latlon_arr)
+            os.rename(tmp_path, cache_path)
+
+    _LATLON_CACHE[key] = latlon_arr
+    while len(_LATLON_CACHE) > LATLON_CACHE_SIZE:
+        _LATLON_CACHE.popitem(last=False)
+
+    return latlon_arr.copy()
+
+
+def utm_to_latlon(easting, northing, zone_number, zone_letter):
+    """Convert arrays of UTM coordinates in one zone to latitude and longitude.
+       The same inverse projection as utm.to_latlon, but on whole arrays.
+
+       Returns:
+           (tuple) arrays of latitudes and longitudes, in degrees
+    """
+    easting = np.asarray(easting, dtype='float64')
+    northing = np.asarray(northing, dtype='float64')
+
+    if ((easting < 100000) | (easting >= 1000000)).any():
+        raise OutOfRangeError('easting out of range (must be between '
+                              '100.000 m and 999.999 m)')
+    if ((northing < 0) | (northing > 10000000)).any():
+        raise OutOfRangeError('northing out of range (must be between '
+                              '0 m and 10.000.000 m)')
+    if not 1 <= zone_number <= 60:
+        raise OutOfRangeError('zone number out of range (must be between '
+                              '1 and 60)')
+
+    zone_letter = zone_letter.upper()
+    if not 'C' <= zone_letter <= 'X' or zone_letter in ['I', 'O']:
+        raise OutOfRangeError('zone letter out of range (must be between '
+                              'C and X)')
+
+    x = easting - 500000
+    y = northing
+
+    if zone_letter < 'N':
+        y = y - 10000000
+
+    m = y / K0
+    mu = m / (R * M1)
+
+    p_rad = (mu +
+             P2 * np.sin(2 * mu) +
+             P3 * np.sin(4 * mu) +
+             P4 * np.sin(6 * mu) +
+             P5 * np.sin(8 * mu))
+
+    p_sin = np.sin(p_rad)
+    p_sin2 = p_sin * p_sin
+
+    p_cos = np.cos(p_rad)
+
+    p_tan = p_sin / p_cos
+    p_tan2 = p_tan * p_tan
+    p_tan4 = p_tan2 * p_tan2
+
+    ep_sin = 1 - E * p_sin2
+    ep_sin_sqrt = np.sqrt(1 - E * p_sin2)
+
+    n = R / ep_sin_sqrt
+    r = (1 - E) / ep_sin
+
+    c = _E * p_cos**2
+    c2 = c * c
+
+    d = x / (n * K0)
+    d2 = d * d
+    d3 = d2 * d
+    d4 = d3 * d
+    d5 = d4 * d
+    d6 = d5 * d
+
+    # grouped as in utm.to_latlon so the results agree with it
+    latitude = (p_rad - (p_tan / r) *
+                (d2 / 2 -
+                 d4 / 24 * (5 + 3 * p_tan2 + 10 * c - 4 * c2 - 9 * E_P2)) +
+                d6 / 720 * (61 + 90 * p_tan2 + 298 * c + 45 * p_tan4 -
+                            252 * E_P2 - 3 * c2))
 
-    latlon_arr = [utm.to_latlon(s, l, utm_zone, utm_letter)
-                  for s in samps for l in lines]
+    longitude = (d -
+                 d3 / 6 * (1 + 2 * p_tan2 + c) +
+                 d5 / 120 * (5 - 2 * c + 28 * p_tan2 - 3 * c2 + 8 * E_P2 +
+                             24 * p_tan4)) / p_cos
 
-    return np.array(latlon_arr)
+    return (np.degrees(latitude),
+            np.degrees(longitude) +
+            zone_number_to_central_longitude(zone_number))
@@ -219,7 +219,11 @@ def run_prms(prmsdir=None, data_in=None, param_in=None, control_in=None, gsflow_
 
 
 def prms(data_path=None, param_path=None, control_path=None, output_path=None,
-         animation_path=None, statsvar_path=None,statsvar_txt_path=None,animation_txt_path=None, gsflow_log_path=None, log_path=None, event_emitter=None, *args, **kwargs):
+         animation_path=None, statsvar_path=None,statsvar_txt_path=None,animation_txt_path=None, gsflow_log_path=None, log_path=None, event_emitter=None, scratch_dir=None, *args, **kwargs):
+    '''
+    Run PRMS on NetCDF data and parameters. The model runs in directories
+    under PRMS_RUN_DIR and PRMS_TMP_DIR, or under `scratch_dir` if given.
+    '''
 
     #print 'running prms'
     kwargs['event_name'] = 'initializing_prms'
@@ -228,9 +232,14 @@ def prms(data_path=None, param_path=None, control_path=None, output_path=None,
     if event_emitter:
         event_emitter.emit('progress', **kwargs)
 
-    prms_tmp_dir = os.path.join(PRMS_TMP_DIR, str(
+    run_root, tmp_root = PRMS_RUN_DIR, PRMS_TMP_DIR
+    if scratch_dir:
+        run_root = os.path.join(scratch_dir, 'prms_runs')
+        tmp_root = os.path.join(scratch_dir, 'prms_tmp')
+
+    prms_tmp_dir = os.path.join(tmp_root, str(
         datetime.datetime.now()).replace(' ', ''))
-    prmsdir = os.path.join(PRMS_RUN_DIR, str(
+    prmsdir = os.path.join(run_root, str(
         datetime.datetime.now()).replace(' ', ''))
 
     if not os.path.exists(prms_tmp_dir):
@@ -0,0 +1,274 @@
+"""
+Run iSNOBAL and PRMS without blocking, for services that supervise many runs.
+
+A RunSupervisor starts each run in a child process of its own and returns a
+ModelRun, a concurrent.futures Future of the run's result. One supervisor
+thread watches every run, relays its progress events to the run's event
+emitter and completes its future:
+
+>>> supervisor = RunSupervisor(scratch_dir='/scratch')
+>>> run = supervisor.submit_isnobal('kormos_inputs.nc', 'kormos_outputs.nc',
+...                                 event_emitter=ee, pipeline=True)
+>>> run.done()
+False
+>>> run.cancel()
+True
+
+Cancelling a run kills its child process with the model processes it
+started, e.g. every isnobal process of a tiled run, and removes its scratch
+directory; an output file it had started is left as it was. Runs stay
+pending until they are done, so that they can be cancelled at any time.
+
+An asyncio coroutine, or a trollius one on Python 2, can wait for a run by
+wrapping it with wrap_future, which hands the outcome over from the
+supervisor thread to the event loop. Cancelling the wrapping future cancels
+the run:
+
+>>> outputs = yield From(trollius.wrap_future(run))
+>>> outputs = await asyncio.wrap_future(run)
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from concurrent.futures import Future, wait
+
+from .isnobal import _close_datasets
+
+
+#: Seconds between looks at the runs of a RunSupervisor
+SUPERVISOR_POLL_SECONDS = 0.2
+
+
+class RunSupervisor(object):
+    """
+    Start model runs in child processes and supervise them from one thread.
+
+    Each run gets a scratch directory of its own in `scratch_dir`, the
+    system's temporary directory by default, which is removed when it ends.
+    """
+    def __init__(self, scratch_dir=None):
+        self.scratch_dir = scratch_dir
+
+        self._runs = []
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def submit(self, fn, event_emitter=None, parent_datasets=(), **kwargs):
+        """
+        Run `fn(event_emitter=..., scratch_dir=..., **kwargs)` in a child
+        process. Its progress events are emitted on `event_emitter` by the
+        supervisor thread. `parent_datasets` are netCDF4 Datasets open in
+        this process whose files the run opens too; the child closes its
+        copies of them first (see isnobal._close_datasets).
+
+        Returns:
+            (ModelRun) future of the return value of `fn`, which must be
+            picklable
+        """
+        scratch_dir = tempfile.mkdtemp(prefix='modelrun', dir=self.scratch_dir)
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+
+        process = multiprocessing.Process(
+            target=_run_in_child,
+            args=(child_conn, fn, scratch_dir, kwargs, parent_datasets)
+        )
+
+        with self._lock:
+            process.start()
+            child_conn.close()
+            try:
+                # a process group of its own, so that cancelling the run
+                # also kills the model processes it started
+                os.setpgid(process.pid, process.pid)
+            except OSError:
+                pass
+
+            run = ModelRun(self, process, conn, scratch_dir, event_emitter)
+            self._runs.append(run)
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._supervise)
+                self._thread.daemon = True
+                self._thread.start()
+
+        return run
+
+    def submit_isnobal(self, input_path, output_path, event_emitter=None,
+                       **kwargs):
+        """
+        Run isnobal_runner.run_isnobal on `input_path` without blocking
+
+        Returns:
+            (ModelRun) future of the run
+        """
+        return self.submit(_isnobal_run, event_emitter=event_emitter,
+                           input_path=input_path, output_path=output_path,
+                           **kwargs)
+
+    def submit_prms(self, event_emitter=None, **kwargs):
+        """
+        Run prms_runner.prms without blocking; see it for the arguments
+
+        Returns:
+            (ModelRun) future of the run
+        """
+        return self.submit(_prms_run, event_emitter=event_emitter, **kwargs)
+
+    def shutdown(self, cancel=False):
+        """
+        Wait for the runs to end, or cancel them with `cancel`
+        """
+        with self._lock:
+            runs = list(self._runs)
+
+        if cancel:
+            for run in runs:
+                run.cancel()
+
+        wait(runs)
+
+    def _supervise(self):
+        while True:
+            with self._lock:
+                if not self._runs:
+                    self._thread = None
+                    return
+                runs = list(self._runs)
+
+            for run in runs:
+                run._check()
+
+            time.sleep(SUPERVISOR_POLL_SECONDS)
+
+
+class ModelRun(Future):
+    """
+    Future of a model run started by a RunSupervisor. It stays pending
+    until the run ends, so cancel() succeeds until then: it kills the run's
+    process group and removes its scratch directory.
+    """
+    def __init__(self, supervisor, process, conn, scratch_dir,
+                 event_emitter=None):
+        Future.__init__(self)
+        self.process = process
+        self.scratch_dir = scratch_dir
+
+        self._supervisor = supervisor
+        self._conn = conn
+        self._event_emitter = event_emitter
+        self._outcome = None
+
+    def cancel(self):
+        with self._supervisor._lock:
+            if not Future.cancel(self):
+                return False
+
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                self.process.terminate()
+
+            self._end()
+
+        return True
+
+    def _check(self):
+        "Relay the run's messages and complete it once it has ended"
+        with self._supervisor._lock:
+            if self.done():
+                return
+
+            # before looking at the process, so no message is missed
+            alive = self.process.is_alive()
+
+            try:
+                while self._conn.poll():
+                    message = self._conn.recv()
+                    if message[0] == 'event':
+                        _, name, kwargs = message
+                        if self._event_emitter:
+                            self._event_emitter.emit(name, **kwargs)
+                    else:
+                        self._outcome = message
+            except (EOFError, IOError):
+                # the child is gone; its exit code tells the rest
+                pass
+
+            if self._outcome is None and alive:
+                return
+
+            self._end()
+
+            if self._outcome is None:
+                self.set_exception(RunError(
+                    "model run exited with code %s" % self.process.exitcode))
+            elif self._outcome[0] == 'error':
+                self.set_exception(RunError(self._outcome[1]))
+            else:
+                self.set_result(self._outcome[1])
+
+    def _end(self):
+        "Reap the run's process and remove its scratch directory"
+        self.process.join()
+        self._conn.close()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+        if self in self._supervisor._runs:
+            self._supervisor._runs.remove(self)
+
+
+class _PipeEmitter(object):
+    """
+    Event emitter of a run's child process; sends the events to the
+    supervisor
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def emit(self, name, **kwargs):
+        self.conn.send(('event', name, kwargs))
+
+
+def _run_in_child(conn, fn, scratch_dir, kwargs, parent_datasets=()):
+    """
+    Run `fn` in the child process of a ModelRun and send its outcome
+    """
+    os.setpgrp()
+    _close_datasets(parent_datasets)
+
+    try:
+        result = fn(event_emitter=_PipeEmitter(conn),
+                    scratch_dir=scratch_dir, **kwargs)
+        outcome = ('result', result)
+    except Exception as e:
+        # not every exception can be unpickled in the parent, e.g. Python
+        # 2's CalledProcessError
+        logging.exception('model run failed')
+        message = "%s: %s" % (type(e).__name__, e)
+        if getattr(e, 'output', None):
+            message += "\n" + e.output
+        outcome = ('error', message)
+
+    conn.send(outcome)
+    conn.close()
+
+
+def _isnobal_run(**kwargs):
+    from .isnobal_runner import run_isnobal
+    return run_isnobal(**kwargs)
+
+
+def _prms_run(**kwargs):
+    # PRMS's conversions need the prms package, which iSNOBAL runs don't
+    from .prms_runner import prms
+    return prms(**kwargs)
+
+
+class RunError(Exception):
+    pass
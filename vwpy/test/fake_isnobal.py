@@ -0,0 +1,108 @@
+"""
+A stand-in for the isnobal executable, for tests of the code that runs it.
+
+It reads the inputs of each time step as isnobal does, in.k and in.k+1 at
+step k, and exits with an error if one is missing or has an air
+temperature over 60 dg C, as isnobal fails on bad inputs. At every step it
+writes the em file of the test data and its snow file with z_s grown by 1
+from the init's, so a run restarted from a snow state continues it. Both
+are cut to the grid of the init, so a run of a strip of the test data's
+grid writes that strip of them.
+
+The environment sets how it runs; the variables are inherited by the
+processes that start it:
+
+    FAKE_ISNOBAL_STEP_SECONDS   seconds each time step takes
+    FAKE_ISNOBAL_PID_DIR        directory to leave an empty file named for
+                                its process id in
+"""
+import os
+import sys
+
+FAKE_ISNOBAL = '''#!{python}
+import glob, math, os, sys, time
+sys.path.insert(0, {root!r})
+from vwpy.isnobal import IPW
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+
+
+def fit(ipw, init):
+    "Cut an IPW of the test data's grid to the grid of the init"
+    gb, b = init.header_dict['global'], init.nonglobal_bands[0]
+    b0 = ipw.nonglobal_bands[0]
+    # staged grids may be half a pixel off the test data's
+    line = int(math.floor((b.bline - b0.bline)/b0.dline + 0.5))
+    samp = int(math.floor((b.bsamp - b0.bsamp)/b0.dsamp + 0.5))
+
+    grids = dict((varname, ipw.grid(varname)[line:line + gb.nLines,
+                                             samp:samp + gb.nSamps])
+                 for varname in ipw.varnames)
+
+    ipw.header_dict['global'] = ipw.header_dict['global']._replace(
+        nLines=gb.nLines, nSamps=gb.nSamps)
+    for band in ipw.nonglobal_bands:
+        band.bline, band.bsamp = b.bline, b.bsamp
+    for varname, grid in grids.items():
+        ipw[varname] = grid.ravel()
+
+    return ipw
+
+
+if os.environ.get('FAKE_ISNOBAL_PID_DIR'):
+    open(os.path.join(os.environ['FAKE_ISNOBAL_PID_DIR'],
+                      str(os.getpid())), 'w').close()
+
+# z_s is band 2 of both seven- and eight-band inits
+init = IPW(args['-I'], file_type='restart')
+z_s = init['z_s']
+step_seconds = float(os.environ.get('FAKE_ISNOBAL_STEP_SECONDS', 0))
+
+for k in range(int(args['-n'])):
+    inputs = dict((int(path.rsplit('.', 1)[1]), path)
+                  for path in glob.glob(args['-i'] + '.*')
+                  if path.rsplit('.', 1)[1].isdigit())
+    for t in (k, k + 1):
+        if t not in inputs:
+            sys.stderr.write('missing input %d\\n' % t)
+            sys.exit(4)
+        if IPW(inputs[t], file_type='in')['T_a'].max() > 60:
+            sys.stderr.write('T_a out of range in %s\\n' % inputs[t])
+            sys.exit(1)
+
+    time.sleep(step_seconds)
+
+    fit(IPW({em!r}), init).write('%s.%04d' % (args['-e'], k))
+    snow = fit(IPW({snow!r}), init)
+    snow['z_s'] = z_s + k + 1
+    snow.recalculate_header()
+    snow.write('%s.%04d' % (args['-s'], k))
+'''
+
+
+def install_fake_isnobal(bin_dir):
+    """
+    Write the fake isnobal to `bin_dir` and put it first on the PATH.
+
+    Returns:
+        (str) the PATH before, to restore
+    """
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    outputs_dir = os.path.join(test_dir, 'data', 'outputs')
+
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+
+    isnobal_path = os.path.join(bin_dir, 'isnobal')
+    with open(isnobal_path, 'w') as f:
+        f.write(FAKE_ISNOBAL.format(
+            python=sys.executable,
+            root=os.path.dirname(os.path.dirname(test_dir)),
+            em=os.path.join(outputs_dir, 'em.0000'),
+            snow=os.path.join(outputs_dir, 'snow.0000')))
+    os.chmod(isnobal_path, 0755)
+
+    path = os.environ['PATH']
+    os.environ['PATH'] = bin_dir + os.pathsep + path
+
+    return path
@@ -0,0 +1,224 @@
+"""
+Tests for the ensemble module
+"""
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from netCDF4 import Dataset
+from nose.tools import raises
+from numpy.testing import assert_allclose, assert_array_equal
+
+from ..ensemble import (run_ensemble, Scenario, EnsembleMember, EnsembleError,
+                        _pool_size, _member_scratch_bytes, Perturbation,
+                        write_perturbed_inputs, offset, scale)
+from ..isnobal import generate_standard_nc, IPW, NC_MAXINT
+from .fake_isnobal import install_fake_isnobal
+
+
+def add_one_degree(nc):
+    "Scenario perturbation; at module level so it can be pickled"
+    nc.variables['T_a'][:] += 1.0
+
+
+def add_hundred_degrees(nc):
+    "Scenario perturbation out of the range the fake isnobal accepts"
+    nc.variables['T_a'][:] += 100.0
+
+
+def kill_worker(nc):
+    "Scenario perturbation that dies as a worker killed for its memory does"
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class TestEnsemble(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scratch_dir = os.path.join(self.tmp_dir, 'scratch')
+        os.mkdir(self.scratch_dir)
+
+        self.base_path = os.path.join(self.tmp_dir, 'base.nc')
+        generate_standard_nc('vwpy/test/data/full_nc_example',
+                             self.base_path).close()
+
+        # members run the fake isnobal
+        self.path = install_fake_isnobal(os.path.join(self.tmp_dir, 'bin'))
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pool_size(self):
+        "The pool is bounded by members, CPUs per member and workers"
+        assert _pool_size(10, None, 8, self.scratch_dir, 1, 0) == 8
+        assert _pool_size(3, None, 8, self.scratch_dir, 1, 0) == 3
+        assert _pool_size(10, 2, 8, self.scratch_dir, 1, 0) == 2
+        assert _pool_size(10, None, 8, self.scratch_dir, 1, 0, tiles=4) == 2
+        assert _pool_size(10, None, 2, self.scratch_dir, 1, 0, tiles=4) == 1
+
+    @raises(EnsembleError)
+    def test_pool_size_disk(self):
+        "No member runs without its scratch space"
+        _pool_size(10, None, 8, self.scratch_dir, 1, 1024**5)
+
+    def test_member_scratch_bytes(self):
+        "Scratch space grows with the grid and time steps"
+        nc = Dataset(self.base_path, 'r')
+        npixels = 148*170*len(nc.dimensions['time'])
+        assert _member_scratch_bytes(nc) >= npixels*(6 + 4 + 10 + 9)*2
+        nc.close()
+
+    @raises(EnsembleError)
+    def test_unique_names(self):
+        "Scenario names name the outputs, so they must be unique"
+        run_ensemble(self.base_path, [Scenario('a'), Scenario('a')],
+                     os.path.join(self.tmp_dir, 'outputs'))
+
+    def test_run_ensemble(self):
+        "Every member runs, is timed, and its scratch directory is removed"
+        output_dir = os.path.join(self.tmp_dir, 'outputs')
+        scenarios = [Scenario('observed'), Scenario('P1.0', add_one_degree)]
+
+        members = run_ensemble(self.base_path, scenarios, output_dir,
+                               workers=2, scratch_dir=self.scratch_dir,
+                               min_free_disk=0)
+
+        assert [m.name for m in members] == ['observed', 'P1.0']
+
+        base = Dataset(self.base_path, 'r')
+        nsteps = len(base.dimensions['time']) - 1
+        base.close()
+
+        for member in members:
+            assert isinstance(member, EnsembleMember)
+            assert member.error is None
+            assert member.output_path == \
+                os.path.join(output_dir, member.name + '.nc')
+            assert os.path.exists(member.output_path)
+
+            assert sorted(member.timing) == ['isnobal', 'perturb', 'total']
+            assert member.timing['isnobal'] > 0
+            assert member.timing['total'] >= \
+                member.timing['perturb'] + member.timing['isnobal']
+
+            assert len(member.dataset.dimensions['time']) == nsteps
+            assert 'melt' in member.dataset.variables
+            member.close()
+
+        assert os.listdir(self.scratch_dir) == []
+
+    def test_run_ensemble_failure(self):
+        "A failing member gets its error; the others are not affected"
+        output_dir = os.path.join(self.tmp_dir, 'outputs')
+        scenarios = [Scenario('P100', add_hundred_degrees),
+                     Scenario('observed')]
+
+        failed, observed = run_ensemble(self.base_path, scenarios,
+                                        output_dir, workers=2,
+                                        scratch_dir=self.scratch_dir,
+                                        min_free_disk=0)
+
+        assert isinstance(failed.error, EnsembleError)
+        assert 'T_a out of range' in str(failed.error)
+        assert failed.timing == {}
+        self.assertRaises(EnsembleError, lambda: failed.dataset)
+
+        assert observed.error is None
+        assert 'melt' in observed.dataset.variables
+        observed.close()
+
+        assert os.listdir(self.scratch_dir) == []
+
+    def test_run_ensemble_lost_worker(self):
+        "A member whose worker dies fails; the ensemble does not hang"
+        output_dir = os.path.join(self.tmp_dir, 'outputs')
+        scenarios = [Scenario('killed', kill_worker), Scenario('observed')]
+
+        killed, observed = run_ensemble(self.base_path, scenarios,
+                                        output_dir, workers=1,
+                                        scratch_dir=self.scratch_dir,
+                                        min_free_disk=0)
+
+        assert isinstance(killed.error, EnsembleError)
+        assert 'exit code -%d' % signal.SIGKILL in str(killed.error)
+
+        assert observed.error is None
+        assert 'melt' in observed.dataset.variables
+        observed.close()
+
+        assert os.listdir(self.scratch_dir) == []
+
+
+class TestPerturbation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.base_dir = 'vwpy/test/data/full_nc_example'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_perturbed_inputs(self):
+        "Each perturbation gets its transformed bands, the rest is kept"
+        inputs_dir = os.path.join(self.base_dir, 'inputs')
+        perturbations = [Perturbation('P0.5', {'T_a': offset(0.5)}),
+                         Perturbation('P1.0', {'T_a': offset(1.0)}),
+                         Perturbation('wetter', {'m_pp': scale(1.1)})]
+
+        for workers in (1, 2):
+            root = os.path.join(self.tmp_dir, str(workers))
+            output_dirs = write_perturbed_inputs(inputs_dir, perturbations,
+                                                 root, workers=workers)
+
+            assert output_dirs == [os.path.join(root, p.name)
+                                   for p in perturbations]
+
+            names = sorted(n for n in os.listdir(inputs_dir)
+                           if n.startswith('in.'))
+
+            for name in names:
+                base = IPW(os.path.join(inputs_dir, name))
+                ta_range = base['T_a'].max() - base['T_a'].min()
+
+                for amount, output_dir in zip((0.5, 1.0), output_dirs):
+                    ipw = IPW(os.path.join(output_dir, name))
+                    assert_allclose(ipw['T_a'], base['T_a'] + amount,
+                                    atol=ta_range/NC_MAXINT + 1e-6)
+
+                    # untouched bands keep their headers and values
+                    assert ipw.header_dict['I_lw'].float_max == \
+                        base.header_dict['I_lw'].float_max
+                    assert_array_equal(ipw['I_lw'], base['I_lw'])
+
+                # no band to transform; copied
+                assert open(os.path.join(output_dirs[2], name)).read() == \
+                    open(os.path.join(inputs_dir, name)).read()
+
+    def test_precip_perturbation(self):
+        "Files named without their type are perturbed given the type"
+        ppt_dir = os.path.join(self.base_dir, 'ppt_images_dist')
+        output_dir, = write_perturbed_inputs(
+            ppt_dir, [Perturbation('wetter', {'m_pp': scale(1.1)})],
+            self.tmp_dir, file_type='precip')
+
+        for name in os.listdir(ppt_dir):
+            base = IPW(os.path.join(ppt_dir, name), file_type='precip')
+            ipw = IPW(os.path.join(output_dir, name), file_type='precip')
+
+            atol = 1.1*(base['m_pp'].max() - base['m_pp'].min())/NC_MAXINT
+            assert_allclose(ipw['m_pp'], 1.1*base['m_pp'], atol=atol + 1e-6)
+
+    def test_transformed_leaves_original(self):
+        "A transformed copy does not change the IPW it was made from"
+        ipw = IPW(os.path.join(self.base_dir, 'inputs', 'in.00'))
+        ta = ipw['T_a'].copy()
+        ta_max = ipw.header_dict['T_a'].float_max
+
+        warmer = ipw.transformed({'T_a': offset(2.0)})
+
+        assert_array_equal(ipw['T_a'], ta)
+        assert ipw.header_dict['T_a'].float_max == ta_max
+        assert warmer.header_dict['T_a'].float_min == ta.min() + 2.0
@@ -8,20 +8,26 @@ import numpy.testing as npt
 import numpy as np
 import os
 import pandas as pd
+import shutil
 import subprocess
 import struct
+import tempfile
+import time
 import unittest
 
 from netCDF4 import Dataset
 from nose.tools import raises
 
 from StringIO import StringIO
+from .. import isnobal
 from ..watershed import VARNAME_DICT
 from ..isnobal import (_make_bands,
     GlobalBand, Band, _calc_float_value, _bands_to_dtype, _build_ipw_dataframe,
     _bands_to_header_lines, _write_floatdf_binstring_to_file,
-    _recalculate_header, IPW, reaggregate_ipws, _is_consecutive,
-    AssertISNOBALInput, ISNOBALNetcdfError)
+    _recalculate_header, IPW, IPWLines, reaggregate_ipws, _is_consecutive,
+    AssertISNOBALInput, ISNOBALNetcdfError, IPWFileError, IPWIndex,
+    IPW_INDEX_FILENAME, IPWStack, _iter_ipw_grids, _ProgressReporter,
+    _run_isnobal_process, _steps_done)
 
 
 class TestIPW(unittest.TestCase):
@@ -86,6 +92,73 @@ class TestIPW(unittest.TestCase):
 
             assert all(df[['m_pp', 'rho_snow', 'T_pp']].sum().abs() > 0)
 
+    def test_ipw_lines(self):
+        "IPWLines splits header from binary data by byte offset"
+        ipw_lines = IPWLines(self.test_file)
+
+        assert ipw_lines.header_lines == self.headerLines
+        assert ipw_lines.header_lines[-1].startswith("!<header> image")
+
+        with open(self.test_file, 'rb') as f:
+            header_len = len("".join(self.headerLines))
+            assert ipw_lines.data_offset == header_len
+
+            f.seek(ipw_lines.data_offset)
+            assert ipw_lines.binary_data.tostring() == f.read()
+
+        # 5 bands: 1 + 1 + 2 + 2 + 1 bytes per pixel
+        assert len(ipw_lines.binary_data) == 148*170*7
+
+    def test_band_access(self):
+        "Bands are accessed by name as flat arrays or as grids"
+        ipw = IPW(self.test_file)
+
+        assert ipw.varnames == ['I_lw', 'T_a', 'e_a', 'u', 'T_g']
+        assert 'T_a' in ipw and 'S_n' not in ipw
+
+        assert ipw['T_a'].shape == (148*170,)
+        assert ipw.grid('T_a').shape == (148, 170)
+        npt.assert_array_equal(ipw.grid('T_a')[1], ipw['T_a'][170:340])
+
+        ipw['T_a'] = ipw['T_a'] + 2.0
+        ipw.recalculate_header()
+        assert ipw.header_dict['T_a'].float_min == ipw['T_a'].min()
+
+        # the compatibility DataFrame view carries the modified data
+        df = ipw.data_frame()
+        npt.assert_array_equal(df['T_a'], ipw['T_a'])
+
+        df['T_a'] += 1.0
+        npt.assert_array_equal(df['T_a'], ipw['T_a'])
+
+    def test_lazy_band_decoding(self):
+        "Only the bands that are accessed get decoded"
+        ipw = IPW('vwpy/test/data/em.0134')
+
+        melt = ipw['melt']
+
+        assert ipw._band_data._decoded.keys() == ['melt']
+        assert ipw['melt'] is melt
+
+        df = _build_ipw_dataframe(ipw.nonglobal_bands, ipw.binary_data)
+        npt.assert_array_equal(df['melt'], melt)
+
+    def test_header_only(self):
+        "Header-only IPW has the full header but no band data"
+        ipw = IPW('vwpy/test/data/em.0134', header_only=True)
+        full = IPW('vwpy/test/data/em.0134')
+
+        assert ipw.binary_data is None
+        assert ipw.data_offset == full.data_offset
+        assert ipw.geotransform == full.geotransform
+        assert ipw.header_dict['global'] == full.header_dict['global']
+
+        for varname in ipw.varnames:
+            assert ipw.header_dict[varname].__dict__ == \
+                full.header_dict[varname].__dict__
+
+        self.assertRaises(IPWFileError, lambda: ipw['melt'])
+
     def test_read_init(self):
         "Read init IPW file"
         ipw = IPW('vwpy/test/data/init.ipw')
@@ -488,6 +561,47 @@ class TestIPW(unittest.TestCase):
 
         os.remove(outfile)
 
+    def test_write_over_source(self):
+        "An IPW can be written back to the file its data is read from"
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'in.0000')
+        shutil.copyfile('vwpy/test/data/in.0000', path)
+
+        expected = IPW('vwpy/test/data/in.0000').data_frame()
+
+        ipw = IPW(path)
+        ipw.write(path)
+
+        assert os.listdir(tmp_dir) == ['in.0000']
+        npt.assert_allclose(IPW(path).data_frame().values, expected.values)
+
+        # the data of the IPW that was written is still readable
+        npt.assert_allclose(ipw.data_frame().values, expected.values)
+
+        # with the mode of a file open() makes
+        mask = os.umask(0)
+        os.umask(mask)
+        assert os.stat(path).st_mode & 0777 == 0666 & ~mask
+
+        shutil.rmtree(tmp_dir)
+
+    def test_write_failure(self):
+        "A failed write leaves the file it was to replace and nothing else"
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'in.0000')
+        shutil.copyfile('vwpy/test/data/in.0000', path)
+
+        # out of the range of the header, which was not recalculated
+        ipw = IPW(path)
+        ipw['T_a'] = ipw['T_a'] + 100.0
+        self.assertRaises(AssertionError, ipw.write, path)
+
+        assert os.listdir(tmp_dir) == ['in.0000']
+        with open(path, 'rb') as f, open('vwpy/test/data/in.0000', 'rb') as g:
+            assert f.read() == g.read()
+
+        shutil.rmtree(tmp_dir)
+
 
 class TestResampleIPW(unittest.TestCase):
     """
@@ -732,6 +846,164 @@ class TestResampleIPW(unittest.TestCase):
             os.remove('vwpy/test/data/tmp_write_reagg')
 
 
+class TestIPWIndex(unittest.TestCase):
+    """
+    Test the sidecar index of a directory of IPW files
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outputs_dir = os.path.join(self.tmpdir, 'outputs')
+        # leaving out any index kept there by conversions of the test data
+        shutil.copytree('vwpy/test/data/outputs', self.outputs_dir,
+                        ignore=shutil.ignore_patterns(IPW_INDEX_FILENAME))
+        self.index_file = os.path.join(self.outputs_dir, IPW_INDEX_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index_directory(self):
+        "Index records headers and supports time-range queries"
+        index = IPWIndex(self.outputs_dir)
+
+        # only kept on disk if asked to
+        assert not os.path.exists(self.index_file)
+        IPWIndex(self.outputs_dir, index_file=self.index_file)
+        assert os.path.isfile(self.index_file)
+
+        assert len(index.entries) == 32
+        assert index.time_steps('em') == range(16)
+
+        em_files = index.files('em', start=2, stop=5)
+        assert [os.path.basename(f) for f in em_files] == \
+            ['em.0002', 'em.0003', 'em.0004']
+
+        # opening from the index gives the same IPW as reading the file
+        ipw = index.open(em_files[0])
+        expected = IPW(em_files[0])
+
+        assert ipw.geotransform == expected.geotransform
+        assert ipw.data_offset == expected.data_offset
+        for varname in expected.varnames:
+            assert ipw.header_dict[varname].__dict__ == \
+                expected.header_dict[varname].__dict__
+            npt.assert_array_equal(ipw[varname], expected[varname])
+
+    def test_index_incremental_update(self):
+        "Reloaded index only changes for added, modified or removed files"
+        IPWIndex(self.outputs_dir, index_file=self.index_file)
+
+        index = IPWIndex(self.outputs_dir, index_file=self.index_file)
+        assert not index.update()
+
+        os.remove(os.path.join(self.outputs_dir, 'snow.0015'))
+        shutil.copy('vwpy/test/data/in.0000',
+                    os.path.join(self.outputs_dir, 'in.0003'))
+
+        index = IPWIndex(self.outputs_dir, index_file=self.index_file)
+
+        assert index.time_steps('snow') == range(15)
+        assert index.time_steps('in') == [3]
+        assert index.entries['in.0003']['global']['nbands'] == 5
+
+    def test_index_same_size_rewrite(self):
+        "A file rewritten to the same size and mtime is read again"
+        path = os.path.join(self.outputs_dir, 'em.0002')
+        rewrites = []
+        for melt in (2.0, 5.0):
+            ipw = IPW(path)
+            ipw['melt'] = ipw['melt'] + melt
+            ipw.recalculate_header()
+            rewrites.append(os.path.join(self.tmpdir, 'em.%d' % melt))
+            ipw.write(rewrites[-1])
+
+        shutil.copyfile(rewrites[0], path)
+        st = os.stat(path)
+        index = IPWIndex(self.outputs_dir, index_file=self.index_file)
+
+        # in place, as isnobal writes its outputs
+        shutil.copyfile(rewrites[1], path)
+        os.utime(path, (st.st_atime, st.st_mtime))
+        assert os.stat(path).st_size == st.st_size
+
+        index = IPWIndex(self.outputs_dir, index_file=self.index_file)
+        npt.assert_array_equal(index.open(path)['melt'], ipw['melt'])
+
+    def test_index_unchanged_not_read(self):
+        "Files unchanged since long before they were indexed aren't read"
+        an_hour_ago = time.time() - 3600
+        for filename in os.listdir(self.outputs_dir):
+            os.utime(os.path.join(self.outputs_dir, filename),
+                     (an_hour_ago, an_hour_ago))
+
+        IPWIndex(self.outputs_dir, index_file=self.index_file)
+
+        header_sha1 = isnobal._header_sha1
+        isnobal._header_sha1 = None
+        try:
+            index = IPWIndex(self.outputs_dir, index_file=self.index_file)
+        finally:
+            isnobal._header_sha1 = header_sha1
+
+        assert len(index.entries) == 32
+        assert not index.update()
+
+    def test_parallel_decoding(self):
+        "Files decoded in a process pool come back in order, unchanged"
+        index = IPWIndex(self.outputs_dir)
+        files = index.files()
+
+        serial = list(_iter_ipw_grids(index, files))
+        parallel = list(_iter_ipw_grids(index, files, workers=2))
+
+        assert [p[0] for p in parallel] == files
+        assert [p[1] for p in parallel] == [s[1] for s in serial]
+
+        for (_, _, expected), (_, _, grids) in zip(serial, parallel):
+            assert grids.keys() == expected.keys()
+            for var in expected:
+                npt.assert_array_equal(grids[var], expected[var])
+
+
+class TestIPWStack(unittest.TestCase):
+    """
+    Test the lazy (time, line, samp) view of a directory of IPW files
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outputs_dir = os.path.join(self.tmpdir, 'outputs')
+        shutil.copytree('vwpy/test/data/outputs', self.outputs_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stack_slicing(self):
+        "Slicing a stacked variable matches the grids of the single files"
+        stack = IPWStack(self.outputs_dir, 'em')
+        melt = stack['melt']
+
+        first = IPW(os.path.join(self.outputs_dir, 'em.0000'))
+        nlines, nsamps = first.grid('melt').shape
+
+        assert melt.shape == (16, nlines, nsamps)
+        assert stack.time_steps == range(16)
+
+        expected = [IPW(os.path.join(self.outputs_dir,
+                                     'em.%04d' % t)).grid('melt')
+                    for t in range(2, 5)]
+
+        npt.assert_array_equal(melt[2:5], expected)
+        npt.assert_array_equal(melt[2:5, 3:7, -4:],
+                               [e[3:7, -4:] for e in expected])
+        npt.assert_array_equal(melt[3, 5], expected[1][5])
+        assert melt[2, 3, 1] == expected[0][3, 1]
+        assert melt[5:5, 3:7].shape == (0, 4, nsamps)
+
+    def test_stack_unknown_variable(self):
+        "Asking a stack for a variable not in its file type raises KeyError"
+        stack = IPWStack(self.outputs_dir, 'snow')
+        self.assertRaises(KeyError, stack.__getitem__, 'melt')
+
+
 class TestISNOBAL(unittest.TestCase):
     """Tests for particularities of the Python iSNOBAL interface"""
     def setUp(self):
@@ -748,3 +1020,71 @@ class TestISNOBAL(unittest.TestCase):
     def test_not_isnobal_raises(self):
         "If a NetCDF does not satisfy iSNOBAL requirements, throw ISNOBALNetcdfError"
         AssertISNOBALInput(self.nc_out)
+
+
+class TestIsnobalProcess(unittest.TestCase):
+    """
+    Test running isnobal processes and reporting their progress
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.em_prefix = os.path.join(self.tmp_dir, 'em')
+
+        class Emitter(object):
+            def __init__(self):
+                self.events = []
+
+            def emit(self, name, **kwargs):
+                self.events.append(kwargs)
+
+        self.emitter = Emitter()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_steps_done(self):
+        "Progress is the last time step with outputs"
+        assert _steps_done(self.em_prefix) == 0
+
+        for name in ('em.0000', 'em.0003', 'snow.0007', 'em.log'):
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+
+        assert _steps_done(self.em_prefix) == 4
+
+    def test_progress_reporter(self):
+        "Progress events are rate limited and carry throughput and ETA"
+        progress = _ProgressReporter(self.emitter, 10, interval=60,
+                                     model_run_uuid='abc')
+
+        progress.update(0, force=True)
+        progress.update(2)
+        progress.update(5, force=True)
+
+        first, last = self.emitter.events
+        assert first['progress_value'] == '0.00'
+        assert first['eta_seconds'] is None
+
+        assert last['event_name'] == 'running_isonbal'
+        assert last['model_run_uuid'] == 'abc'
+        assert last['progress_value'] == '50.00'
+        assert last['tsteps_done'] == 5
+        assert last['tsteps_per_second'] > 0
+        assert last['eta_seconds'] == 5/last['tsteps_per_second']
+
+    def test_run_isnobal_process(self):
+        "The output of a failed run is in its error"
+        cmd = ['sh', '-c', 'echo step 1; echo failed >&2; exit 3']
+        progress = _ProgressReporter(self.emitter, 10)
+
+        try:
+            _run_isnobal_process(cmd, self.em_prefix, progress)
+        except subprocess.CalledProcessError as e:
+            assert e.returncode == 3
+            assert e.output == 'step 1\nfailed\n'
+        else:
+            raise AssertionError('no CalledProcessError')
+
+        cmd = ['sh', '-c', 'touch %s.0000 %s.0001; echo ok' %
+               (self.em_prefix, self.em_prefix)]
+        assert _run_isnobal_process(cmd, self.em_prefix, progress) == 'ok\n'
+        assert self.emitter.events[-1]['tsteps_done'] == 2
@@ -0,0 +1,170 @@
+"""
+Tests for the isnobal_runner module
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from netCDF4 import Dataset
+
+from .. import isnobal_runner
+from ..isnobal import generate_standard_nc
+from ..isnobal_runner import run_isnobal, run_cache_key, _evict_cache
+from ..netcdf import STORAGE_PROFILES, DEFAULT_STORAGE_PROFILE
+
+
+class TestRunCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+        self.input_path = os.path.join(self.tmp_dir, 'input.nc')
+        generate_standard_nc('vwpy/test/data/full_nc_example',
+                             self.input_path).close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _key(self, path, **kwargs):
+        nc = Dataset(path, 'r')
+        key = run_cache_key(nc, 'v1', **kwargs)
+        nc.close()
+        return key
+
+    def _modified_copy(self, modify):
+        path = os.path.join(self.tmp_dir, 'modified.nc')
+        shutil.copyfile(self.input_path, path)
+        nc = Dataset(path, 'a')
+        modify(nc)
+        nc.close()
+        return path
+
+    def test_run_cache_key(self):
+        "The key is of the data, attributes, run parameters and model"
+        key = self._key(self.input_path)
+
+        # the same contents in another file
+        copy_path = os.path.join(self.tmp_dir, 'copy.nc')
+        shutil.copyfile(self.input_path, copy_path)
+        assert self._key(copy_path) == key
+
+        # options that do not change the outputs
+        assert self._key(self.input_path, tiles=4, workers=2) == key
+        assert self._key(self.input_path, event_name='running_isonbal',
+                         progress_value=50, job_id='a1b2') == key
+
+        assert self._key(self.input_path, year=2011) != key
+        nc = Dataset(self.input_path, 'r')
+        assert run_cache_key(nc, 'v2') != key
+        nc.close()
+
+        def warmer(nc):
+            nc.variables['T_a'][0, 0, 0] += 1.0
+        assert self._key(self._modified_copy(warmer)) != key
+
+        def longer_steps(nc):
+            nc.data_tstep = 2*nc.data_tstep
+        assert self._key(self._modified_copy(longer_steps)) != key
+
+        def relabeled(nc):
+            nc.variables['T_a'].units = 'K'
+        assert self._key(self._modified_copy(relabeled)) != key
+
+    def test_run_cache_key_options(self):
+        "Options that change the outputs are part of the key"
+        key = self._key(self.input_path)
+
+        assert self._key(self.input_path, crop=False, segment_steps=None,
+                         storage_profile=DEFAULT_STORAGE_PROFILE) == key
+        assert self._key(self.input_path, crop=True) != key
+        assert self._key(self.input_path, segment_steps=4) != key
+        assert self._key(self.input_path, storage_profile='series') != key
+
+        # a profile by name or by value, its chunks a tuple or a list
+        series = self._key(self.input_path, storage_profile='series')
+        profile = dict(STORAGE_PROFILES['series'])
+        assert self._key(self.input_path, storage_profile=profile) == series
+        profile['chunks'] = list(profile['chunks'])
+        assert self._key(self.input_path, storage_profile=profile) == series
+
+        # only the options known to change the outputs are keyed
+        assert self._key(self.input_path, pipeline=True,
+                         scratch_dir=self.tmp_dir, hour='06') == key
+
+    def test_run_cache_key_reuses_digest(self):
+        "An input unchanged since it was last keyed is not read again"
+        an_hour_ago = time.time() - 3600
+        os.utime(self.input_path, (an_hour_ago, an_hour_ago))
+        key = self._key(self.input_path)
+
+        update_digest = isnobal_runner._update_digest
+        isnobal_runner._update_digest = None
+        try:
+            assert self._key(self.input_path, year=2011) != key
+            assert self._key(self.input_path) == key
+        finally:
+            isnobal_runner._update_digest = update_digest
+
+        # a change to the file is hashed
+        def warmer(nc):
+            nc.variables['T_a'][0, 0, 0] += 1.0
+        assert self._key(self._modified_copy(warmer)) != key
+
+    def test_no_isnobal_no_cache(self):
+        "Without an isnobal to key runs by, the cache is not used"
+        path = os.environ['PATH']
+        os.environ['PATH'] = self.tmp_dir
+        try:
+            nc = Dataset(self.input_path, 'r')
+            self.assertRaises(ValueError, run_cache_key, nc)
+            nc.close()
+
+            # the run itself fails, with nothing cached
+            self.assertRaises(OSError, run_isnobal, self.input_path,
+                              os.path.join(self.tmp_dir, 'output.nc'),
+                              cache_dir=self.cache_dir)
+            assert not os.path.exists(self.cache_dir)
+        finally:
+            os.environ['PATH'] = path
+
+    def test_cache_hit(self):
+        "A cached run is not run again; its outputs are copied"
+        os.mkdir(self.cache_dir)
+        key = self._key(self.input_path)
+        cached = os.path.join(self.cache_dir, key + '.nc')
+        with open(cached, 'w') as f:
+            f.write('cached outputs')
+
+        output_path = os.path.join(self.tmp_dir, 'output.nc')
+        run_isnobal(self.input_path, output_path, cache_dir=self.cache_dir,
+                    model_version='v1')
+
+        assert open(output_path).read() == 'cached outputs'
+
+    def test_cache_evicted(self):
+        "An entry evicted before it is opened is a miss"
+        os.mkdir(self.cache_dir)
+        output_path = os.path.join(self.tmp_dir, 'output.nc')
+
+        assert not isnobal_runner._copy_cached(
+            os.path.join(self.cache_dir, 'evicted.nc'), output_path)
+        assert not os.path.exists(output_path)
+
+    def test_evict_cache(self):
+        "The least recently used outputs are evicted first"
+        os.mkdir(self.cache_dir)
+        now = time.time()
+        for age, name in enumerate(('c', 'b', 'a')):
+            path = os.path.join(self.cache_dir, name + '.nc')
+            with open(path, 'w') as f:
+                f.write('x'*100)
+            os.utime(path, (now - age, now - age))
+
+        _evict_cache(self.cache_dir, 250)
+        assert sorted(os.listdir(self.cache_dir)) == ['b.nc', 'c.nc']
+
+        _evict_cache(self.cache_dir, 0)
+        assert os.listdir(self.cache_dir) == []
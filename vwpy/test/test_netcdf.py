@@ -2,17 +2,34 @@
    metadata gleaning, CF-Station data conversion, and maybe more, like opendap.
 """
 
+import gc
+import json
 import os
+import shutil
+import tempfile
 import unittest
 
+from collections import OrderedDict
 from netCDF4 import Dataset
-from numpy import ravel, shape, sum
+from numpy import arange, ravel, reshape, shape, sum, zeros
+from numpy.ma import masked
+from numpy.testing import assert_allclose
 
-from ..netcdf import utm2latlon, ncgen_from_template
+from ..netcdf import (utm2latlon, ncgen_from_template, _LATLON_CACHE,
+                      storage_template_args, _build_cdl, NCOError,
+                      parse_cdl, build_nc, DEFAULT_STORAGE_PROFILE)
 
 # include tests for generate_standard_nc in this module
+from .. import isnobal
 from ..isnobal import (_nc_insert_ipw, IPW, nc_to_standard_ipw,
-                       GlobalBand, generate_standard_nc)
+                       GlobalBand, generate_standard_nc, _TimeStepBuffer,
+                       _iter_precip_tsteps, _read_precip_tsteps,
+                       refresh_precip_tsteps,
+                       NC_JOURNAL_SUFFIX, NC_MAXINT, _tile_windows,
+                       _generate_mosaic_nc, _write_restart_init, _mask_window,
+                       _completed_outputs, _write_ipws_from_nc,
+                       ISNOBALNetcdfError)
+from .fake_isnobal import install_fake_isnobal
 
 
 class TestIsnobalNetCDF(unittest.TestCase):
@@ -287,6 +304,635 @@ class TestIsnobalNetCDF(unittest.TestCase):
         df = IPW(init_file, file_type='init').data_frame()
         assert all(df0 - df < 0.01)
 
+    def test_precip_tsteps(self):
+        "Precip time steps are recorded, and found block-wise without it"
+        nc_out = os.path.join(self.full_nc_base_dir, 'nc_precip.tmp')
+        nc = generate_standard_nc(self.full_nc_base_dir, nc_out)
+
+        ppt_desc = os.path.join(self.full_nc_base_dir, 'ppt_desc')
+        expected = sorted(int(line.split()[0])
+                          for line in open(ppt_desc) if line.strip())
+
+        assert _read_precip_tsteps(nc) == expected
+
+        # the search reads blocks of two time steps at a time
+        step_bytes = 4*4*self.nlines*self.nsamps
+        assert list(_iter_precip_tsteps(nc, memory=2*step_bytes)) == \
+            expected
+
+        nc.close()
+        os.remove(nc_out)
+
+    def test_refresh_precip_tsteps(self):
+        "Precip time steps are recorded again after precip is modified"
+        nc_out = os.path.join(self.full_nc_base_dir, 'nc_refresh.tmp')
+        nc = generate_standard_nc(self.full_nc_base_dir, nc_out)
+
+        expected = _read_precip_tsteps(nc)
+        added = [t for t in range(len(nc.dimensions['time']))
+                 if t not in expected][0]
+        removed = expected[0]
+
+        for varname in ['m_pp', 'percent_snow', 'rho_snow', 'T_pp']:
+            var = nc.variables[varname]
+            var[added] = 1.0
+            var[removed] = masked
+
+        refresh_precip_tsteps(nc)
+
+        assert _read_precip_tsteps(nc) == \
+            sorted(set(expected) - set([removed]) | set([added]))
+
+        nc.close()
+        os.remove(nc_out)
+
+    def test_from_nc_fill_values(self):
+        "Masked NetCDF points are written to IPW as the _FillValue"
+        tmpdir = tempfile.mkdtemp()
+        nc = Dataset(os.path.join(tmpdir, 'fill.nc'), 'w')
+        nc.createDimension('northing', 2)
+        nc.createDimension('easting', 3)
+        for attr, value in (('bline', 10.0), ('dline', -1.0),
+                            ('bsamp', 20.0), ('dsamp', 1.0)):
+            nc.setncattr(attr, value)
+
+        alt = nc.createVariable('alt', 'f4', ('northing', 'easting'),
+                                fill_value=-9999.0)
+        # one point set and the rest left as fill values
+        alt[0, 0] = 1500.0
+
+        ipw = IPW.from_nc(nc, variable='alt')
+        assert list(ipw._band_data['alt']) == [1500.0] + 5*[-9999.0]
+        band = ipw.header_dict['alt']
+        assert (band.float_min, band.float_max) == (-9999.0, 1500.0)
+
+        # an all-fill band has a finite range too
+        nc.createVariable('mask', 'i1', ('northing', 'easting'),
+                          fill_value=0)
+        ipw = IPW.from_nc(nc, variable='mask')
+        assert list(ipw._band_data['mask']) == 6*[0]
+        band = ipw.header_dict['mask']
+        assert (band.float_min, band.float_max) == (0.0, 1.0)
+
+        nc.close()
+        shutil.rmtree(tmpdir)
+
+    def test_from_nc_no_fill_value(self):
+        "Masked points of a variable without a _FillValue write as its min"
+        tmpdir = tempfile.mkdtemp()
+        nc = Dataset(os.path.join(tmpdir, 'nofill.nc'), 'w')
+        nc.createDimension('northing', 2)
+        nc.createDimension('easting', 3)
+        for attr, value in (('bline', 10.0), ('dline', -1.0),
+                            ('bsamp', 20.0), ('dsamp', 1.0)):
+            nc.setncattr(attr, value)
+
+        alt = nc.createVariable('alt', 'f4', ('northing', 'easting'))
+        assert '_FillValue' not in alt.ncattrs()
+        alt[0, :2] = [1500.0, 1600.0]
+
+        ipw = IPW.from_nc(nc, variable='alt')
+        band = ipw.header_dict['alt']
+        assert (band.float_min, band.float_max) == (1500.0, 1600.0)
+
+        ipw_path = os.path.join(tmpdir, 'alt.ipw')
+        ipw.write(ipw_path)
+
+        written = IPW(ipw_path, file_type='dem')
+        assert_allclose(written['alt'], [1500.0, 1600.0] + 4*[1500.0])
+
+        nc.close()
+        shutil.rmtree(tmpdir)
+
+    def test_netcdf_to_standard_ipw_parallel(self):
+        "Staging with worker processes writes the same files as serially"
+        nc_out = os.path.join(self.full_nc_base_dir, 'nc_parallel.tmp')
+        generate_standard_nc(self.full_nc_base_dir, nc_out).close()
+
+        nc = Dataset(nc_out, mode='r')
+
+        serial_dir = os.path.join(self.full_nc_base_dir, 'ipw_from_nc')
+        parallel_dir = os.path.join(self.full_nc_base_dir,
+                                    'ipw_from_nc_parallel')
+
+        nc_to_standard_ipw(nc, serial_dir)
+        nc_to_standard_ipw(nc, parallel_dir, workers=3)
+
+        serial_ppt_desc = open(os.path.join(serial_dir, 'ppt_desc')).read()
+        parallel_ppt_desc = \
+            open(os.path.join(parallel_dir, 'ppt_desc')).read()
+        assert parallel_ppt_desc == \
+            serial_ppt_desc.replace(serial_dir, parallel_dir)
+
+        for subdir in ('inputs', 'ppt_images_dist'):
+            names = sorted(os.listdir(os.path.join(serial_dir, subdir)))
+            assert names == \
+                sorted(os.listdir(os.path.join(parallel_dir, subdir)))
+
+            for name in names:
+                assert open(os.path.join(serial_dir, subdir, name)).read() \
+                    == open(os.path.join(parallel_dir, subdir, name)).read()
+
+        nc.close()
+        os.remove(nc_out)
+        shutil.rmtree(parallel_dir)
+
+    def test_generate_standard_nc_resume(self):
+        "An interrupted conversion to NetCDF resumes from its journal"
+        nc_out = os.path.join(self.full_nc_base_dir, 'nc_resume.tmp')
+        journal_path = nc_out + NC_JOURNAL_SUFFIX
+
+        class Interrupt(Exception):
+            pass
+
+        class InterruptingEmitter(object):
+            "Stops the conversion after a number of progress events"
+            def __init__(self, n_events):
+                self.n_events = n_events
+
+            def emit(self, event, **kwargs):
+                self.n_events -= 1
+                if self.n_events == 0:
+                    raise Interrupt()
+
+        checkpoint_files = isnobal.NC_CHECKPOINT_FILES
+        isnobal.NC_CHECKPOINT_FILES = 3
+        try:
+            self.assertRaises(Interrupt, generate_standard_nc,
+                              self.full_nc_base_dir, nc_out, resume=True,
+                              event_emitter=InterruptingEmitter(7))
+        finally:
+            isnobal.NC_CHECKPOINT_FILES = checkpoint_files
+        gc.collect()
+
+        # files of the last complete checkpoint are journaled
+        done = json.load(open(journal_path))['done']
+        in_files = [name for name in os.listdir(
+            os.path.join(self.full_nc_base_dir, 'inputs'))
+            if name.startswith('in.')]
+        assert done == sorted(in_files)[:6]
+
+        nc = generate_standard_nc(self.full_nc_base_dir, nc_out,
+                                  resume=True)
+        assert not os.path.exists(journal_path)
+
+        expected_out = os.path.join(self.full_nc_base_dir,
+                                    'nc_expected.tmp')
+        expected = generate_standard_nc(self.full_nc_base_dir, expected_out)
+
+        for varname, var in expected.variables.items():
+            assert_allclose(nc.variables[varname][:], var[:])
+
+        nc.close()
+        expected.close()
+        os.remove(nc_out)
+        os.remove(expected_out)
+
+    def test_generate_standard_nc_resume_profile(self):
+        "A conversion with a storage profile dict resumes from its journal"
+        nc_out = os.path.join(self.full_nc_base_dir, 'nc_resume_prof.tmp')
+        profile = dict(chunks=(2, None, None), deflate_level=1,
+                       shuffle=False)
+
+        class Interrupt(Exception):
+            pass
+
+        class RecordingEmitter(object):
+            "Records progress, and stops after a number of events"
+            def __init__(self, n_events=None):
+                self.n_events = n_events
+                self.progress = []
+
+            def emit(self, event, **kwargs):
+                self.progress.append((kwargs['event_name'],
+                                      float(kwargs['progress_value'])))
+                if self.n_events is not None:
+                    self.n_events -= 1
+                    if self.n_events == 0:
+                        raise Interrupt()
+
+        checkpoint_files = isnobal.NC_CHECKPOINT_FILES
+        isnobal.NC_CHECKPOINT_FILES = 3
+        try:
+            self.assertRaises(Interrupt, generate_standard_nc,
+                              self.full_nc_base_dir, nc_out, resume=True,
+                              storage_profile=profile,
+                              event_emitter=RecordingEmitter(7))
+        finally:
+            isnobal.NC_CHECKPOINT_FILES = checkpoint_files
+        gc.collect()
+
+        emitter = RecordingEmitter()
+        nc = generate_standard_nc(self.full_nc_base_dir, nc_out,
+                                  resume=True, storage_profile=profile,
+                                  event_emitter=emitter)
+
+        # the journaled input files are not converted again
+        first_input = [value for name, value in emitter.progress
+                       if name == 'input_ipw_to_nc'][0]
+        assert first_input > 0
+        assert nc.variables['T_a'].chunking()[0] == 2
+
+        nc.close()
+        os.remove(nc_out)
+
+    def test_netcdf_to_standard_ipw_resume(self):
+        "Resumed staging rewrites only missing and incomplete IPW files"
+        nc_out = os.path.join(self.full_nc_base_dir, 'nc_resume_ipw.tmp')
+        nc = generate_standard_nc(self.full_nc_base_dir, nc_out)
+
+        ipw_dir = os.path.join(self.full_nc_base_dir, 'ipw_resume')
+        nc_to_standard_ipw(nc, ipw_dir)
+
+        inputs_dir = os.path.join(ipw_dir, 'inputs')
+        names = sorted(os.listdir(inputs_dir))
+        paths = [os.path.join(inputs_dir, name) for name in names]
+        contents = [open(path, 'rb').read() for path in paths]
+
+        # the process died writing the third and before the last file
+        with open(paths[2], 'r+b') as f:
+            f.truncate(len(contents[2]) - 100)
+        os.remove(paths[-1])
+        os.remove(os.path.join(ipw_dir, 'init.ipw'))
+
+        kept = paths[:2] + [os.path.join(ipw_dir, 'dem.ipw')]
+        for path in kept:
+            os.utime(path, (0, 0))
+
+        nc_to_standard_ipw(nc, ipw_dir, resume=True)
+
+        assert sorted(os.listdir(inputs_dir)) == names
+        for path, content in zip(paths, contents):
+            assert open(path, 'rb').read() == content
+
+        # complete files were kept as they were
+        for path in kept:
+            assert os.stat(path).st_mtime == 0
+
+        assert os.path.exists(os.path.join(ipw_dir, 'init.ipw'))
+
+        nc.close()
+        os.remove(nc_out)
+        shutil.rmtree(ipw_dir)
+
+    def test_tile_windows(self):
+        "Strips of lines split the unmasked pixels about evenly"
+        mask = zeros((self.nlines, self.nsamps))
+        mask[100:, 20:60] = 1
+
+        windows = _tile_windows(mask, 4)
+        assert len(windows) == 4
+
+        lines = [w[0] for w in windows]
+        assert lines[0].start == 0 and lines[-1].stop == self.nlines
+        for prev, cur in zip(lines[:-1], lines[1:]):
+            assert prev.stop == cur.start
+
+        counts = [mask[w].sum() for w in windows]
+        assert max(counts) - min(counts) <= 2*40
+
+        # an empty mask splits evenly; never more strips than lines
+        windows = _tile_windows(zeros((10, 3)), 2)
+        assert [w[0] for w in windows] == [slice(0, 5), slice(5, 10)]
+        assert len(_tile_windows(zeros((3, 3)), 8)) == 3
+
+    def test_tiled_outputs_mosaic(self):
+        "Outputs of strips of the domain mosaic into the whole-domain NetCDF"
+        outputs_dir = os.path.join(self.base_data_dir, 'outputs')
+        nc_out = os.path.join(self.base_data_dir, 'nc_tiles.tmp')
+        nc = generate_standard_nc(outputs_dir, nc_out)
+
+        windows = _tile_windows(zeros((self.nlines, self.nsamps)), 3)
+
+        tmp_dir = tempfile.mkdtemp()
+        tile_dirs = []
+        for i, window in enumerate(windows):
+            tile_dir = os.path.join(tmp_dir, str(i), 'outputs')
+            os.makedirs(tile_dir)
+            tile_dirs.append(tile_dir)
+
+            for tstep in range(len(nc.variables['time'])):
+                for file_type in ('em', 'snow'):
+                    ipw = IPW.from_nc(nc, tstep=tstep, file_type=file_type,
+                                      window=window)
+                    ipw.write(os.path.join(tile_dir, '%s.%04d' %
+                                           (file_type, tstep)))
+
+            # the header places the strip in the domain
+            assert ipw.nlines == window[0].stop - window[0].start
+            assert ipw.geotransform[3] == \
+                nc.bline + window[0].start*nc.dline - nc.dline/2.0
+
+        mosaic_out = os.path.join(self.base_data_dir, 'nc_mosaic.tmp')
+        mosaic = _generate_mosaic_nc(tile_dirs, mosaic_out)
+
+        for file_type in ('em', 'snow'):
+            for varname in isnobal.VARNAME_BY_FILETYPE[file_type]:
+                expected = nc.variables[varname][:]
+                # strips are requantized over their own value ranges
+                atol = (expected.max() - expected.min())/NC_MAXINT + 1e-6
+                assert_allclose(mosaic.variables[varname][:], expected,
+                                rtol=0, atol=atol)
+
+        mosaic.close()
+        nc.close()
+        os.remove(nc_out)
+        os.remove(mosaic_out)
+        shutil.rmtree(tmp_dir)
+
+    def test_mask_window(self):
+        "The window bounds the unmasked pixels; an empty mask is whole"
+        mask = zeros((self.nlines, self.nsamps))
+        mask[30:40, 5] = 1
+        mask[35, 60:70] = 1
+        assert _mask_window(mask) == (slice(30, 40), slice(5, 70))
+
+        assert _mask_window(zeros((4, 3))) == (slice(0, 4), slice(0, 3))
+
+    def test_cropped_outputs_pad(self):
+        "Outputs of a cropped run are padded back onto the whole grid"
+        outputs_dir = os.path.join(self.base_data_dir, 'outputs')
+        nc_out = os.path.join(self.base_data_dir, 'nc_crop.tmp')
+        nc = generate_standard_nc(outputs_dir, nc_out)
+
+        crop = (slice(20, 90), slice(10, 50))
+        windows = [(slice(20, 60), crop[1]), (slice(60, 90), crop[1])]
+
+        tmp_dir = tempfile.mkdtemp()
+        tile_dirs = []
+        for i, window in enumerate(windows):
+            tile_dir = os.path.join(tmp_dir, str(i), 'outputs')
+            os.makedirs(tile_dir)
+            tile_dirs.append(tile_dir)
+
+            for tstep in range(len(nc.variables['time'])):
+                for file_type in ('em', 'snow'):
+                    IPW.from_nc(nc, tstep=tstep, file_type=file_type,
+                                window=window).write(
+                        os.path.join(tile_dir, '%s.%04d' % (file_type, tstep)))
+
+        mosaic_out = os.path.join(self.base_data_dir, 'nc_padded.tmp')
+        mosaic = _generate_mosaic_nc(tile_dirs, mosaic_out, windows=windows,
+                                     grid_shape=(self.nlines, self.nsamps))
+
+        # the origin of outputs of a run over the whole grid
+        gt = IPW.from_nc(nc, tstep=0, file_type='em').geotransform
+        assert mosaic.bline == gt[3] and mosaic.bsamp == gt[0]
+
+        for file_type in ('em', 'snow'):
+            for varname in isnobal.VARNAME_BY_FILETYPE[file_type]:
+                expected = nc.variables[varname][:, crop[0], crop[1]]
+                atol = (expected.max() - expected.min())/NC_MAXINT + 1e-6
+                padded = mosaic.variables[varname][:]
+                assert_allclose(padded[:, crop[0], crop[1]], expected,
+                                rtol=0, atol=atol)
+
+                padded[:, crop[0], crop[1]] = 0
+                assert (padded == 0).all()
+
+        mosaic.close()
+        nc.close()
+        os.remove(nc_out)
+        os.remove(mosaic_out)
+        shutil.rmtree(tmp_dir)
+
+    def test_completed_outputs(self):
+        "Outputs are taken as they are complete, until isnobal exits"
+        class Proc(object):
+            returncode = None
+
+            def poll(self):
+                return self.returncode
+
+        outputs_dir = os.path.join(self.base_data_dir, 'outputs')
+        tmp_dir = tempfile.mkdtemp()
+        em = open(os.path.join(outputs_dir, 'em.0000'), 'rb').read()
+        snow = open(os.path.join(outputs_dir, 'snow.0000'), 'rb').read()
+
+        def write(name, data):
+            with open(os.path.join(tmp_dir, name), 'wb') as f:
+                f.write(data)
+
+        write('em.0000', em)
+        write('snow.0000', snow[:len(snow)//2])
+        write('isnobal.log', '')
+
+        proc = Proc()
+        outputs = _completed_outputs(tmp_dir, proc, poll_seconds=0)
+
+        path, file_type, tstep = next(outputs)
+        assert (os.path.basename(path), file_type, tstep) == \
+            ('em.0000', 'em', 0)
+        os.remove(path)
+
+        # the rest of the snow file, then an em file cut short by the exit
+        write('snow.0000', snow)
+        write('em.0001', em[:len(em)//2])
+        proc.returncode = 0
+
+        path, file_type, tstep = next(outputs)
+        assert (os.path.basename(path), file_type, tstep) == \
+            ('snow.0000', 'snow', 0)
+        os.remove(path)
+
+        self.assertRaises(StopIteration, next, outputs)
+
+        shutil.rmtree(tmp_dir)
+
+    def test_isnobal_pipelined(self):
+        "A pipelined run of an isnobal faster than the polls is complete"
+        tmp_dir = tempfile.mkdtemp()
+        path = install_fake_isnobal(os.path.join(tmp_dir, 'bin'))
+
+        in_path = os.path.join(tmp_dir, 'in.nc')
+        nc_in = generate_standard_nc(self.full_nc_base_dir, in_path)
+
+        expected = isnobal.isnobal(nc_in, os.path.join(tmp_dir, 'run.nc'),
+                                   scratch_dir=tmp_dir)
+
+        # the fake isnobal takes no time over its steps
+        nc = isnobal.isnobal(nc_in, os.path.join(tmp_dir, 'pipelined.nc'),
+                             pipeline=True, scratch_dir=tmp_dir)
+
+        nsteps = len(nc_in.dimensions['time']) - 1
+        assert len(nc.dimensions['time']) == nsteps
+        for varname in ('z_s', 'melt'):
+            assert_allclose(nc.variables[varname][:],
+                            expected.variables[varname][:])
+        assert_allclose(nc.variables['z_s'][-1],
+                        nc_in.variables['z_s'][:] + nsteps, atol=0.01)
+
+        assert sorted(os.listdir(tmp_dir)) == \
+            ['bin', 'in.nc', 'pipelined.nc', 'run.nc']
+
+        nc.close()
+        expected.close()
+        nc_in.close()
+        os.environ['PATH'] = path
+        shutil.rmtree(tmp_dir)
+
+    def test_netcdf_to_standard_ipw_time_range(self):
+        "A range of time steps is staged numbered from its start"
+        nc_out = os.path.join(self.full_nc_base_dir, 'nc_range.tmp')
+        nc = generate_standard_nc(self.full_nc_base_dir, nc_out)
+
+        ipw_dir = os.path.join(self.full_nc_base_dir, 'ipw_range')
+        nc_to_standard_ipw(nc, ipw_dir, time_range=(4, 9))
+
+        assert sorted(os.listdir(os.path.join(ipw_dir, 'inputs'))) == \
+            ['in.%d' % i for i in range(5)]
+
+        ipw = IPW(os.path.join(ipw_dir, 'inputs', 'in.2'))
+        assert_allclose(ipw.grid('T_a'), nc.variables['T_a'][6],
+                        atol=0.01)
+
+        precip = _read_precip_tsteps(nc)
+        ppt_desc = [line.split() for line in
+                    open(os.path.join(ipw_dir, 'ppt_desc'))]
+
+        assert [int(idx) for idx, _ in ppt_desc] == \
+            [t - 4 for t in precip if 4 <= t < 9]
+
+        for idx, path in ppt_desc:
+            assert os.path.basename(path) == 'ppt_%s.ipw' % idx
+
+        nc.close()
+        os.remove(nc_out)
+        shutil.rmtree(ipw_dir)
+
+    def test_isnobal_tiled(self):
+        "Strips staged at once with one precip search equal a whole run"
+        tmp_dir = tempfile.mkdtemp()
+        path = install_fake_isnobal(os.path.join(tmp_dir, 'bin'))
+
+        # workers staging strips open the input again, so it must be
+        # closed for writing
+        in_path = os.path.join(tmp_dir, 'in.nc')
+        generate_standard_nc(self.full_nc_base_dir, in_path).close()
+        nc_in = Dataset(in_path, 'r')
+
+        expected = isnobal.isnobal(nc_in, os.path.join(tmp_dir, 'run.nc'),
+                                   scratch_dir=tmp_dir)
+
+        tiled = isnobal.isnobal(nc_in, os.path.join(tmp_dir, 'tiled.nc'),
+                                tiles=2, workers=2, scratch_dir=tmp_dir)
+
+        # without a recorded index, the precip steps are searched for once
+        searches = []
+        read_precip_tsteps = isnobal._read_precip_tsteps
+        iter_precip_tsteps = isnobal._iter_precip_tsteps
+
+        def counted_search(nc):
+            searches.append(nc)
+            return iter_precip_tsteps(nc)
+
+        isnobal._read_precip_tsteps = lambda nc: None
+        isnobal._iter_precip_tsteps = counted_search
+        try:
+            serial = isnobal.isnobal(nc_in,
+                                     os.path.join(tmp_dir, 'serial.nc'),
+                                     tiles=3, scratch_dir=tmp_dir)
+        finally:
+            isnobal._read_precip_tsteps = read_precip_tsteps
+            isnobal._iter_precip_tsteps = iter_precip_tsteps
+
+        assert len(searches) == 1
+
+        for nc in (tiled, serial):
+            for varname in ('z_s', 'melt'):
+                assert_allclose(nc.variables[varname][:],
+                                expected.variables[varname][:], atol=0.01)
+            nc.close()
+
+        assert sorted(os.listdir(tmp_dir)) == \
+            ['bin', 'in.nc', 'run.nc', 'serial.nc', 'tiled.nc']
+
+        expected.close()
+        nc_in.close()
+        os.environ['PATH'] = path
+        shutil.rmtree(tmp_dir)
+
+    def test_isnobal_segmented_resume(self):
+        "A segmented run resumed after a crash equals an uninterrupted one"
+        tmp_dir = tempfile.mkdtemp()
+        path = install_fake_isnobal(os.path.join(tmp_dir, 'bin'))
+
+        in_path = os.path.join(tmp_dir, 'in.nc')
+        nc_in = generate_standard_nc(self.full_nc_base_dir, in_path)
+
+        expected = isnobal.isnobal(nc_in, os.path.join(tmp_dir, 'full.nc'),
+                                   segment_steps=4, scratch_dir=tmp_dir)
+
+        class Interrupt(Exception):
+            pass
+
+        # crash after segment 1 wrote its restart but before it was
+        # journaled, so a resume must run it again from segment 0's
+        record = isnobal._ConversionJournal.record
+
+        def crashing_record(journal, filenames):
+            if 'segment.1' in filenames:
+                raise Interrupt()
+            record(journal, filenames)
+
+        out_path = os.path.join(tmp_dir, 'out.nc')
+        isnobal._ConversionJournal.record = crashing_record
+        try:
+            self.assertRaises(Interrupt, isnobal.isnobal, nc_in, out_path,
+                              segment_steps=4, scratch_dir=tmp_dir)
+        finally:
+            isnobal._ConversionJournal.record = record
+        gc.collect()
+
+        assert os.path.exists(out_path + NC_JOURNAL_SUFFIX)
+
+        nc = isnobal.isnobal(nc_in, out_path, segment_steps=4,
+                             scratch_dir=tmp_dir)
+
+        for varname in ('z_s', 'melt'):
+            assert_allclose(nc.variables[varname][:],
+                            expected.variables[varname][:])
+        # the fake isnobal grows z_s by 1 a step from the init's
+        assert_allclose(nc.variables['z_s'][-1],
+                        nc_in.variables['z_s'][:] + 15, atol=0.01)
+
+        assert sorted(os.listdir(tmp_dir)) == \
+            ['bin', 'full.nc', 'in.nc', 'out.nc']
+
+        nc.close()
+        expected.close()
+        nc_in.close()
+        os.environ['PATH'] = path
+        shutil.rmtree(tmp_dir)
+
+    def test_write_restart_init(self):
+        "A restart init has all bands of the snow state of an output"
+        snow = IPW(os.path.join(self.base_data_dir, 'outputs', 'snow.0005'))
+
+        in_path = os.path.join(self.full_nc_base_dir, 'nc_restart_in.tmp')
+        nc_in = generate_standard_nc(self.full_nc_base_dir, in_path)
+
+        init_path = os.path.join(self.base_data_dir, 'init_restart.tmp')
+        _write_restart_init(nc_in, snow, init_path)
+
+        init = IPW(init_path, file_type='restart')
+        assert init.varnames == ['z', 'z_0', 'z_s', 'rho', 'T_s_0',
+                                 'T_s_l', 'T_s', 'h2o_sat']
+
+        for varname in ('z_s', 'rho', 'T_s_0', 'T_s_l', 'T_s', 'h2o_sat'):
+            expected = snow.grid(varname)
+            atol = (expected.max() - expected.min())/NC_MAXINT + 1e-6
+            assert_allclose(init.grid(varname), expected, atol=atol)
+
+        for varname in ('z', 'z_0'):
+            expected = nc_in.variables[varname][:]
+            atol = (expected.max() - expected.min())/NC_MAXINT + 1e-6
+            assert_allclose(init.grid(varname), expected, atol=atol)
+
+        nc_in.close()
+        os.remove(in_path)
+        os.remove(init_path)
+
 
 def _validate_nc(test_obj, nc, type_='inputs'):
     # helper for getting varnames within a group
@@ -426,6 +1072,154 @@ class TestNetCDF(unittest.TestCase):
         assert (ll2 == latlons[2]).all
         assert (ll3 == latlons[3]).all
 
+    def test_utm_latlon_grid(self):
+        "Vectorized lat/lon grid matches utm.to_latlon and is cached"
+        from utm import to_latlon
+
+        args = dict(bsamp=569029.6, bline=4842544.9, dsamp=30.0,
+                    dline=-30.0, nsamp=7, nline=5)
+
+        cache_dir = tempfile.mkdtemp()
+        latlons = utm2latlon(cache_dir=cache_dir, **args)
+
+        expected = [to_latlon(args['bsamp'] + args['dsamp']*s,
+                              args['bline'] + args['dline']*l, 11, 'T')
+                    for s in range(args['nsamp'])
+                    for l in range(args['nline'])]
+
+        assert_allclose(latlons, expected, rtol=1e-12)
+
+        assert len(os.listdir(cache_dir)) == 1
+        _LATLON_CACHE.clear()
+        assert_allclose(utm2latlon(cache_dir=cache_dir, **args), latlons)
+
+        shutil.rmtree(cache_dir)
+
+    def test_time_step_buffer(self):
+        "Buffered time steps are written as hyperslabs aligned to chunks"
+        tmpdir = tempfile.mkdtemp()
+        nc = Dataset(os.path.join(tmpdir, 'buffered.nc'), 'w')
+        nc.createDimension('time', None)
+        nc.createDimension('northing', 3)
+        nc.createDimension('easting', 2)
+        nc.createVariable('T_a', 'f4', ('time', 'northing', 'easting'),
+                          chunksizes=(4, 3, 2))
+
+        grids = reshape(arange(13*6, dtype='f4'), (13, 3, 2))
+
+        # room for 3 grids, still one whole chunk of 4
+        assert _TimeStepBuffer(nc, memory=3*6*4).lengths['T_a'] == 4
+
+        # room for 9 grids, rounded down to two whole chunks of 4
+        buf = _TimeStepBuffer(nc, memory=9*6*4)
+        assert buf.lengths['T_a'] == 8
+
+        for tstep in range(9):
+            buf.insert('T_a', tstep, grids[tstep])
+
+        # time steps 0-7 filled a whole buffer and were written
+        assert nc.variables['T_a'].shape[0] == 8
+
+        # skipping time steps 10 and 11 writes the run ending at 9
+        buf.insert('T_a', 9, grids[9])
+        buf.insert('T_a', 12, grids[12])
+        assert nc.variables['T_a'].shape[0] == 10
+
+        buf.flush()
+
+        written = nc.variables['T_a'][:]
+        assert_allclose(written[:10], grids[:10])
+        assert_allclose(written[12], grids[12])
+
+        nc.close()
+        shutil.rmtree(tmpdir)
+
+    def test_storage_profiles(self):
+        "Storage profiles set chunking and compression in rendered CDLs"
+        template_args = dict(bline=100, bsamp=10, dline=1.0, dsamp=-1.0,
+                             nlines=50, nsamps=10, dt='hours', year=2010,
+                             month=10, day="01")
+
+        args = storage_template_args('series', 50, 10)
+        assert args == dict(chunksizes='720, 16, 10', deflate_level=4,
+                            shuffle='true')
+
+        args.update(template_args)
+        cdl = _build_cdl('ipw_out_template.cdl', None, **args)
+
+        assert 'melt:_ChunkSizes = 720, 16, 10 ;' in cdl
+        assert 'melt:_DeflateLevel = 4 ;' in cdl
+        assert 'melt:_Shuffle = "true" ;' in cdl
+
+        args = storage_template_args('map', 50, 10)
+        assert args['chunksizes'] == '1, 50, 10'
+
+        self.assertRaises(NCOError, storage_template_args, 'mapp', 50, 10)
+        self.assertRaises(NCOError, storage_template_args, 'map')
+
+        # the default keeps the storage the templates always had
+        args = storage_template_args(DEFAULT_STORAGE_PROFILE)
+        assert args == dict(chunksizes=None, deflate_level=1,
+                            shuffle='false')
+
+        args.update(template_args)
+        cdl = _build_cdl('ipw_out_template.cdl', None, **args)
+
+        assert '_ChunkSizes' not in cdl
+        assert 'melt:_DeflateLevel = 1 ;' in cdl
+        assert 'melt:_Shuffle = "false" ;' in cdl
+
+    def test_build_nc_from_cdl(self):
+        "NetCDF built in-process from CDL has its dimensions and variables"
+        cdl = """netcdf test {
+            :n = 3; // an int
+            :x = 2.5 ;
+            :link = "http://example.com;a" ;
+
+            dimensions:
+                time = UNLIMITED ;
+                northing = 4 ;
+                easting = 5 ;
+
+            variables:
+                byte mask(northing, easting) ;
+                    mask:_FillValue = 0;
+
+                float T_a(time, northing, easting) ;
+                    T_a:units = "C";
+                    T_a:_ChunkSizes = 2, 4, 5 ;
+                    T_a:_DeflateLevel = 4 ;
+                    T_a:_Shuffle = "true" ;
+        }
+        """
+        schema = parse_cdl(cdl)
+
+        assert schema['dimensions'] == \
+            OrderedDict([('time', None), ('northing', 4), ('easting', 5)])
+
+        tmpdir = tempfile.mkdtemp()
+        nc = build_nc(schema, os.path.join(tmpdir, 'built.nc'))
+
+        assert nc.n == 3 and nc.getncattr('n').dtype == 'int32'
+        assert nc.x == 2.5
+        assert nc.link == 'http://example.com;a'
+
+        assert nc.dimensions['time'].isunlimited()
+
+        mask = nc.variables['mask']
+        assert mask.dtype == 'int8'
+        assert mask._FillValue == 0
+
+        T_a = nc.variables['T_a']
+        assert T_a.dimensions == ('time', 'northing', 'easting')
+        assert T_a.units == 'C'
+        assert T_a.chunking() == [2, 4, 5]
+        assert T_a.filters()['complevel'] == 4
+        assert T_a.filters()['shuffle']
+
+        nc.close()
+        shutil.rmtree(tmpdir)
+
     def test_ncgen(self):
         "CDL is generated from template and arguments and can build a valid NetCDF using `ncgen`"
 
@@ -0,0 +1,198 @@
+"""
+Tests for the supervisor module
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from concurrent.futures import CancelledError
+
+from ..isnobal import generate_standard_nc
+from ..supervisor import RunSupervisor, ModelRun, RunError
+from .fake_isnobal import install_fake_isnobal
+
+
+def add(event_emitter=None, scratch_dir=None, a=0, b=0):
+    event_emitter.emit('progress', event_name='adding', progress_value=50)
+    return a + b
+
+
+def fail(event_emitter=None, scratch_dir=None):
+    raise subprocess.CalledProcessError(3, 'isnobal', 'missing input 7\n')
+
+
+def sleep(event_emitter=None, scratch_dir=None):
+    "Start a model process and wait for it, leaving its pid in scratch"
+    proc = subprocess.Popen(['sleep', '60'])
+    with open(os.path.join(scratch_dir, 'pid.tmp'), 'w') as f:
+        f.write(str(proc.pid))
+    os.rename(os.path.join(scratch_dir, 'pid.tmp'),
+              os.path.join(scratch_dir, 'pid'))
+    proc.wait()
+
+
+def is_running(pid):
+    "Whether process `pid` exists and is not a zombie"
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestRunSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.supervisor = RunSupervisor(scratch_dir=self.scratch_dir)
+
+        class Emitter(object):
+            def __init__(self):
+                self.events = []
+
+            def emit(self, name, **kwargs):
+                self.events.append((name, kwargs))
+
+        self.emitter = Emitter()
+
+    def tearDown(self):
+        self.supervisor.shutdown(cancel=True)
+        shutil.rmtree(self.scratch_dir)
+
+    def test_result(self):
+        "A run's events are relayed and its result is its future's"
+        run = self.supervisor.submit(add, event_emitter=self.emitter,
+                                     a=1, b=2)
+        assert isinstance(run, ModelRun)
+
+        assert run.result(timeout=60) == 3
+        assert self.emitter.events == \
+            [('progress', dict(event_name='adding', progress_value=50))]
+        assert os.listdir(self.scratch_dir) == []
+
+    def test_error(self):
+        "A failed run raises RunError with the model's output"
+        run = self.supervisor.submit(fail)
+
+        try:
+            run.result(timeout=60)
+        except RunError as e:
+            assert 'CalledProcessError' in str(e)
+            assert 'missing input 7' in str(e)
+        else:
+            raise AssertionError('no RunError')
+
+        assert os.listdir(self.scratch_dir) == []
+
+    def test_cancel(self):
+        "Cancelling a run kills its model process and removes its scratch"
+        run = self.supervisor.submit(sleep)
+
+        pid_path = os.path.join(run.scratch_dir, 'pid')
+        for _ in range(600):
+            if os.path.exists(pid_path):
+                break
+            time.sleep(0.1)
+        pid = int(open(pid_path).read())
+
+        assert not run.done()
+        assert run.cancel()
+
+        assert run.cancelled()
+        self.assertRaises(CancelledError, run.result)
+        assert not run.process.is_alive()
+
+        for _ in range(100):
+            if not is_running(pid):
+                break
+            time.sleep(0.1)
+        assert not is_running(pid)
+
+        assert os.listdir(self.scratch_dir) == []
+
+        # a done run can't be cancelled
+        run = self.supervisor.submit(add)
+        run.result(timeout=60)
+        assert not run.cancel()
+
+    def test_submit_isnobal(self):
+        "isnobal runs in the run's scratch directory"
+        tmp_dir = tempfile.mkdtemp()
+        input_path = os.path.join(tmp_dir, 'inputs.nc')
+        generate_standard_nc('vwpy/test/data/full_nc_example',
+                             input_path).close()
+
+        run = self.supervisor.submit_isnobal(
+            input_path, os.path.join(tmp_dir, 'outputs.nc'),
+            event_emitter=self.emitter)
+
+        # without an isnobal executable the run fails, but cleanly
+        try:
+            run.result(timeout=300)
+            assert os.path.exists(os.path.join(tmp_dir, 'outputs.nc'))
+        except RunError:
+            pass
+
+        assert any(kwargs['event_name'] == 'processing_input'
+                   for _, kwargs in self.emitter.events)
+        assert os.listdir(self.scratch_dir) == []
+
+        shutil.rmtree(tmp_dir)
+
+    def _cancel_isnobal(self, nprocs, **kwargs):
+        """
+        Cancel an isnobal run once it has `nprocs` isnobal processes running
+        at once, and check that none is left running or starts after
+        """
+        tmp_dir = tempfile.mkdtemp()
+        pid_dir = os.path.join(tmp_dir, 'pids')
+        os.mkdir(pid_dir)
+
+        input_path = os.path.join(tmp_dir, 'inputs.nc')
+        generate_standard_nc('vwpy/test/data/full_nc_example',
+                             input_path).close()
+
+        path = install_fake_isnobal(os.path.join(tmp_dir, 'bin'))
+        os.environ['FAKE_ISNOBAL_STEP_SECONDS'] = '60'
+        os.environ['FAKE_ISNOBAL_PID_DIR'] = pid_dir
+        try:
+            run = self.supervisor.submit_isnobal(
+                input_path, os.path.join(tmp_dir, 'outputs.nc'), **kwargs)
+
+            for _ in range(600):
+                if len(os.listdir(pid_dir)) == nprocs:
+                    break
+                time.sleep(0.1)
+            pids = [int(pid) for pid in os.listdir(pid_dir)]
+            assert len(pids) == nprocs
+
+            assert run.cancel()
+        finally:
+            os.environ['PATH'] = path
+            del os.environ['FAKE_ISNOBAL_STEP_SECONDS']
+            del os.environ['FAKE_ISNOBAL_PID_DIR']
+
+        for _ in range(100):
+            if not any(is_running(pid) for pid in pids):
+                break
+            time.sleep(0.1)
+        assert not any(is_running(pid) for pid in pids)
+
+        # no later segment or strip was started
+        time.sleep(1)
+        assert len(os.listdir(pid_dir)) == nprocs
+
+        assert os.listdir(self.scratch_dir) == []
+
+        shutil.rmtree(tmp_dir)
+
+    def test_cancel_tiled(self):
+        "Cancelling a tiled run kills the isnobal process of every strip"
+        self._cancel_isnobal(2, tiles=2)
+
+    def test_cancel_segmented(self):
+        "Cancelling a segmented run kills its isnobal and starts no more"
+        self._cancel_isnobal(1, segment_steps=4)